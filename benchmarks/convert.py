@@ -0,0 +1,45 @@
+#!/usr/bin/env python3
+"""
+RGB555 -> RGB888 conversion microbenchmark. Prints pixels/s for every
+available backend, using a full 1280x1024 refresh worth of random pixels.
+
+    python benchmarks/convert.py [width] [height] [repeat]
+"""
+
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from client import RGB555_CONVERTERS  # noqa: E402
+
+
+def bench(fn, data, repeat):
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn(data)
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+
+def main(width=1280, height=1024, repeat=5):
+    data = os.urandom(width * height * 2)
+    pixels = width * height
+
+    reference = RGB555_CONVERTERS["struct"](data)
+
+    for name, fn in RGB555_CONVERTERS.items():
+        if fn(data) != reference:
+            raise AssertionError("%s backend output differs from reference" % name)
+
+        elapsed = bench(fn, data, repeat)
+        print(
+            "%-10s %8.2f ms  %12.0f pixels/s" % (name, elapsed * 1000, pixels / elapsed)
+        )
+
+
+if __name__ == "__main__":
+    main(*map(int, sys.argv[1:]))
@@ -0,0 +1,165 @@
+#!/usr/bin/env python3
+"""
+Benchmark corpus - deterministic sequences of KVM video fragments (as passed
+to KVMClient.process_video) representative of typical console contents:
+
+ * `bios` - 720x400 text mode setup screen, with a small counter updating
+ * `text` - 1024x768 text console, scrolling a line every fragment
+ * `installer` - 1024x768 graphical installer with a growing progress bar
+ * `motion` - 1024x768 desktop with a quarter of the screen playing video
+ * `resolution` - full screen updates switching between common resolutions
+
+Recordings (see `recorder.py`) can be used as additional corpus entries.
+
+    python benchmarks/corpus.py
+"""
+
+import os
+import random
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import emulator  # noqa: E402
+from emulator import compress_rle, fragment, render_text, rgb555  # noqa: E402
+
+
+def rect(resx, x, y, w, h, rows):
+    """
+    Compressed (x, y, w, h) area of full screen RGB555 `rows`
+    """
+    return (
+        x,
+        y,
+        w,
+        h,
+        compress_rle(b"".join(row[x * 2 : (x + w) * 2] for row in rows[y : y + h])),
+    )
+
+
+def bios(frames=60):
+    resx, resy = 720, 400
+    rng = random.Random(1)
+    fg, bg = rgb555(255, 255, 255), rgb555(0, 0, 168)
+    rows = render_text(resx // 8, resy // 16, fg, bg, rng, fill=0.5)
+    out = [fragment(resx, resy, [rect(resx, 0, 0, resx, resy, rows)])]
+
+    # Memory test counter - a few glyphs changing on a single line
+    glyphs = render_text(10, frames, fg, bg, rng)
+    for n in range(frames):
+        counter = glyphs[n * 16 : (n + 1) * 16]
+        for row in range(16):
+            line = 20 * 16 + row
+            rows[line] = rows[line][: 160 * 2] + counter[row] + rows[line][240 * 2 :]
+        out.append(fragment(resx, resy, [rect(resx, 160, 320, 80, 16, rows)], n))
+
+    return out
+
+
+def text(frames=60):
+    workload = emulator.TextWorkload(1024, 768, 10)
+    return [workload.initial] + [payload for _, payload in workload.frames[:frames]]
+
+
+def installer(frames=60):
+    resx, resy = 1024, 768
+    rng = random.Random(2)
+    rows = [
+        b"".join(
+            rgb555(x * 255 // resx, 64 + y * 128 // resy, 160) for x in range(0, resx)
+        )
+        for y in range(resy)
+    ]
+
+    # Dialog window with some text
+    bg = rgb555(224, 224, 224)
+    window = render_text(64, 12, rgb555(0, 0, 0), bg, rng, fill=0.6)
+    for n, line in enumerate(window):
+        rows[200 + n] = rows[200 + n][: 256 * 2] + line + rows[200 + n][768 * 2 :]
+
+    out = [fragment(resx, resy, [rect(resx, 0, 0, resx, resy, rows)])]
+
+    bar = rgb555(0, 96, 200)
+    for n in range(frames):
+        # Progress bar, and a spinner next to it
+        x = 288 + 448 * n // frames
+        for y in range(440, 456):
+            rows[y] = rows[y][: 288 * 2] + bar * (x - 288) + rows[y][x * 2 :]
+        spinner = bytes(rng.getrandbits(8) for _ in range(16 * 16 * 2))
+        for y in range(16):
+            line = 440 + y
+            rows[line] = (
+                rows[line][: 740 * 2]
+                + spinner[y * 32 : (y + 1) * 32]
+                + rows[line][756 * 2 :]
+            )
+
+        out.append(
+            fragment(
+                resx,
+                resy,
+                [
+                    rect(resx, 288, 440, 448, 16, rows),
+                    rect(resx, 740, 440, 16, 16, rows),
+                ],
+                n,
+            )
+        )
+
+    return out
+
+
+def motion(frames=30):
+    workload = emulator.MotionWorkload(1024, 768, 10)
+    return [workload.initial] + [payload for _, payload in workload.frames[:frames]]
+
+
+def resolution(frames=6):
+    out = []
+    for n in range(frames):
+        resx, resy = [(640, 480), (800, 600), (1024, 768)][n % 3]
+        workload = emulator.Workload(resx, resy, 10)
+        out.append(workload.full_screen(workload.background()))
+
+    return out
+
+
+def recording(path):
+    """
+    All video fragments of a recording
+    """
+    from recorder import REC_FRAGMENT, Recording
+
+    return [
+        payload
+        for record_type, _, payload in Recording(path).records()
+        if record_type == REC_FRAGMENT
+    ]
+
+
+CORPUS = {
+    "bios": bios,
+    "text": text,
+    "installer": installer,
+    "motion": motion,
+    "resolution": resolution,
+}
+
+
+def load(names=None, recordings=()):
+    """
+    Returns {name: list of fragments} of selected corpus entries and
+    recordings
+    """
+    corpus = {name: CORPUS[name]() for name in names or CORPUS}
+    for path in recordings:
+        corpus[os.path.basename(path)] = recording(path)
+    return corpus
+
+
+if __name__ == "__main__":
+    for name, fragments in load(recordings=sys.argv[1:]).items():
+        print(
+            "%-12s %4d fragments %10d bytes"
+            % (name, len(fragments), sum(map(len, fragments)))
+        )
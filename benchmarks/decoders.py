@@ -0,0 +1,122 @@
+#!/usr/bin/env python3
+"""
+KVM rectangle decoder benchmark. Encodes a synthetic 1024x768 screen (text
+console-like runs mixed with noise) for every registered (color mode,
+compression mode) decoder, verifies decoded output and prints pixels/s.
+
+    python benchmarks/decoders.py [width] [height] [repeat]
+"""
+
+import os
+import random
+import struct
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import client  # noqa: E402
+
+
+def screen(width, height, pixel_size):
+    """
+    Runs of repeated pixels (of random length) mixed with short noisy spans
+    """
+    rng = random.Random(0)
+    size = width * height * pixel_size
+    data = bytearray()
+    while len(data) < size:
+        if rng.random() < 0.7:
+            data += bytes(rng.getrandbits(7) for _ in range(pixel_size)) * rng.randint(
+                1, 200
+            )
+        else:
+            data += bytes(rng.getrandbits(7) for _ in range(pixel_size * 8))
+    return bytes(data[:size])
+
+
+def compress_rle(data, unit):
+    """
+    Reference RLE encoder - see client.decompress_rle
+    """
+    if len(data) % unit:
+        data += bytes(unit - len(data) % unit)
+
+    units = [data[n : n + unit] for n in range(0, len(data), unit)]
+    out = bytearray()
+    literal = []
+
+    def flush():
+        while literal:
+            out.extend(b"".join(literal[:0x7FFF]))
+            out.extend(struct.pack("<H", len(literal[:0x7FFF])))
+            del literal[:0x7FFF]
+
+    n = 0
+    while n < len(units):
+        run = 1
+        while n + run < len(units) and units[n + run] == units[n] and run < 0x7FFF:
+            run += 1
+
+        if run >= 3:
+            flush()
+            out.extend(units[n])
+            out.extend(struct.pack("<H", 0x8000 | run))
+        else:
+            literal.extend(units[n : n + run])
+        n += run
+
+    flush()
+    return bytes(out)
+
+
+def expected(colormode, data):
+    if colormode == client.COLOR_MODE_7BIT:
+        return b"".join(
+            struct.pack("<H", client.rgb7_to_rgb555(value & 0x7F)) for value in data
+        )
+
+    return data
+
+
+def main(width=1024, height=768, repeat=5):
+    out = bytearray(width * height * 2 + 4)
+
+    print(
+        "%-6s %-12s %10s %10s %14s"
+        % ("color", "compression", "bytes", "ms", "pixels/s")
+    )
+    for (colormode, compression_mode), decoder in sorted(client.DECODERS.items()):
+        pixel_size = 1 if colormode == client.COLOR_MODE_7BIT else 2
+        pixels = screen(width, height, pixel_size)
+        unit = client.COMPRESSION_UNITS[compression_mode]
+        data = pixels if unit is None else compress_rle(pixels, unit)
+
+        reference = expected(colormode, pixels)
+        if bytes(decoder(data, width, height, out)) != reference:
+            raise AssertionError(
+                "Decoder %r output differs from reference"
+                % ((colormode, compression_mode),)
+            )
+
+        best = None
+        for _ in range(repeat):
+            start = time.perf_counter()
+            decoder(data, width, height, out)
+            elapsed = time.perf_counter() - start
+            best = elapsed if best is None else min(best, elapsed)
+
+        print(
+            "%-6d %-12d %10d %10.2f %14.0f"
+            % (
+                colormode,
+                compression_mode,
+                len(data),
+                best * 1000,
+                width * height / best,
+            )
+        )
+
+
+if __name__ == "__main__":
+    main(*map(int, sys.argv[1:]))
@@ -0,0 +1,96 @@
+#!/usr/bin/env python3
+"""
+RFB encoder benchmark. Prints bytes-on-wire and encode time of a full
+1280x1024 update for every encoder, across a few synthetic screens.
+
+    python benchmarks/encoding.py [width] [height]
+"""
+
+import os
+import struct
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import encoders  # noqa: E402
+from pixelformat import DEFAULT_PIXEL_FORMAT  # noqa: E402
+
+
+def rgb555(r, g, b):
+    return struct.pack("<H", (r << 10) | (g << 5) | b)
+
+
+def text_screen(width, height):
+    """
+    Text console - two colors, pseudo-random glyph bits in 8x16 cells, with
+    every third cell left blank
+    """
+    fg, bg = rgb555(21, 21, 21), rgb555(0, 0, 0)
+    rows = []
+    for y in range(height):
+        line = bytearray()
+        for cx in range(0, width, 8):
+            cell = (cx // 8) * 31 + (y // 16) * 17
+            bits = (cell * 2654435761 >> (y % 16)) & 0xFF
+            if (cx // 8 + y // 16) % 3 == 0:
+                bits = 0
+            for bit in range(8):
+                line += fg if bits & (1 << bit) else bg
+        rows.append(bytes(line[: width * 2]))
+    return b"".join(rows)
+
+
+def gradient_screen(width, height):
+    """
+    Smooth gradients - graphical installer background-like content
+    """
+    return b"".join(
+        rgb555(x * 31 // width, y * 31 // height, (x + y) * 31 // (width + height))
+        for y in range(height)
+        for x in range(width)
+    )
+
+
+def noise_screen(width, height):
+    return os.urandom(width * height * 2)
+
+
+SCREENS = {
+    "text": text_screen,
+    "gradient": gradient_screen,
+    "noise": noise_screen,
+}
+
+
+def main(width=1280, height=1024):
+    configurations = [
+        ("raw", encoders.RawEncoder, {}),
+        ("zlib", encoders.ZlibEncoder, {}),
+        ("zrle", encoders.ZRLEEncoder, {}),
+        ("tight", encoders.TightEncoder, {}),
+    ]
+    if encoders.Image is not None:
+        configurations.append(
+            ("tight-jpeg", encoders.TightEncoder, {"quality_level": 6})
+        )
+
+    print("%-10s %-12s %12s %10s" % ("screen", "encoding", "bytes", "ms"))
+    for screen_name, generator in SCREENS.items():
+        data = generator(width, height)
+
+        for name, cls, kwargs in configurations:
+            encoder = cls(DEFAULT_PIXEL_FORMAT, **kwargs)
+
+            start = time.perf_counter()
+            encoded = encoder.encode(0, 0, width, height, data)
+            elapsed = time.perf_counter() - start
+
+            print(
+                "%-10s %-12s %12d %10.2f"
+                % (screen_name, name, sum(map(len, encoded)), elapsed * 1000)
+            )
+
+
+if __name__ == "__main__":
+    main(*map(int, sys.argv[1:]))
@@ -0,0 +1,126 @@
+#!/usr/bin/env python3
+"""
+Proxy cold start benchmark. Spawns `vncproxy.py` (from another working
+directory) against an emulated KVM, and measures time from spawning it until
+its VNC port accepts connections, and until a viewer gets ServerInit (which
+takes KVM connection and first video fragment). Time to just import
+`vncproxy` is measured as well. Prints median of all runs, in milliseconds.
+
+    python benchmarks/startup.py [runs]
+"""
+
+import asyncio
+import os
+import socket
+import ssl
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+import emulator  # noqa: E402
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def import_time():
+    start = time.perf_counter()
+    subprocess.run(
+        [sys.executable, "-c", "import vncproxy"],
+        cwd=ROOT,
+        check=True,
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.DEVNULL,
+    )
+    return time.perf_counter() - start
+
+
+async def server_init(bmc, timeout=30):
+    """
+    Spawns vncproxy, returns (seconds until listening, seconds until
+    ServerInit)
+    """
+    port = free_port()
+    start = time.perf_counter()
+    process = await asyncio.create_subprocess_exec(
+        sys.executable,
+        os.path.join(ROOT, "vncproxy.py"),
+        *bmc.arguments("127.0.0.1"),
+        cwd=tempfile.gettempdir(),
+        env=dict(os.environ, VNC_PORT=str(port)),
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.DEVNULL,
+    )
+
+    try:
+        while True:
+            try:
+                reader, writer = await asyncio.open_connection("127.0.0.1", port)
+                break
+            except OSError:
+                if time.perf_counter() - start > timeout:
+                    raise
+                await asyncio.sleep(0.002)
+
+        listening = time.perf_counter() - start
+
+        await reader.readexactly(12)
+        writer.write(b"RFB 003.008\n")
+        await reader.readexactly(2)
+        writer.write(b"\x01")
+        await reader.readexactly(4)
+        writer.write(b"\x01")
+        await asyncio.wait_for(reader.readexactly(24), timeout)
+
+        ready = time.perf_counter() - start
+        writer.close()
+        return listening, ready
+
+    finally:
+        process.kill()
+        await process.wait()
+
+
+async def run(runs):
+    cert, key = emulator.generate_certificate()
+    ssl_context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+    ssl_context.load_cert_chain(cert, key)
+
+    bmc = emulator.FakeBMC(emulator.StaticWorkload(1024, 768, 1), ssl_context)
+    await bmc.start("127.0.0.1")
+
+    try:
+        return [await server_init(bmc) for _ in range(runs)]
+    finally:
+        bmc.close()
+
+
+def measure(runs=5):
+    """
+    Returns median {import, listen, server_init} times, in seconds
+    """
+    imports = [import_time() for _ in range(runs)]
+    results = asyncio.get_event_loop().run_until_complete(run(runs))
+
+    return {
+        "import": statistics.median(imports),
+        "listen": statistics.median(listening for listening, _ in results),
+        "server_init": statistics.median(ready for _, ready in results),
+    }
+
+
+def main(runs=5):
+    for name, elapsed in measure(runs).items():
+        print("%-12s %8.1f ms" % (name, elapsed * 1000))
+
+
+if __name__ == "__main__":
+    main(*map(int, sys.argv[1:]))
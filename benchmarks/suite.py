@@ -0,0 +1,472 @@
+#!/usr/bin/env python3
+"""
+Benchmark suite - runs all pipeline stages over the benchmark corpus (see
+`corpus.py`) and emits results as JSON, for comparing runs:
+
+ * `decompress` - KVMClient.decompress, decoded bytes/s
+ * `convert` - rgb555_to_rgb888 backends, pixels/s
+ * `process_video` - KVMClient.process_video (decoding, damage and scroll
+   detection), fragments/s
+ * `vnc_update` - VNCHandler.flush (framebuffer snapshot, encoding and RFB
+   framing) after every fragment, fragments/s per encoding
+ * `end_to_end` - emulated KVM (see `emulator.py`) to VNC viewer socket over
+   loopback - latency at 10 fragments/s, and throughput at full speed. Both
+   ends share the event loop with the proxy, so throughput runs measure how
+   fast the proxy can take fragments in while still serving a viewer.
+ * `startup` - vncproxy cold start, until viewer gets ServerInit (see
+   `startup.py`)
+
+    python benchmarks/suite.py [--output results.json] [--compare old.json]
+
+Comparison marks results worse than baseline by more than `--threshold`,
+and exits with status 1 if there are any.
+"""
+
+import argparse
+import asyncio
+import json
+import logging
+import os
+import platform
+import ssl
+import struct
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import client  # noqa: E402
+import corpus as corpora  # noqa: E402
+import emulator  # noqa: E402
+import encoders  # noqa: E402
+import startup  # noqa: E402
+from vncproxy import KVMSession, SessionHub, VNCHandler, WrappedSocket  # noqa: E402
+from vncproxy import serve_viewer  # noqa: E402
+
+HEADER_SIZE = struct.calcsize("<HIHHB")
+RECT_HEADER = struct.Struct("<HHHHII")
+
+
+def best_of(fn, repeat):
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+
+def rects(fragments):
+    """
+    Yields (x, y, w, h, compression mode, data) of all fragment rectangles
+    """
+    for payload in fragments:
+        pos = HEADER_SIZE
+        while pos + RECT_HEADER.size <= len(payload):
+            x, y, w, h, mode, length = RECT_HEADER.unpack_from(payload, pos)
+            pos += RECT_HEADER.size
+            yield x, y, w, h, mode, payload[pos : pos + length]
+            pos += length
+
+
+def result(value, unit, better="higher", **extra):
+    return dict(extra, value=value, unit=unit, better=better)
+
+
+def bench_decompress(corpus, args):
+    results = {}
+    kvm = client.KVMClient(None, None)
+
+    for name, fragments in corpus.items():
+        compressed = [
+            (data, w * h * 2)
+            for x, y, w, h, mode, data in rects(fragments)
+            if mode == emulator.COMPRESSION_RLE16
+        ]
+        if not compressed:
+            continue
+
+        def run():
+            for data, size in compressed:
+                kvm.decompress(data, size)
+
+        elapsed = best_of(run, args.repeat)
+        results["decompress/%s" % name] = result(
+            sum(size for _, size in compressed) / elapsed, "bytes/s"
+        )
+
+    return results
+
+
+def bench_convert(corpus, args):
+    data = os.urandom(1024 * 768 * 2)
+    results = {}
+
+    for name, fn in client.RGB555_CONVERTERS.items():
+        # Untimed first call, so that one-off costs (page faults of fresh
+        # buffers, lazy numpy initialization) don't count with --repeat 1
+        fn(data)
+        results["convert/%s" % name] = result(
+            len(data) // 2 / best_of(lambda: fn(data), args.repeat), "pixels/s"
+        )
+
+    return results
+
+
+def bench_process_video(corpus, args):
+    results = {}
+
+    for name, fragments in corpus.items():
+
+        def run():
+            kvm = client.KVMClient(None, None)
+            kvm.on_damage = lambda *rect: None
+            kvm.on_copy = lambda *rect: None
+            for payload in fragments:
+                kvm.process_video(payload)
+
+        elapsed = best_of(run, args.repeat)
+        results["process_video/%s" % name] = result(
+            len(fragments) / elapsed,
+            "fragments/s",
+            pixels_per_second=sum(r[2] * r[3] for r in rects(fragments)) / elapsed,
+        )
+
+    return results
+
+
+class NullSocket(object):
+    """
+    Viewer socket discarding everything sent
+    """
+
+    def __init__(self):
+        self.sent = 0
+
+    async def send(self, data):
+        self.sent += len(data)
+
+    async def send_many(self, chunks):
+        self.sent += sum(map(len, chunks))
+
+
+ENCODINGS = {
+    "raw": encoders.RAW,
+    "zrle": encoders.ZRLE,
+    "tight": encoders.TIGHT,
+}
+
+
+def bench_vnc_update(corpus, args):
+    loop = asyncio.get_event_loop()
+    results = {}
+
+    for name, fragments in corpus.items():
+        for encoding_name, encoding in ENCODINGS.items():
+            kvm = client.KVMClient(None, None)
+            session = KVMSession(kvm, loop)
+            handler = VNCHandler(NullSocket(), session, loop)
+            session.viewers.add(handler)
+            handler.encodings = [encoding, encoders.COPYRECT]
+            handler.encoder = handler.get_encoder(encoding)
+
+            async def run():
+                for payload in fragments:
+                    kvm.process_video(payload)
+                    handler.requested = (0, 0) + kvm.resolution
+                    await handler.flush()
+
+            start = time.perf_counter()
+            loop.run_until_complete(run())
+            elapsed = time.perf_counter() - start
+
+            results["vnc_update/%s/%s" % (name, encoding_name)] = result(
+                len(fragments) / elapsed,
+                "fragments/s",
+                bytes_per_fragment=handler.sock.sent / len(fragments),
+            )
+
+    return results
+
+
+class TimedBMC(emulator.FakeBMC):
+    """
+    FakeBMC keeping send time of every fragment
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.sent = []
+
+    def send_fragment(self, writer, payload):
+        super().send_fragment(writer, payload)
+        self.sent.append(time.monotonic())
+
+
+async def read_exactly(reader, size):
+    return await reader.readexactly(size)
+
+
+async def viewer(port, updates, encoding=encoders.ZRLE):
+    """
+    Minimal VNC viewer, requesting updates continuously and appending time
+    every update is completely received to `updates`. Returns number of
+    bytes received.
+    """
+    reader, writer = await asyncio.open_connection("127.0.0.1", port)
+    received = 0
+
+    try:
+        await reader.readexactly(12)
+        writer.write(b"RFB 003.008\n")
+        await reader.readexactly(2)
+        writer.write(b"\x01")
+        await reader.readexactly(4)
+        writer.write(b"\x01")
+
+        server_init = await reader.readexactly(24)
+        resx, resy = struct.unpack(">HH", server_init[:4])
+        await reader.readexactly(struct.unpack(">I", server_init[20:])[0])
+
+        encodings = [encoding, encoders.COPYRECT, encoders.PSEUDO_DESKTOP_SIZE]
+        writer.write(
+            struct.pack(">BxH", 2, len(encodings))
+            + struct.pack(">%di" % len(encodings), *encodings)
+        )
+        writer.write(struct.pack(">BBHHHH", 3, 0, 0, 0, resx, resy))
+
+        while True:
+            _, count = struct.unpack(">BxH", await reader.readexactly(4))
+            for _ in range(count):
+                x, y, w, h, rect_encoding = struct.unpack(
+                    ">HHHHi", await reader.readexactly(12)
+                )
+                if rect_encoding == encoders.PSEUDO_DESKTOP_SIZE:
+                    resx, resy = w, h
+                elif rect_encoding == encoders.COPYRECT:
+                    received += len(await reader.readexactly(4))
+                elif rect_encoding == encoders.RAW:
+                    received += len(await reader.readexactly(w * h * 4))
+                else:
+                    (length,) = struct.unpack(">I", await reader.readexactly(4))
+                    received += len(await reader.readexactly(length))
+
+            updates.append(time.monotonic())
+            writer.write(struct.pack(">BBHHHH", 3, 1, 0, 0, resx, resy))
+
+    except (asyncio.CancelledError, asyncio.IncompleteReadError, ConnectionError):
+        return received
+    finally:
+        writer.close()
+
+
+async def end_to_end(fragments, ssl_context, fps, duration):
+    """
+    Runs emulated KVM serving `fragments` (first one only once, the rest in
+    a loop) at `fps` (or as fast as possible, if None) through SessionHub to
+    a single viewer, returns (BMC, update times, viewer bytes received)
+    """
+    workload = emulator.Workload(0, 0, fps)
+    workload.initial = fragments[0]
+    workload.frames = [(1.0 / fps if fps else 0, f) for f in fragments[1:]]
+
+    bmc = TimedBMC(workload, ssl_context, video_ssl=False)
+    await bmc.start("127.0.0.1")
+
+    loop = asyncio.get_event_loop()
+    hub = SessionHub(loop)
+
+    async def handle(reader, writer):
+        try:
+            await serve_viewer(
+                WrappedSocket(reader, writer),
+                hub,
+                "bmc",
+                lambda: client.AsyncKVMClient.from_arguments(
+                    bmc.arguments("127.0.0.1")
+                ),
+                loop,
+            )
+        except asyncio.CancelledError:
+            # Session closed at the end of the run
+            pass
+
+    server = await asyncio.start_server(handle, "127.0.0.1", 0)
+    updates = []
+    task = asyncio.ensure_future(viewer(server.sockets[0].getsockname()[1], updates))
+
+    await asyncio.sleep(duration)
+    task.cancel()
+    received = await task
+
+    for session in list(hub.sessions.values()):
+        session.close()
+    server.close()
+    bmc.close()
+    await asyncio.sleep(0.1)
+
+    return bmc, updates, received
+
+
+def percentile(values, fraction):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * fraction))]
+
+
+def bench_end_to_end(corpus, args):
+    cert, key = emulator.generate_certificate()
+    ssl_context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+    ssl_context.load_cert_chain(cert, key)
+
+    loop = asyncio.get_event_loop()
+    results = {}
+
+    for name, fragments in corpus.items():
+        if len(fragments) < 2:
+            continue
+
+        # Latency - time from fragment being sent until viewer has received
+        # an update following it, skipping initial screen
+        bmc, updates, _ = loop.run_until_complete(
+            end_to_end(fragments, ssl_context, 10, args.duration)
+        )
+        latencies = []
+        for sent in bmc.sent[1:]:
+            following = [u for u in updates if u >= sent]
+            if following:
+                latencies.append(following[0] - sent)
+
+        if latencies:
+            results["end_to_end/%s/latency_p50" % name] = result(
+                percentile(latencies, 0.5) * 1000, "ms", "lower"
+            )
+            results["end_to_end/%s/latency_p95" % name] = result(
+                percentile(latencies, 0.95) * 1000, "ms", "lower"
+            )
+
+        # Throughput - BMC sending as fast as proxy reads
+        bmc, updates, received = loop.run_until_complete(
+            end_to_end(fragments, ssl_context, None, args.duration)
+        )
+        results["end_to_end/%s/throughput" % name] = result(
+            len(bmc.sent) / args.duration,
+            "fragments/s",
+            kvm_bytes_per_second=bmc.bytes_sent / args.duration,
+            viewer_bytes_per_second=received / args.duration,
+            updates_per_second=len(updates) / args.duration,
+        )
+
+    return results
+
+
+def bench_startup(corpus, args):
+    return {
+        "startup/%s" % name: result(elapsed * 1000, "ms", "lower")
+        for name, elapsed in startup.measure(args.repeat).items()
+    }
+
+
+BENCHMARKS = {
+    "decompress": bench_decompress,
+    "convert": bench_convert,
+    "process_video": bench_process_video,
+    "vnc_update": bench_vnc_update,
+    "end_to_end": bench_end_to_end,
+    "startup": bench_startup,
+}
+
+
+def compare(baseline, current, threshold):
+    """
+    Prints comparison of results with baseline, returns number of
+    regressions
+    """
+    regressions = 0
+    print("%-44s %14s %14s %8s" % ("benchmark", "baseline", "current", "change"))
+
+    for name, value in sorted(current["results"].items()):
+        base = baseline["results"].get(name)
+        if base is None or not base["value"]:
+            continue
+
+        change = value["value"] / base["value"] - 1
+        worse = -change if value["better"] == "higher" else change
+        regressed = worse > threshold
+        regressions += regressed
+
+        print(
+            "%-44s %14.1f %14.1f %+7.1f%%%s"
+            % (
+                name,
+                base["value"],
+                value["value"],
+                change * 100,
+                " REGRESSION" if regressed else "",
+            )
+        )
+
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument(
+        "--benchmarks", default=",".join(BENCHMARKS), help="comma separated list"
+    )
+    parser.add_argument(
+        "--corpus", default=",".join(corpora.CORPUS), help="comma separated list"
+    )
+    parser.add_argument(
+        "--recording", action="append", default=[], help="add recording to corpus"
+    )
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument(
+        "--duration", type=float, default=3, help="seconds per end-to-end run"
+    )
+    parser.add_argument("--output", help="write JSON results to file")
+    parser.add_argument("--compare", help="baseline JSON results")
+    parser.add_argument("--threshold", type=float, default=0.05)
+    parser.add_argument("-v", "--verbose", action="store_true")
+    args = parser.parse_args()
+
+    if not args.verbose:
+        logging.getLogger().setLevel(logging.WARNING)
+
+    corpus = corpora.load(args.corpus.split(","), args.recording)
+
+    results = {}
+    for name in args.benchmarks.split(","):
+        start = time.perf_counter()
+        results.update(BENCHMARKS[name](corpus, args))
+        print("%s done in %.1fs" % (name, time.perf_counter() - start), file=sys.stderr)
+
+    output = {
+        "meta": {
+            "time": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "cpu_count": os.cpu_count(),
+            "numpy": client.numpy.__version__ if client.numpy else None,
+            "pillow": encoders.Image is not None,
+        },
+        "results": results,
+    }
+
+    if args.output:
+        with open(args.output, "w") as fd:
+            json.dump(output, fd, indent=2, sort_keys=True)
+    else:
+        json.dump(output, sys.stdout, indent=2, sort_keys=True)
+        print()
+
+    if args.compare:
+        with open(args.compare) as fd:
+            baseline = json.load(fd)
+        if compare(baseline, output, args.threshold):
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -7,11 +7,41 @@ import struct
 import logging
 import errno
 import os
-from functools import reduce
+import asyncio
+import array
+import importlib
+import importlib.util
+import time
+import zlib
+from functools import reduce, partial
 
-from PIL import Image
+from metrics import Histogram
+from region import subtract
 
-import socks
+
+class LazyModule(object):
+    """
+    Stand-in for module `name`, imported on first attribute access, so that
+    heavy dependencies don't slow down startup of processes that may never
+    use these. Raises ImportError right away if module isn't installed.
+    """
+
+    def __init__(self, name):
+        if importlib.util.find_spec(name) is None:
+            raise ImportError("No module named %r" % name, name=name)
+        self._name = name
+
+    def __getattr__(self, attr):
+        # Import lock makes concurrent first use from other threads safe
+        return getattr(importlib.import_module(self._name), attr)
+
+
+socks = LazyModule("socks")
+
+try:
+    numpy = LazyModule("numpy")
+except ImportError:
+    numpy = None
 
 
 logging.basicConfig(level=logging.INFO)
@@ -68,13 +98,14 @@ REV_FRAME_TYPES = {v: k for k, v in FRAME_TYPES.items()}
 
 
 # Convert RGB555 to RGB888
-def rgb555_to_rgb888(data):
+def rgb555_to_rgb888_struct(data):
     """
-    Converts RGB555 to (vnc-compatible) RGB888
+    Converts RGB555 to (vnc-compatible) RGB888, one pixel at a time. Kept
+    as a reference implementation for the batched backends below.
     """
     out = bytearray()
 
-    for b in struct.unpack("<%dH" % (len(data) / 2), data):
+    for b in struct.unpack("<%dH" % (len(data) // 2), data[: len(data) & ~1]):
         out.append(((b) & 0b11111) << 3)
         out.append(((b >> 5) & 0b11111) << 3)
         out.append(((b >> 10) & 0b11111) << 3)
@@ -83,6 +114,305 @@ def rgb555_to_rgb888(data):
     return bytes(out)
 
 
+# Per-byte lookup tables for the translate backend. Blue lives in the low
+# byte, red in the high one and green is split across both (3 + 2 bits), so
+# green halves are translated separately (already shifted into disjoint bit
+# ranges) and merged with a single big-integer OR.
+_LO_BLUE = bytes(((i & 0b11111) << 3) for i in range(256))
+_LO_GREEN = bytes(((i >> 5) << 3) for i in range(256))
+_HI_GREEN = bytes(((i & 0b11) << 6) for i in range(256))
+_HI_RED = bytes((((i >> 2) & 0b11111) << 3) for i in range(256))
+
+
+def rgb555_to_rgb888_translate(data):
+    """
+    Pure-python RGB555 to RGB888 converter using bytes.translate lookup
+    tables and strided slice assignment - no per-pixel python code.
+    """
+    count = len(data) // 2
+    lo = bytes(data[0 : count * 2 : 2])
+    hi = bytes(data[1 : count * 2 : 2])
+
+    green = int.from_bytes(lo.translate(_LO_GREEN), "little") | int.from_bytes(
+        hi.translate(_HI_GREEN), "little"
+    )
+
+    out = bytearray(count * 4)
+    out[0::4] = lo.translate(_LO_BLUE)
+    out[1::4] = green.to_bytes(count, "little")
+    out[2::4] = hi.translate(_HI_RED)
+
+    return bytes(out)
+
+
+def rgb555_to_rgb888_numpy(data):
+    """
+    NumPy-backed RGB555 to RGB888 converter
+    """
+    pixels = numpy.frombuffer(data, dtype="<u2", count=len(data) // 2)
+
+    out = numpy.zeros((len(pixels), 4), dtype=numpy.uint8)
+    out[:, 0] = (pixels & 0b11111) << 3
+    out[:, 1] = ((pixels >> 5) & 0b11111) << 3
+    out[:, 2] = ((pixels >> 10) & 0b11111) << 3
+
+    return out.tobytes()
+
+
+RGB555_CONVERTERS = {
+    "struct": rgb555_to_rgb888_struct,
+    "translate": rgb555_to_rgb888_translate,
+}
+
+if numpy is not None:
+    RGB555_CONVERTERS["numpy"] = rgb555_to_rgb888_numpy
+    rgb555_to_rgb888 = rgb555_to_rgb888_numpy
+else:
+    rgb555_to_rgb888 = rgb555_to_rgb888_translate
+
+
+class DecompressionError(ValueError):
+    """
+    Raised when compressed rectangle data is malformed
+    """
+
+
+# Video fragment color modes. Only 15-bit mode has been observed on our
+# hardware - 7-bit mode value is a guess.
+COLOR_MODE_15BIT = 8
+COLOR_MODE_7BIT = 7
+
+# Rectangle compression modes, mapped to RLE unit size in bytes (None for raw
+# data). Only raw (0) and 16-bit RLE (2) have been observed - byte and 32-bit
+# modes are assumed to be numbered the same way.
+COMPRESSION_UNITS = {0: None, 1: 1, 2: 2, 3: 4}
+
+
+def decompress_rle(data, size, out, unit=2):
+    """
+    Decompresses RLE encoded data into `size` bytes of `out` writable buffer,
+    using `unit`-byte (1, 2 or 4) values.
+
+    Data is a sequence of runs, each followed by 16-bit little-endian header -
+    run length (in units) with high bit set for fill runs (single value
+    repeated), or clear for copy runs (values stored as-is). Data is decoded
+    back-to-front. If `size` is not a multiple of `unit`, last unit is assumed
+    to be padded, so `out` needs to be able to fit it. Returns memoryview of
+    decoded data.
+    """
+    end = -(-size // unit) * unit
+    if len(out) < end:
+        raise ValueError("Output buffer smaller than %d bytes" % end)
+
+    data = memoryview(data)
+    out = memoryview(out)
+    pos = len(data)
+    out_pos = end
+
+    while pos > 0:
+        if pos < 2:
+            raise DecompressionError("Truncated run header at %d" % pos)
+
+        chunk_len = (data[pos - 1] << 8) | (data[pos - 2])
+
+        if chunk_len & 0x8000:
+            # fill
+            chunk_len = chunk_len & 0x7FFF
+            if pos < 2 + unit:
+                raise DecompressionError("Truncated fill run at %d" % pos)
+
+            if chunk_len * unit > out_pos:
+                raise DecompressionError(
+                    "Fill of %d units overflows %d byte rectangle" % (chunk_len, size)
+                )
+
+            out[out_pos - chunk_len * unit : out_pos] = (
+                bytes(data[pos - 2 - unit : pos - 2]) * chunk_len
+            )
+            pos -= 2 + unit
+        else:
+            # copy
+            if chunk_len * unit + 2 > pos:
+                raise DecompressionError("Truncated copy run at %d" % pos)
+
+            if chunk_len * unit > out_pos:
+                raise DecompressionError(
+                    "Copy of %d units overflows %d byte rectangle" % (chunk_len, size)
+                )
+
+            out[out_pos - chunk_len * unit : out_pos] = data[
+                pos - chunk_len * unit - 2 : pos - 2
+            ]
+            pos -= 2 + (chunk_len * unit)
+
+        out_pos -= chunk_len * unit
+
+    return out[out_pos:size]
+
+
+def rgb7_to_rgb555(value):
+    """
+    Converts 7-bit color (2-bit red, 3-bit green, 2-bit blue, guessed from
+    JViewer color mode names) to RGB555
+    """
+    red = (value >> 5) & 0b11
+    green = (value >> 2) & 0b111
+    blue = value & 0b11
+    return (red * 31 // 3) << 10 | (green * 31 // 7) << 5 | (blue * 31 // 3)
+
+
+_RGB7_LO = bytes(rgb7_to_rgb555(i & 0x7F) & 0xFF for i in range(256))
+_RGB7_HI = bytes(rgb7_to_rgb555(i & 0x7F) >> 8 for i in range(256))
+
+
+def decode_15bit(data, w, h, out, unit=None):
+    """
+    15-bit color rectangle decoder - raw data is passed through as-is
+    """
+    if unit is None:
+        return memoryview(data)[: w * h * 2]
+
+    return decompress_rle(data, w * h * 2, out, unit)
+
+
+def decode_7bit(data, w, h, out, unit=None):
+    """
+    7-bit color rectangle decoder - palette indices (decompressed into upper
+    half of `out`) are expanded into RGB555 using lookup tables
+    """
+    size = w * h
+    if unit is None:
+        indices = bytes(data[:size])
+    else:
+        indices = bytes(decompress_rle(data, size, memoryview(out)[size:], unit))
+
+    out = memoryview(out)[: len(indices) * 2]
+    out[0::2] = indices.translate(_RGB7_LO)
+    out[1::2] = indices.translate(_RGB7_HI)
+    return out
+
+
+# Rectangle decoders, keyed by (color mode, compression mode). Each decoder
+# takes (data, w, h, out) and returns memoryview of RGB555 data, decoded into
+# `out` writable buffer of w * h * 2 + 4 bytes, or referencing `data` itself.
+DECODERS = {}
+
+for _mode, _unit in COMPRESSION_UNITS.items():
+    DECODERS[COLOR_MODE_15BIT, _mode] = partial(decode_15bit, unit=_unit)
+    DECODERS[COLOR_MODE_7BIT, _mode] = partial(decode_7bit, unit=_unit)
+
+
+class FrameReader:
+    """
+    Buffered reader for `<BIH` framed messages. Data is received in large
+    blocks straight into an internal buffer and all complete frames are
+    parsed out of it at once. Payloads are memoryviews into that buffer, and
+    are only valid until next read.
+    """
+
+    header = struct.Struct("<BIH")
+
+    def __init__(self, size=65536):
+        self.size = size
+        self.buffer = bytearray(size)
+        self.start = 0
+        self.end = 0
+
+        # Total number of bytes received
+        self.received = 0
+
+    def trim(self):
+        """
+        Shrinks buffer back to its initial size, if it has grown to fit a
+        large frame and there is nothing pending in it
+        """
+        if self.start == self.end and len(self.buffer) > self.size:
+            self.buffer = bytearray(self.size)
+            self.start = self.end = 0
+
+    def writable(self, size=0):
+        """
+        Returns writable memoryview of free buffer space, large enough to fit
+        at least `size` more bytes, or whole pending frame, if its header has
+        already been received
+        """
+        needed = self.end - self.start + max(size, 1)
+        if self.end - self.start >= self.header.size:
+            _, msg_len, _ = self.header.unpack_from(self.buffer, self.start)
+            needed = max(needed, self.header.size + msg_len)
+
+        if len(self.buffer) - self.start < needed:
+            pending = memoryview(self.buffer)[self.start : self.end]
+            if len(self.buffer) < needed:
+                # Payloads handed out earlier may still be referenced, so
+                # buffer is replaced instead of being resized in-place
+                self.buffer = bytearray(max(needed, len(self.buffer) * 2))
+            elif self.start < len(pending):
+                # Overlapping move within the same buffer
+                pending = bytes(pending)
+
+            self.buffer[: len(pending)] = pending
+            self.start, self.end = 0, len(pending)
+
+        return memoryview(self.buffer)[self.end :]
+
+    def commit(self, size):
+        self.end += size
+        self.received += size
+
+    def recv_into(self, sock):
+        size = sock.recv_into(self.writable())
+        if not size:
+            raise OSError(errno.ECONNRESET, "%r disconnected" % sock)
+
+        self.commit(size)
+
+        # SSL sockets may keep already decrypted data, which select() won't
+        # report as readable anymore
+        while getattr(sock, "pending", None) and sock.pending():
+            self.commit(sock.recv_into(self.writable(sock.pending())))
+
+    def feed(self, data):
+        self.writable(len(data))[: len(data)] = data
+        self.commit(len(data))
+
+    def frames(self):
+        """
+        Yields (msg_type, status, payload) of all complete frames received
+        """
+        view = memoryview(self.buffer)
+
+        while self.end - self.start >= self.header.size:
+            msg_type, msg_len, status = self.header.unpack_from(self.buffer, self.start)
+            frame_end = self.start + self.header.size + msg_len
+            if frame_end > self.end:
+                break
+
+            payload = view[self.start + self.header.size : frame_end]
+            self.start = frame_end
+            yield msg_type, status, payload
+
+        if self.start == self.end:
+            self.start = self.end = 0
+
+    def partial(self):
+        """
+        Returns (msg_type, status, msg_len, payload) of a frame that has only
+        been partially received so far, payload being the part that is
+        available, or None
+        """
+        if self.end - self.start < self.header.size:
+            return None
+
+        msg_type, msg_len, status = self.header.unpack_from(self.buffer, self.start)
+        return (
+            msg_type,
+            status,
+            msg_len,
+            memoryview(self.buffer)[self.start + self.header.size : self.end],
+        )
+
+
 class KVMClient:
     """
     JViewer.jar-compatible iDRAC/AMI KVM client implementation
@@ -90,21 +420,77 @@ class KVMClient:
 
     on_chunk = None
     on_frame = None
-
-    def __init__(self, address, token, video_port=5901, video_ssl=True, kvm_port=5900):
+    on_damage = None
+    on_copy = None
+    on_fragment = None
+
+    # Tracer and Profiler, when session is being traced or profiled (see
+    # tracing.py), and tracer sampled for data currently being processed
+    tracer = None
+    profiler = None
+    trace = None
+
+    decoders = DECODERS
+
+    # Size of framebuffer tiles tracked in content hash index
+    tile_size = 32
+
+    # Minimal number of rows shifted together for a rectangle to be reported
+    # as a scroll (on_copy), and rows hash index size limit for scroll search
+    scroll_min_rows = 16
+    scroll_max_matches = 8
+
+    def __init__(
+        self,
+        address,
+        token,
+        video_port=5901,
+        video_ssl=True,
+        kvm_port=5900,
+        color_mode=None,
+    ):
         self.address = address
         self.token = token
         self.video_port = video_port
         self.video_ssl = video_ssl
         self.kvm_port = kvm_port
 
+        # Video color mode requested after authentication (eg.
+        # COLOR_MODE_7BIT for low bandwidth links), or None to keep default
+        self.color_mode = color_mode
+
+        # Framebuffer, kept in native RGB555 format (2 bytes per pixel)
         self.fb = None
+        self.resolution = (0, 0)
+
+        # Incremented whenever framebuffer contents change, so anything
+        # derived from them (eg. screenshots) can be cached until then
+        self.generation = 0
         self.running = True
+        self.readers = {}
+        self.video_header = None
+        self._scratch = bytearray()
+        self._scratch_pos = 0
+
+        # Content hash (crc32) of every framebuffer tile, used to drop parts
+        # of rectangles KVM resends without any changes
+        self.tiles = None
+        self.tiles_checked = 0
+        self.tiles_unchanged = 0
+        self.rects_unchanged = 0
+        self.scrolls_detected = 0
+
+        # Metrics (see metrics.py)
+        self.compressed_bytes = 0
+        self.decoded_bytes = 0
+        self.keepalives = 0
+        self.decode_seconds = Histogram()
+        self.decode_time = 0.0
 
         self.logger = logging.getLogger("client.KVMClient")
 
     @classmethod
-    def from_arguments(cls, arguments):
+    def from_arguments(cls, arguments, **kwargs):
         return cls(
             address=arguments[0].partition(":")[0],
             video_port=int(arguments[1]),
@@ -115,6 +501,7 @@ class KVMClient:
             # arguments[6]
             # arguments[7]
             kvm_port=int(arguments[8]),
+            **kwargs
         )
 
     def connect(self):
@@ -128,6 +515,11 @@ class KVMClient:
 
         self.kvm_socket = None
 
+    def connect_kvm(self):
+        self.kvm_socket = self.ssl_context.wrap_socket(
+            create_connection((self.address, self.kvm_port))
+        )
+
     def run(self):
         self.connect()
 
@@ -160,38 +552,81 @@ class KVMClient:
             pass
 
     def process_socket(self, sock):
-        hdr = sock.recv(7)
-        if not hdr:
-            raise OSError(errno.ECONNRESET, "%r disconnected" % sock)
+        reader = self.readers.get(sock)
+        if reader is None:
+            reader = self.readers[sock] = FrameReader()
+
+        start = time.perf_counter()
+        received = reader.received
+        reader.recv_into(sock)
+        self.sample_trace(sock, start, reader.received - received)
+        self.process_frames(sock, reader)
+
+    def sample_trace(self, sock, start, size):
+        """
+        Decides whether data just read from `sock` is traced, and records
+        its `read` span if so
+        """
+        self.trace = self.tracer.sample() if self.tracer is not None else None
+        if self.trace is not None:
+            self.trace.add("read", start, size=size, video=sock is self.video_socket)
+
+    def process_frames(self, sock, reader):
+        """
+        Processes all frames available in FrameReader, including partially
+        received video fragment
+        """
+        start = time.perf_counter()
+        profiler = self.profiler
+
+        try:
+            if profiler is not None:
+                profiler.enable()
 
-        msg_type, msg_len, status = struct.unpack("<BIH", hdr)
+            for msg_type, status, payload in reader.frames():
+                try:
+                    self.process_message(sock, msg_type, status, payload)
+                except OSError:
+                    raise
+                except:
+                    logging.exception("Oops?")
+
+            partial = reader.partial()
+            if partial and partial[0] == 0x03:
+                try:
+                    self.process_video(partial[3], complete=False)
+                except:
+                    logging.exception("Oops?")
+
+        finally:
+            if profiler is not None:
+                profiler.disable()
+            if self.trace is not None:
+                self.trace.add("parse", start)
+
+    def peername(self, sock):
+        return sock.getpeername()
 
+    def process_message(self, sock, msg_type, status, payload):
         self.logger.debug(
             "[%02x %30s / %7d / %08x] %r",
             msg_type,
             REV_FRAME_TYPES.get(msg_type, None),
-            msg_len,
+            len(payload),
             status,
-            sock.getpeername(),
+            self.peername(sock),
         )
 
-        payload = b""
-        while len(payload) < msg_len:
-            fragment = sock.recv(msg_len - len(payload))
-            if not len(fragment):
-                raise OSError(errno.ECONNRESET, "%r disconnected" % sock)
-
-            payload += fragment
-
         if msg_type == 0x0E:
             # Authentication/handshake
             if not self.kvm_socket:
-                self.kvm_socket = self.ssl_context.wrap_socket(
-                    create_connection((self.address, self.kvm_port))
-                )
+                self.connect_kvm()
             elif sock == self.kvm_socket:
                 self.authenticate()
 
+                if self.color_mode is not None:
+                    self.set_color_mode(self.color_mode)
+
         elif msg_type == 0x10:
             if status == 0x002:
                 self.logger.info("Waiting for authorization")
@@ -210,6 +645,7 @@ class KVMClient:
 
         elif msg_type == 0x12:
             # Keepalive
+            self.keepalives += 1
             self.send_frame(sock, 0x13, b"")
 
         elif msg_type == 0x03:
@@ -221,99 +657,420 @@ class KVMClient:
                 "Unhandled frame %d (%r) on %r",
                 msg_type,
                 REV_FRAME_TYPES.get(msg_type, None),
-                sock.getpeername(),
+                self.peername(sock),
             )
 
-    def process_video(self, payload):
+    def process_video(self, payload, complete=True):
+        """
+        Decodes a video fragment. May be called multiple times with growing
+        prefixes of a fragment that is still being received
+        (`complete=False`) - each rectangle is decoded (and `on_chunk` fired)
+        as soon as it is available, and `on_frame` is called once whole
+        fragment has been processed.
+
+        Rectangles which didn't change framebuffer contents are not reported
+        at all, and `on_damage` is only called for changed tiles of the rest.
+        If `on_copy` is set, rectangles are also checked for vertically
+        shifted framebuffer contents (scrolling) - shifted part is then
+        reported using `on_copy`, before `on_damage` for the rest.
+
+        Decoded chunks passed to `on_chunk` and `on_frame` are memoryviews
+        into a scratch buffer reused by the next fragment - callbacks need to
+        copy them if they outlive the call. Same goes for raw fragment payload
+        passed to `on_fragment` after it has been processed.
+        """
         hdrsize = 2 + 4 + 2 + 2 + 1
-        fragnum, framesize, resx, resy, colormode = struct.unpack(
-            "<HIHHB", payload[:hdrsize]
-        )
+        start = time.perf_counter()
+
+        if self.video_header is None:
+            if len(payload) < hdrsize:
+                if complete:
+                    self.logger.warning("Truncated video fragment")
+                return
+
+            self.video_header = struct.unpack_from("<HIHHB", payload)
+            self.video_pos = 0
+            self.video_chunks = []
+            self._scratch_pos = 0
+            self.decode_time = 0.0
+
+            fragnum, framesize, resx, resy, colormode = self.video_header
+            self.logger.debug(
+                "Video frame: %04x %08x %04x %04x %02x",
+                fragnum,
+                framesize,
+                resx,
+                resy,
+                colormode,
+            )
 
-        if not self.fb or (resx, resy) != self.fb.size:
-            self.fb = Image.new("RGB", (resx, resy), color="red")
+            if self.fb is None or (resx, resy) != self.resolution:
+                self.logger.info("Resolution: %dx%d", resx, resy)
+                self.resize(resx, resy)
 
-        framedata = payload[hdrsize:]
-        self.logger.debug(
-            "Video frame: %04x %08x %04x %04x %02x",
-            fragnum,
-            framesize,
-            resx,
-            resy,
-            colormode,
-        )
+        fragnum, framesize, resx, resy, colormode = self.video_header
+        framedata = memoryview(payload)[hdrsize:]
 
-        pos = 0
-        chunks = []
-        while pos < len(framedata):
-            x, y, w, h, compression_mode, compressed_length = struct.unpack(
-                "<HHHHII", framedata[pos : pos + 16]
+        pos = self.video_pos
+        while pos + 16 <= len(framedata):
+            x, y, w, h, compression_mode, compressed_length = struct.unpack_from(
+                "<HHHHII", framedata, pos
             )
+            if pos + 16 + compressed_length > len(framedata):
+                if complete:
+                    self.logger.warning("Truncated rectangle %dx%d+%d+%d", w, h, x, y)
+                break
+
             self.logger.debug("  %dx%d+%d+%d @ %d", w, h, x, y, compression_mode)
             compressed = framedata[pos + 16 : pos + 16 + compressed_length]
             pos += 16 + compressed_length
 
-            chunk = None
+            if not complete:
+                # Partially received payload may still get moved around by
+                # FrameReader, so views into it can't be handed out.
+                compressed = bytes(compressed)
 
-            if compression_mode == 2 and colormode == 8:
-                chunk = self.decompress(compressed)
-            elif compression_mode == 0 and colormode == 8:
-                chunk = compressed
-            else:
-                self.logger.warning(
-                    "Unknown compression: %02x %02x", compression_mode, colormode
-                )
-                continue
+            self.process_rect(x, y, w, h, compression_mode, compressed, colormode)
+
+        self.video_pos = pos
+        self.decode_time += time.perf_counter() - start
+
+        if complete:
+            # Time spent on all prefixes of the fragment
+            self.decode_seconds.observe(self.decode_time)
+
+            chunks = self.video_chunks
+            self.video_header = None
+            self.video_chunks = None
+
+            if self.on_frame:
+                self.on_frame(chunks, resx, resy)
+
+            if self.on_fragment:
+                self.on_fragment(payload)
+
+            self.frame_number += 1
+
+    def process_rect(self, x, y, w, h, compression_mode, compressed, colormode):
+        decoder = self.decoders.get((colormode, compression_mode))
+        if decoder is None:
+            self.logger.warning(
+                "Unknown compression: %02x %02x", compression_mode, colormode
+            )
+            return
+
+        size = w * h * 2 + 4
+        scratch = self.scratch_buffer(self._scratch_pos + size)
+        start = time.perf_counter()
+        try:
+            chunk = decoder(
+                compressed, w, h, scratch[self._scratch_pos : self._scratch_pos + size]
+            )
+        except DecompressionError as exc:
+            self.logger.warning("Dropping %dx%d+%d+%d: %s", w, h, x, y, exc)
+            return
+
+        if self.trace is not None:
+            self.trace.add("decompress", start, w=w, h=h, size=len(compressed))
+
+        # Scratch space is only used up if decoder actually wrote there
+        if chunk.obj is self._scratch:
+            self._scratch_pos += size
+
+        self.compressed_bytes += len(compressed)
+        self.decoded_bytes += w * h * 2
+
+        # KVM sometimes reports rectangles partially out of framebuffer
+        resy = self.resolution[1]
+        if y + h > resy:
+            h = max(resy - y, 0)
+            chunk = chunk[: w * h * 2]
+
+        if not h:
+            return
+
+        scroll = self.detect_scroll(x, y, w, h, chunk) if self.on_copy else None
+
+        self.blit(x, y, w, h, chunk)
 
-            if self.on_chunk:
-                self.on_chunk(x, y, w, h, chunk)
+        damage = self.update_tiles(x, y, w, h)
+        if not damage:
+            self.rects_unchanged += 1
+            return
 
-            chunks.append((x, y, w, h, chunk))
+        self.generation += 1
 
-            # chunk_image = Image.frombytes('RGB', (w, h),
-            #                              rgb555_to_rgb888(chunk))
-            # self.fb.paste(chunk_image, (x, y))
+        if self.on_chunk:
+            self.on_chunk(x, y, w, h, chunk)
 
-        if self.on_frame:
-            self.on_frame(chunks, resx, resy)
+        if scroll:
+            first, rows, dy = scroll
+            copied = (x, y + first, w, rows)
+            self.scrolls_detected += 1
+            self.on_copy(*copied, x, y + first + dy)
+            damage = [piece for rect in damage for piece in subtract(rect, copied)]
 
-        self.frame_number += 1
-        # self.fb.save('/tmp/vnc/frame_%04d.png' % (self.frame_number))
+        if self.on_damage:
+            for rect in damage:
+                self.on_damage(*rect)
+
+        self.video_chunks.append((x, y, w, h, chunk))
 
     frame_number = 0
     chunk_number = 0
 
-    def decompress(self, data):
-        out = bytearray(10240000)
-        out_pos = len(out)
-
-        data = bytearray(data)
-        pos = len(data)
-
-        while pos > 0 and out_pos > 0:
-            chunk_len = (data[pos - 1] << 8) | (data[pos - 2])
-            # chunk_len, = struct.unpack('<H', data[pos-2:pos])
-
-            if chunk_len & 0x8000:
-                # fill
-                fill_data = data[pos - 4 : pos - 2]
-                chunk_len = chunk_len & 0x7FFF
-
-                out[out_pos - chunk_len * 2 : out_pos] = fill_data * chunk_len
-                out_pos -= chunk_len * 2
-                pos -= 4
-            else:
-                # copy
-                out[out_pos - chunk_len * 2 : out_pos] = data[
-                    pos - chunk_len * 2 - 2 : pos - 2
-                ]
-                out_pos -= chunk_len * 2
-                pos -= 2 + (chunk_len * 2)
+    def blit(self, x, y, w, h, chunk):
+        """
+        Writes RGB555 rectangle data into framebuffer, clipped to its bounds
+        """
+        resx, resy = self.resolution
+        stride = resx * 2
+        row = w * 2
+
+        h = min(h, resy - y, len(chunk) // row if row else 0)
+        width = min(w, resx - x) * 2
+        if h <= 0 or width <= 0:
+            return
+
+        fb = memoryview(self.fb)
+        chunk = memoryview(chunk)
+
+        if x == 0 and w == resx:
+            fb[y * stride : (y + h) * stride] = chunk[: h * row]
+            return
+
+        offset = y * stride + x * 2
+        for pos in range(0, h * row, row):
+            fb[offset : offset + width] = chunk[pos : pos + width]
+            offset += stride
+
+    def resize(self, resx, resy, fb=None):
+        """
+        Replaces framebuffer with a new one (either provided writable buffer or
+        a newly allocated one) of given resolution
+        """
+        self.fb = bytearray(resx * resy * 2) if fb is None else fb
+        self.resolution = (resx, resy)
+        self.generation += 1
+        self.tiles = array.array(
+            "q", [-1] * (-(-resx // self.tile_size) * -(-resy // self.tile_size))
+        )
 
-        if out_pos <= 0:
-            raise Exception("Buffer too small")
+    def update_tiles(self, x, y, w, h):
+        """
+        Rehashes framebuffer tiles overlapping given rectangle. Returns list of
+        areas of the rectangle within tiles whose contents changed, with
+        horizontally adjacent tiles merged.
+        """
+        resx, resy = self.resolution
+        size = self.tile_size
+        stride = resx * 2
+        columns = -(-resx // size)
+        x1 = min(x + w, resx)
+        y1 = min(y + h, resy)
+        fb = memoryview(self.fb)
+        damage = []
+
+        for ty in range(y // size, -(-y1 // size)):
+            top = ty * size
+            bottom = min(top + size, resy)
+            runs = []
+
+            for tx in range(x // size, -(-x1 // size)):
+                left = tx * size
+                right = min(left + size, resx)
+
+                crc = 0
+                for offset in range(top * stride + left * 2, bottom * stride, stride):
+                    crc = zlib.crc32(fb[offset : offset + (right - left) * 2], crc)
+
+                index = ty * columns + tx
+                self.tiles_checked += 1
+                if self.tiles[index] == crc:
+                    self.tiles_unchanged += 1
+                    continue
+
+                self.tiles[index] = crc
+                if runs and runs[-1][1] == left:
+                    runs[-1][1] = right
+                else:
+                    runs.append([left, right])
+
+            # Changed tile runs, clipped to the rectangle itself
+            top = max(top, y)
+            bottom = min(bottom, y1)
+            for left, right in runs:
+                left = max(left, x)
+                damage.append((left, top, min(right, x1) - left, bottom - top))
+
+        return damage
+
+    def detect_scroll(self, x, y, w, h, chunk):
+        """
+        Looks for rows of incoming rectangle data that are present in current
+        framebuffer (at the same columns) shifted vertically by the same
+        offset. Returns (first_row, rows, dy) of longest such run, such that
+        rectangle rows first_row..first_row + rows are equal to framebuffer
+        rows dy below, or None.
+        """
+        resx, resy = self.resolution
+        if h < self.scroll_min_rows or x + w > resx:
+            return None
+
+        stride = resx * 2
+        row = w * 2
+        fb = memoryview(self.fb)
+        chunk = memoryview(chunk)
+
+        new = [zlib.crc32(chunk[i * row : (i + 1) * row]) for i in range(h)]
+
+        # Rows shifted by more than rectangle height can't produce a long
+        # enough run anyway
+        top = max(0, y - h)
+        old = [
+            zlib.crc32(fb[offset : offset + row])
+            for offset in range(
+                top * stride + x * 2, min(resy, y + 2 * h) * stride, stride
+            )
+        ]
+        index = {}
+        for j, crc in enumerate(old, top):
+            index.setdefault(crc, []).append(j)
+
+        # Each row votes for all offsets it could have been moved by. Rows
+        # repeated many times (eg. blank lines) carry no information.
+        votes = {}
+        for i, crc in enumerate(new):
+            matches = index.get(crc, ())
+            if len(matches) > self.scroll_max_matches:
+                continue
+            for j in matches:
+                dy = j - y - i
+                if dy:
+                    votes[dy] = votes.get(dy, 0) + 1
+
+        best = None
+        for dy in sorted(votes, key=votes.get, reverse=True)[:3]:
+            if votes[dy] < self.scroll_min_rows:
+                break
+
+            # Longest run of rows matching with this offset
+            first = rows = run = 0
+            for i, crc in enumerate(new):
+                j = y + i + dy - top
+                if 0 <= j < len(old) and old[j] == crc:
+                    run += 1
+                    if run > rows:
+                        first, rows = i - run + 1, run
+                else:
+                    run = 0
+
+            if rows >= self.scroll_min_rows and (best is None or rows > best[1]):
+                best = (first, rows, dy)
+
+        if best is None:
+            return None
+
+        # Hashes may collide, so matched rows are compared as well
+        first, rows, dy = best
+        for i in range(first, first + rows):
+            offset = (y + i + dy) * stride + x * 2
+            if chunk[i * row : (i + 1) * row] != fb[offset : offset + row]:
+                return None
+
+        return best
+
+    @property
+    def stats(self):
+        return {
+            "tiles_checked": self.tiles_checked,
+            "tiles_unchanged": self.tiles_unchanged,
+            "rects_unchanged": self.rects_unchanged,
+            "scrolls_detected": self.scrolls_detected,
+            "compressed_bytes": self.compressed_bytes,
+            "decoded_bytes": self.decoded_bytes,
+            "tile_hit_rate": (
+                self.tiles_unchanged / self.tiles_checked if self.tiles_checked else 0.0
+            ),
+        }
+
+    @property
+    def framebuffer(self):
+        """
+        Read-only view of the whole RGB555 framebuffer (row-major, no
+        padding), or None if no video has been received yet
+        """
+        if self.fb is None:
+            return None
+
+        return memoryview(self.fb).toreadonly()
+
+    def read_rect(self, x, y, w, h):
+        """
+        Returns a copy of framebuffer rectangle as packed RGB555 bytes
+        """
+        resx, resy = self.resolution
+        stride = resx * 2
+        fb = memoryview(self.fb)
+
+        if x == 0 and w == resx:
+            return bytes(fb[y * stride : (y + h) * stride])
+
+        return b"".join(
+            fb[offset : offset + w * 2]
+            for offset in range(y * stride + x * 2, (y + h) * stride, stride)
+        )
 
-        return bytes(out[out_pos:])
+    def trim(self):
+        """
+        Releases buffers grown while processing large frames. Must not be
+        called from within callbacks.
+        """
+        for reader in self.readers.values():
+            reader.trim()
+
+        # Chunks of a partially processed fragment still live in scratch
+        if self.video_header is None:
+            self._scratch = bytearray()
+
+    @property
+    def bytes_received(self):
+        return sum(reader.received for reader in self.readers.values())
+
+    @property
+    def memory_usage(self):
+        """
+        Approximate size (in bytes) of framebuffer and other per-client buffers
+        """
+        return (
+            len(self.fb or b"")
+            + len(self._scratch)
+            + sum(len(reader.buffer) for reader in self.readers.values())
+            + (len(self.tiles) * self.tiles.itemsize if self.tiles else 0)
+        )
+
+    def scratch_buffer(self, size):
+        """
+        Returns a writable memoryview of at least `size` bytes backed by a
+        per-client buffer, reused across calls
+        """
+        if len(self._scratch) < size:
+            # Previous buffer may still be referenced by chunks handed out to
+            # callbacks, so it is replaced instead of resized in-place
+            self._scratch = bytearray(max(size, len(self._scratch) * 2))
+
+        return memoryview(self._scratch)
+
+    def decompress(self, data, size, out=None, unit=2):
+        """
+        Decompresses RLE encoded rectangle data into `size` bytes, into `out`
+        writable memoryview if provided, or scratch buffer otherwise. See
+        `decompress_rle`.
+        """
+        if out is None:
+            out = self.scratch_buffer(size + unit)
+
+        return decompress_rle(data, size, out, unit)
 
     def authenticate(self):
         self.logger.debug("...authenticating")
@@ -323,6 +1080,11 @@ class KVMClient:
             struct.pack("<B98s47s", 0, self.token.encode(), self.address.encode()),
         )
 
+    def set_color_mode(self, color_mode):
+        # Payload format is a guess - not verified on real hardware
+        self.logger.info("Requesting color mode %02x", color_mode)
+        self.send_frame(self.video_socket, 0x0B, struct.pack("<B", color_mode))
+
     def send_frame(self, sock, msg_type, data, status=0):
         sock.send(struct.pack("<BIH", msg_type, len(data), status) + data)
 
@@ -361,6 +1123,91 @@ class KVMClient:
         self.send_frame(self.kvm_socket, 0x04, payload)
 
 
+class AsyncKVMClient(KVMClient):
+    """
+    asyncio-native KVMClient variant - `run` is a coroutine, and all
+    callbacks are executed in event loop thread. `video_socket` and
+    `kvm_socket` are asyncio StreamWriters.
+    """
+
+    kvm_task = None
+
+    async def open_connection(self, port, ssl_context=None):
+        if os.getenv("SOCKS5_PROXY"):
+            # asyncio can't talk SOCKS on its own - connect synchronously and
+            # hand established socket over.
+            sock = await asyncio.get_event_loop().run_in_executor(
+                None, create_connection, (self.address, port)
+            )
+            sock.setblocking(False)
+            return await asyncio.open_connection(
+                sock=sock,
+                ssl=ssl_context,
+                server_hostname="" if ssl_context else None,
+            )
+
+        return await asyncio.open_connection(self.address, port, ssl=ssl_context)
+
+    async def connect(self):
+        self.ssl_context = ssl._create_unverified_context()
+        self.ssl_context.set_ciphers("DEFAULT")
+
+        self.video_reader, self.video_socket = await self.open_connection(
+            self.video_port, self.ssl_context if self.video_ssl else None
+        )
+
+        self.kvm_socket = None
+
+    def connect_kvm(self):
+        if self.kvm_task is None:
+            self.kvm_task = asyncio.ensure_future(self.run_kvm())
+
+    async def run(self):
+        await self.connect()
+
+        try:
+            await self.read_loop(self.video_reader, self.video_socket)
+        finally:
+            self.stop()
+
+    async def run_kvm(self):
+        try:
+            reader, self.kvm_socket = await self.open_connection(
+                self.kvm_port, self.ssl_context
+            )
+            await self.read_loop(reader, self.kvm_socket)
+        except (OSError, EOFError) as exc:
+            self.logger.warning("KVM connection failed: %r", exc)
+        finally:
+            # Video connection is useless without the other one
+            self.stop()
+
+    async def read_loop(self, reader, sock):
+        frames = self.readers[sock] = FrameReader()
+
+        while self.running:
+            start = time.perf_counter()
+            data = await reader.read(len(frames.writable()))
+            if not data:
+                raise OSError(errno.ECONNRESET, "%r disconnected" % sock)
+
+            frames.feed(data)
+            self.sample_trace(sock, start, len(data))
+            self.process_frames(sock, frames)
+
+    def stop(self):
+        super().stop()
+
+        if self.kvm_task:
+            self.kvm_task.cancel()
+
+    def peername(self, sock):
+        return sock.get_extra_info("peername")
+
+    def send_frame(self, sock, msg_type, data, status=0):
+        sock.write(struct.pack("<BIH", msg_type, len(data), status) + data)
+
+
 if __name__ == "__main__":
     arguments = sys.argv[1:]
 
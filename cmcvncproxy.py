@@ -5,7 +5,7 @@
 
 import os
 import mimetypes
-from http.server import HTTPStatus
+from http import HTTPStatus
 import urllib.parse
 import logging
 
@@ -14,15 +14,19 @@ import asyncio
 import jwt
 import grpc
 
-from client import KVMClient
-from vncproxy import VNCHandler
+from client import AsyncKVMClient
+import httpserver
+from metrics import http_handler
+from vncproxy import SessionHub, serve_viewer
 
 import proxy_pb2
 import proxy_pb2_grpc
 
-
 config = {
     "jwt_secret": "secret",
+    # Seconds to keep blade KVM session alive after last viewer disconnects
+    "session_linger": 60,
+    "max_viewers": 8,
 }
 
 
@@ -82,6 +86,9 @@ if __name__ == "__main__":
     HOST, PORT = "0.0.0.0", 8081
     logger = logging.getLogger("proxy")
     loop = asyncio.get_event_loop()
+    hub = SessionHub(
+        loop, linger=config["session_linger"], max_viewers=config["max_viewers"]
+    )
 
     async def handler(websocket, path):
         logger.info("Incoming conection on %s" % path)
@@ -92,20 +99,19 @@ if __name__ == "__main__":
             logger.warning("Invalid data?")
             return
 
-        stub = grpc_connect()
-        arguments = stub.GetKVMData(
-            proxy_pb2.GetKVMDataRequest(blade_num=data["blade"])
-        ).arguments
+        def client_factory():
+            stub = grpc_connect()
+            arguments = stub.GetKVMData(
+                proxy_pb2.GetKVMDataRequest(blade_num=data["blade"])
+            ).arguments
 
-        logger.debug("KVM arguments: %r", arguments)
+            logger.debug("KVM arguments: %r", arguments)
 
-        client = KVMClient.from_arguments(arguments)
+            return AsyncKVMClient.from_arguments(arguments)
 
-        handler = VNCHandler(websocket, client, loop)
-        try:
-            await handler.handle()
-        finally:
-            handler.finish()
+        # KVM arguments (and one-time token) are only requested if there's no
+        # session for this blade running already
+        await serve_viewer(websocket, hub, data["blade"], client_factory, loop)
 
     start_server = websockets.serve(
         handler,
@@ -116,4 +122,14 @@ if __name__ == "__main__":
     )
 
     loop.run_until_complete(start_server)
+
+    # Prometheus metrics, scraped from http://127.0.0.1:$METRICS_PORT/metrics -
+    # not served on public websocket port, since these aren't authenticated
+    if os.getenv("METRICS_PORT"):
+        loop.run_until_complete(
+            httpserver.start_server(
+                http_handler(hub), "127.0.0.1", int(os.getenv("METRICS_PORT"))
+            )
+        )
+
     loop.run_forever()
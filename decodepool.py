@@ -0,0 +1,354 @@
+"""
+Process pool video decoding backend. Each KVM session is pinned to a single
+worker process (so fragments of a session are always decoded in order, while
+different sessions are spread across all workers), which decodes fragments
+into a copy of session framebuffer kept in shared memory. Areas changed by a
+fragment are copied into session framebuffer once its damage is reported, so
+the framebuffer never has pixels that viewers haven't been told about yet.
+
+Fragment payloads are passed to workers through per-session shared memory
+input buffers as well - only small control messages are pickled.
+
+    pool = DecodePool(workers=8)
+    client = PooledKVMClient.from_arguments(arguments, pool=pool)
+
+Since whole fragments are decoded at once in the worker, damage callbacks are
+fired once fragment is complete, and `on_chunk`/`on_frame` are not supported.
+"""
+
+import asyncio
+import collections
+import errno
+import itertools
+import logging
+import multiprocessing
+import os
+import signal
+import struct
+import time
+from multiprocessing import shared_memory
+
+from client import AsyncKVMClient, FrameReader, KVMClient
+
+
+def worker_main(conn):
+    """
+    Worker process loop - handles requests sent by DecodePool in order
+    """
+    decoders = {}
+    memory = {}
+
+    # Ctrl-C reaches the whole process group - workers are shut down by
+    # DecodePool once parent process is done with its sessions
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+    def attach(name):
+        shm = shared_memory.SharedMemory(name=name)
+        memory[name] = shm
+        return shm
+
+    while True:
+        try:
+            request = conn.recv()
+        except EOFError:
+            break
+
+        op, sid = request[0], request[1]
+
+        if op == "open":
+            decoder = decoders[sid] = KVMClient(None, None)
+            decoder.input = None
+            if request[2]:
+                decoder.on_copy = lambda *rect: decoder.events.append(("copy", rect))
+            decoder.on_damage = lambda *rect: decoder.events.append(("damage", rect))
+
+        elif op == "resize":
+            _, _, name, resx, resy = request
+            decoders[sid].resize(resx, resy, attach(name).buf)
+
+        elif op == "input":
+            decoders[sid].input = attach(request[2]).buf
+
+        elif op == "decode":
+            decoder = decoders[sid]
+            decoder.events = []
+            try:
+                decoder.process_video(decoder.input[: request[2]])
+                conn.send(("ok", decoder.events, decoder.stats))
+            except Exception as exc:
+                conn.send(("error", repr(exc), None))
+
+        elif op == "close":
+            decoders.pop(sid, None)
+
+        elif op == "release":
+            # Session id field carries shared memory name here
+            shm = memory.pop(sid, None)
+            if shm is not None:
+                try:
+                    shm.close()
+                except BufferError:
+                    pass
+
+        elif op == "exit":
+            break
+
+
+class DecodePool(object):
+    """
+    Pool of decoding worker processes, with sessions assigned to the least
+    loaded worker
+    """
+
+    def __init__(self, workers=None, loop=None):
+        self.loop = loop or asyncio.get_event_loop()
+        self.context = multiprocessing.get_context("spawn")
+        self.workers = []
+        self.ids = itertools.count()
+        self.logger = logging.getLogger("decodepool.DecodePool")
+
+        for _ in range(workers or os.cpu_count()):
+            conn, child_conn = self.context.Pipe()
+            process = self.context.Process(
+                target=worker_main, args=(child_conn,), daemon=True
+            )
+            process.start()
+            child_conn.close()
+
+            worker = {
+                "process": process,
+                "conn": conn,
+                "pending": collections.deque(),
+                "sessions": 0,
+            }
+            self.loop.add_reader(conn.fileno(), self.on_reply, worker)
+            self.workers.append(worker)
+
+    def on_reply(self, worker):
+        conn = worker["conn"]
+        try:
+            while conn.poll():
+                reply = conn.recv()
+                future = worker["pending"].popleft()
+                if not future.done():
+                    future.set_result(reply)
+        except (EOFError, OSError) as exc:
+            self.logger.error("Worker %r died: %r", worker["process"].pid, exc)
+            self.loop.remove_reader(conn.fileno())
+            while worker["pending"]:
+                future = worker["pending"].popleft()
+                if not future.done():
+                    future.set_exception(OSError(errno.EPIPE, "Decoding worker died"))
+
+    def open(self, detect_scroll=False):
+        """
+        Assigns new session to a worker, returns (worker, session id)
+        """
+        worker = min(self.workers, key=lambda w: w["sessions"])
+        worker["sessions"] += 1
+        sid = next(self.ids)
+        self.send(worker, ("open", sid, detect_scroll))
+        return worker, sid
+
+    def close(self, worker, sid):
+        worker["sessions"] -= 1
+        self.send(worker, ("close", sid))
+
+    def send(self, worker, request):
+        worker["conn"].send(request)
+
+    def call(self, worker, request):
+        """
+        Sends request expecting a reply, returns future of it. Replies come
+        back in the same order requests were sent.
+        """
+        future = self.loop.create_future()
+        worker["pending"].append(future)
+        self.send(worker, request)
+        return future
+
+    def shutdown(self):
+        for worker in self.workers:
+            self.loop.remove_reader(worker["conn"].fileno())
+            try:
+                self.send(worker, ("exit", None))
+            except OSError:
+                pass
+            worker["process"].join(1)
+
+
+class PooledKVMClient(AsyncKVMClient):
+    """
+    AsyncKVMClient decoding video fragments in DecodePool worker, into a
+    shared memory buffer (`fb_memory`) that changed areas are copied from into
+    framebuffer (`fb`)
+    """
+
+    def __init__(self, *args, pool=None, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.pool = pool
+        self.worker = None
+        self.sid = None
+        self.fb_memory = None
+        self.input_memory = None
+        self.remote_stats = None
+
+    @property
+    def stats(self):
+        return self.remote_stats or super().stats
+
+    @property
+    def memory_usage(self):
+        return super().memory_usage + (self.fb_memory.size if self.fb_memory else 0)
+
+    def release(self, shm):
+        if shm is None:
+            return
+
+        self.pool.send(self.worker, ("release", shm.name))
+        try:
+            shm.close()
+        except BufferError:
+            # Still referenced by a view handed out earlier
+            pass
+        shm.unlink()
+
+    async def read_loop(self, reader, sock):
+        if sock is not self.video_socket:
+            return await super().read_loop(reader, sock)
+
+        if self.worker is None:
+            self.worker, self.sid = self.pool.open(self.on_copy is not None)
+
+        frames = self.readers[sock] = FrameReader()
+
+        while self.running:
+            start = time.perf_counter()
+            data = await reader.read(len(frames.writable()))
+            if not data:
+                raise OSError(errno.ECONNRESET, "%r disconnected" % sock)
+
+            frames.feed(data)
+            self.sample_trace(sock, start, len(data))
+
+            # Same span as process_frames, including the wait for workers.
+            # Traces are kept locally, since other sockets may sample their
+            # own ones while decoding is awaited.
+            start = time.perf_counter()
+            trace = self.trace
+            try:
+                # Payloads stay valid while awaiting decoding, since nothing
+                # is fed into the reader in the meantime
+                for msg_type, status, payload in frames.frames():
+                    try:
+                        if msg_type == 0x03:
+                            await self.decode_remote(payload)
+                        else:
+                            self.process_message(sock, msg_type, status, payload)
+                    except OSError:
+                        raise
+                    except:
+                        logging.exception("Oops?")
+            finally:
+                if trace is not None:
+                    trace.add("parse", start)
+
+    async def decode_remote(self, payload):
+        if len(payload) < 11:
+            self.logger.warning("Truncated video fragment")
+            return
+
+        fragnum, framesize, resx, resy, colormode = struct.unpack_from(
+            "<HIHHB", payload
+        )
+
+        if self.fb is None or (resx, resy) != self.resolution:
+            self.logger.info("Resolution: %dx%d", resx, resy)
+            old = self.fb_memory
+            self.fb_memory = shared_memory.SharedMemory(
+                create=True, size=max(resx * resy * 2, 1)
+            )
+            self.resize(resx, resy)
+            self.pool.send(
+                self.worker, ("resize", self.sid, self.fb_memory.name, resx, resy)
+            )
+            self.release(old)
+
+        if self.input_memory is None or self.input_memory.size < len(payload):
+            old = self.input_memory
+            self.input_memory = shared_memory.SharedMemory(
+                create=True, size=max(len(payload), 65536) * 2
+            )
+            self.pool.send(self.worker, ("input", self.sid, self.input_memory.name))
+            self.release(old)
+
+        self.input_memory.buf[: len(payload)] = payload
+
+        start = time.perf_counter()
+        trace = self.trace
+        status, events, stats = await self.pool.call(
+            self.worker, ("decode", self.sid, len(payload))
+        )
+        self.decode_seconds.observe(time.perf_counter() - start)
+        if trace is not None:
+            trace.add("decompress", start, size=len(payload), remote=True)
+        if status != "ok":
+            self.logger.warning("Decoding failed: %s", events)
+            return
+
+        # Session may have been stopped while waiting for the worker
+        if self.fb_memory is None:
+            return
+
+        self.remote_stats = stats
+        if events:
+            self.generation += 1
+
+        # Worker is done with the fragment, and nothing else is decoded
+        # until its damage is reported, so changes can be applied now
+        for event, rect in events:
+            self.apply(*rect[:4])
+
+        for event, rect in events:
+            if event == "damage" and self.on_damage:
+                self.on_damage(*rect)
+            elif event == "copy" and self.on_copy:
+                self.on_copy(*rect)
+
+        if self.on_fragment:
+            self.on_fragment(payload)
+
+        self.frame_number += 1
+
+    def apply(self, x, y, w, h):
+        """
+        Copies rectangle decoded by worker into framebuffer
+        """
+        resx, resy = self.resolution
+        stride = resx * 2
+        width = min(w, resx - x) * 2
+        h = min(h, resy - y)
+        if h <= 0 or width <= 0:
+            return
+
+        fb = memoryview(self.fb)
+        decoded = self.fb_memory.buf
+
+        if x == 0 and w == resx:
+            fb[y * stride : (y + h) * stride] = decoded[y * stride : (y + h) * stride]
+            return
+
+        for offset in range(y * stride + x * 2, (y + h) * stride, stride):
+            fb[offset : offset + width] = decoded[offset : offset + width]
+
+    def stop(self):
+        # Framebuffer is a private copy, so it stays readable (eg. for
+        # screenshots) after shared memory is released
+        super().stop()
+
+        if self.worker is not None:
+            self.pool.close(self.worker, self.sid)
+            self.release(self.input_memory)
+            self.release(self.fb_memory)
+            self.input_memory = self.fb_memory = None
+            self.worker = None
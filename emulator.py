@@ -0,0 +1,626 @@
+#!/usr/bin/env python3
+"""
+iDRAC/AMI KVM emulator for testing and load testing KVMClient based proxies
+without real hardware. Any number of fake BMCs can be run in a single
+process, each on its own pair of video and keyboard/mouse ports, serving one
+of the workloads:
+
+ * `static` - a single full screen update, then only keepalives
+ * `text` - text console scrolling by a line every frame
+ * `motion` - part of the screen (a quarter of it) changing every frame
+ * `replay:<path>` - video of a recorded session (see `recorder.py`), looped
+
+Video fragments of a workload are only encoded once (at startup), and shared
+by all BMCs, so emulator itself stays cheap regardless of their number.
+
+    python emulator.py --count 100 --workload text --fps 10 --config hosts.json
+    python multiproxy.py hosts.json
+
+JViewer arguments of every BMC are printed to stdout (one BMC per line), and
+multiproxy.py configuration listing all of them is written to `--config`
+file, if set. Without `--cert`/`--key`, a temporary self-signed certificate
+is generated using `openssl` command.
+"""
+
+import argparse
+import asyncio
+import itertools
+import json
+import logging
+import os
+import random
+import shlex
+import ssl
+import struct
+import subprocess
+import sys
+import tempfile
+import time
+import zlib
+
+from client import COLOR_MODE_15BIT, REV_FRAME_TYPES, FrameReader
+
+FRAGMENT_HEADER = struct.Struct("<HIHHB")
+RECT_HEADER = struct.Struct("<HHHHII")
+
+# 16-bit RLE, the only compression mode seen on real hardware
+COMPRESSION_RLE16 = 2
+
+# Statuses of ADVISER_KVM_PRIV frames
+PRIV_APPROVED = 0x0004
+PRIV_DENIED = 0x0104
+
+
+def compress_rle(data, unit=2):
+    """
+    RLE encoder producing data accepted by client.decompress_rle. Encoded
+    data of consecutive parts of a rectangle (each a multiple of `unit`
+    bytes) can be simply concatenated.
+    """
+    if len(data) % unit:
+        data = bytes(data) + bytes(unit - len(data) % unit)
+
+    out = bytearray()
+    literal = []
+
+    def flush():
+        while literal:
+            count = min(len(literal), 0x7FFF)
+            out.extend(b"".join(literal[:count]))
+            out.extend(struct.pack("<H", count))
+            del literal[:count]
+
+    units = [data[n : n + unit] for n in range(0, len(data), unit)]
+    for value, group in itertools.groupby(units):
+        run = sum(1 for _ in group)
+        if run < 3:
+            literal.extend([value] * run)
+            continue
+
+        flush()
+        while run:
+            count = min(run, 0x7FFF)
+            out.extend(value)
+            out.extend(struct.pack("<H", 0x8000 | count))
+            run -= count
+
+    flush()
+    return bytes(out)
+
+
+def fragment(resx, resy, rects, fragnum=0):
+    """
+    Builds video fragment payload out of (x, y, w, h, compressed RGB555 data)
+    rectangles, compressed with 16-bit RLE
+    """
+    body = b"".join(
+        RECT_HEADER.pack(x, y, w, h, COMPRESSION_RLE16, len(data)) + data
+        for x, y, w, h, data in rects
+    )
+    return (
+        FRAGMENT_HEADER.pack(
+            fragnum, FRAGMENT_HEADER.size + len(body), resx, resy, COLOR_MODE_15BIT
+        )
+        + body
+    )
+
+
+def rgb555(red, green, blue):
+    return struct.pack("<H", (red >> 3) << 10 | (green >> 3) << 5 | blue >> 3)
+
+
+# Glyph row bit patterns resembling strokes of a VGA font
+GLYPH_STROKES = [0x00, 0x18, 0x3C, 0x66, 0x7E, 0x60, 0x06, 0xC6, 0x6C, 0x38, 0xFE]
+
+
+def render_text(columns, lines, fg, bg, rng, fill=1.0):
+    """
+    Renders `lines` of random 8x16 glyphs (of 95 pseudo-characters), up to
+    `columns` long (`fill` limiting average line length), returns list of
+    RGB555 pixel rows
+    """
+    pixels = [
+        b"".join(fg if bits & 0x80 >> n else bg for n in range(8))
+        for bits in range(256)
+    ]
+    glyphs = [
+        [bg * 8, bg * 8]
+        + [pixels[rng.choice(GLYPH_STROKES)] for _ in range(12)]
+        + [bg * 8, bg * 8]
+        for _ in range(95)
+    ]
+    space = [bg * 8] * 16
+
+    rows = []
+    for _ in range(lines):
+        length = int(columns * fill * rng.random())
+        text = [
+            space if rng.random() < 0.15 else rng.choice(glyphs) for _ in range(length)
+        ] + [space] * (columns - length)
+        rows.extend(b"".join(glyph[row] for glyph in text) for row in range(16))
+
+    return rows
+
+
+class Workload(object):
+    """
+    Screen contents served by fake BMCs - full screen `initial` fragment sent
+    right after authentication, and `frames` - list of (delay, fragment)
+    sent in a loop afterwards
+    """
+
+    def __init__(self, resx, resy, fps):
+        self.resx = resx
+        self.resy = resy
+        self.fps = fps
+        self.initial = None
+        self.frames = []
+
+    def background(self):
+        """
+        Desktop-like background - solid color with a few windows
+        """
+        rng = random.Random(0)
+        rows = [rgb555(0, 64, 128) * self.resx for _ in range(self.resy)]
+        for _ in range(4):
+            w = rng.randint(self.resx // 8, self.resx // 2)
+            h = rng.randint(self.resy // 8, self.resy // 2)
+            x, y = rng.randint(0, self.resx - w), rng.randint(0, self.resy - h)
+            color = rgb555(*(rng.randint(128, 255) for _ in range(3)))
+            for row in range(y, y + h):
+                rows[row] = rows[row][: x * 2] + color * w + rows[row][(x + w) * 2 :]
+
+        return rows
+
+    def full_screen(self, rows):
+        return fragment(
+            self.resx,
+            self.resy,
+            [(0, 0, self.resx, self.resy, compress_rle(b"".join(rows)))],
+        )
+
+
+class StaticWorkload(Workload):
+    def __init__(self, resx, resy, fps):
+        super().__init__(resx, resy, fps)
+        self.initial = self.full_screen(self.background())
+
+
+class TextWorkload(Workload):
+    """
+    Text console (8x16 font) scrolling up by a line every frame. Each frame
+    is a single rectangle covering whole console, as sent by real hardware.
+    """
+
+    lines = 100
+
+    def __init__(self, resx, resy, fps):
+        super().__init__(resx, resy, fps)
+        rng = random.Random(0)
+        columns, rows = resx // 8, resy // 16
+
+        fg, bg = rgb555(192, 192, 192), rgb555(0, 0, 0)
+        text = render_text(columns, self.lines, fg, bg, rng)
+
+        # Compressed bands of all lines, so each frame is just a join
+        bands = [
+            compress_rle(b"".join(text[line * 16 : (line + 1) * 16]))
+            for line in range(self.lines)
+        ]
+
+        w, h = columns * 8, rows * 16
+        for n in range(self.lines):
+            data = b"".join(bands[(n + row) % self.lines] for row in range(rows))
+            self.frames.append(
+                (1.0 / fps, fragment(resx, resy, [(0, 0, w, h, data)], n))
+            )
+
+        background = [bg * resx] * resy
+        self.initial = self.full_screen(background)
+
+
+class MotionWorkload(Workload):
+    """
+    Quarter of the screen with moving, noisy content, updated every frame
+    """
+
+    cycle = 30
+
+    def __init__(self, resx, resy, fps):
+        super().__init__(resx, resy, fps)
+        rng = random.Random(0)
+        background = self.background()
+        self.initial = self.full_screen(background)
+
+        w, h = resx // 2, resy // 2
+        x, y = resx // 4, resy // 4
+        for n in range(self.cycle):
+            rows = []
+            for row in range(h):
+                color = rgb555((row * 4 + n * 8) & 0xFF, (n * 16) & 0xFF, 128)
+                # Noisy spans mixed with runs, similarly to video content
+                line = bytearray(color * w)
+                for _ in range(w // 16):
+                    offset = rng.randrange(w) * 2
+                    line[offset : offset + 2] = rng.getrandbits(15).to_bytes(
+                        2, "little"
+                    )
+                rows.append(bytes(line))
+
+            self.frames.append(
+                (
+                    1.0 / fps,
+                    fragment(
+                        resx, resy, [(x, y, w, h, compress_rle(b"".join(rows)))], n
+                    ),
+                )
+            )
+
+
+class ReplayWorkload(Workload):
+    """
+    Recorded session video, starting with its first keyframe and keeping
+    original timing (scaled by `fps`, where 1 is real-time)
+    """
+
+    def __init__(self, path, speed=1.0):
+        from recorder import REC_FRAGMENT, KEYFRAME_HEADER, Recording
+
+        recording = Recording(path)
+        if not recording.keyframes:
+            raise ValueError("Recording %s has no keyframes" % path)
+
+        records = recording.records(recording.keyframes[0][1])
+        record_type, last, payload = next(records)
+
+        resx, resy = KEYFRAME_HEADER.unpack_from(payload)
+        super().__init__(resx, resy, speed)
+        fb = zlib.decompress(payload[KEYFRAME_HEADER.size :])
+        self.initial = fragment(resx, resy, [(0, 0, resx, resy, compress_rle(fb))])
+
+        # Later keyframes carry nothing new
+        for record_type, timestamp, payload in records:
+            if record_type == REC_FRAGMENT:
+                self.frames.append(((timestamp - last) / speed, payload))
+                last = timestamp
+
+        recording.close()
+
+
+WORKLOADS = {
+    "static": StaticWorkload,
+    "text": TextWorkload,
+    "motion": MotionWorkload,
+}
+
+
+def make_workload(name, resx, resy, fps):
+    if name.startswith("replay:"):
+        return ReplayWorkload(name.partition(":")[2], fps)
+
+    return WORKLOADS[name](resx, resy, fps)
+
+
+def generate_certificate():
+    """
+    Generates temporary self-signed certificate, returns (cert, key) paths
+    """
+    directory = tempfile.mkdtemp(prefix="kvmemulator")
+    cert, key = os.path.join(directory, "cert.pem"), os.path.join(directory, "key.pem")
+    subprocess.run(
+        [
+            "openssl",
+            "req",
+            "-x509",
+            "-newkey",
+            "rsa:2048",
+            "-nodes",
+            "-days",
+            "1",
+            "-subj",
+            "/CN=localhost",
+            "-keyout",
+            key,
+            "-out",
+            cert,
+        ],
+        check=True,
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.DEVNULL,
+    )
+    return cert, key
+
+
+def send_frame(writer, msg_type, data=b"", status=0):
+    writer.write(struct.pack("<BIH", msg_type, len(data), status) + data)
+
+
+class FakeBMC(object):
+    """
+    Single emulated KVM - video port (optionally SSL) and keyboard/mouse port
+    (always SSL, as expected by KVMClient)
+    """
+
+    keepalive_interval = 5
+
+    def __init__(self, workload, ssl_context, video_ssl=True, token=None):
+        self.workload = workload
+        self.ssl_context = ssl_context
+        self.video_ssl = video_ssl
+        self.token = token
+        self.servers = []
+        self.video_port = None
+        self.kvm_port = None
+        self.kvm_writer = None
+
+        self.sessions = 0
+        self.fragments_sent = 0
+        self.bytes_sent = 0
+        self.hid_packets = 0
+        self.keepalive_sent = None
+        self.keepalive_rtt = None
+        self.logger = logging.getLogger("emulator.FakeBMC")
+
+    @property
+    def stats(self):
+        return {
+            "sessions": self.sessions,
+            "fragments_sent": self.fragments_sent,
+            "bytes_sent": self.bytes_sent,
+            "hid_packets": self.hid_packets,
+            "keepalive_rtt": self.keepalive_rtt,
+        }
+
+    def arguments(self, host):
+        """
+        JViewer arguments (as passed to KVMClient.from_arguments)
+        """
+        return [
+            host,
+            str(self.video_port),
+            self.token or "0" * 16,
+            "1" if self.video_ssl else "",
+            "0",
+            "0",
+            "0",
+            "0",
+            str(self.kvm_port),
+        ]
+
+    async def start(self, host, video_port=0, kvm_port=0):
+        video = await asyncio.start_server(
+            self.handle_video,
+            host,
+            video_port,
+            ssl=self.ssl_context if self.video_ssl else None,
+        )
+        kvm = await asyncio.start_server(
+            self.handle_kvm, host, kvm_port, ssl=self.ssl_context
+        )
+        self.servers = [video, kvm]
+        self.video_port = video.sockets[0].getsockname()[1]
+        self.kvm_port = kvm.sockets[0].getsockname()[1]
+
+    def close(self):
+        for server in self.servers:
+            server.close()
+
+    async def read_frames(self, reader, frames):
+        data = await reader.read(len(frames.writable()))
+        if not data:
+            raise ConnectionResetError("Client disconnected")
+
+        frames.feed(data)
+        return [(t, s, bytes(p)) for t, s, p in frames.frames()]
+
+    async def handle_video(self, reader, writer):
+        frames = FrameReader()
+        sender = None
+
+        try:
+            # Session approval makes client connect to keyboard/mouse port,
+            # which in turn makes it authenticate on this one
+            send_frame(writer, 0x0E)
+            await writer.drain()
+
+            while True:
+                for msg_type, status, payload in await self.read_frames(reader, frames):
+                    if msg_type == 0x0C and sender is None:
+                        token = payload[1:99].rstrip(b"\x00").decode(errors="replace")
+                        if self.token is not None and token != self.token:
+                            self.logger.warning("Invalid token %r", token)
+                            send_frame(writer, 0x10, b"", PRIV_DENIED)
+                            return
+
+                        self.sessions += 1
+                        send_frame(writer, 0x10, b"", PRIV_APPROVED)
+                        sender = asyncio.ensure_future(self.send_video(writer))
+
+                    elif msg_type == 0x0D:
+                        send_frame(writer, 0x0E)
+
+                    elif msg_type == 0x12:
+                        send_frame(writer, 0x13)
+
+                    elif msg_type == 0x13 and self.keepalive_sent is not None:
+                        self.keepalive_rtt = time.monotonic() - self.keepalive_sent
+
+                    elif msg_type == 0x10:
+                        self.logger.debug("Sharing request answered: %04x", status)
+
+                    else:
+                        self.logger.debug(
+                            "Unhandled frame %d (%r)",
+                            msg_type,
+                            REV_FRAME_TYPES.get(msg_type),
+                        )
+
+        except (ConnectionError, asyncio.IncompleteReadError, ssl.SSLError):
+            pass
+        finally:
+            if sender is not None:
+                sender.cancel()
+            writer.close()
+
+    async def send_video(self, writer):
+        workload = self.workload
+        try:
+            self.send_fragment(writer, workload.initial)
+            self.send_keepalive(writer)
+            await writer.drain()
+
+            if not workload.frames:
+                while True:
+                    await asyncio.sleep(self.keepalive_interval)
+                    self.send_keepalive(writer)
+                    await writer.drain()
+
+            # Frames are sent on schedule, unless client can't keep up
+            deadline = time.monotonic()
+            for delay, payload in itertools.cycle(workload.frames):
+                deadline += delay
+                pause = deadline - time.monotonic()
+                if pause > 0:
+                    await asyncio.sleep(pause)
+                else:
+                    deadline = time.monotonic()
+
+                self.send_fragment(writer, payload)
+                if time.monotonic() - self.keepalive_sent > self.keepalive_interval:
+                    self.send_keepalive(writer)
+                await writer.drain()
+
+        except (ConnectionError, ssl.SSLError):
+            pass
+
+    def send_keepalive(self, writer):
+        self.keepalive_sent = time.monotonic()
+        send_frame(writer, 0x12)
+
+    def send_fragment(self, writer, payload):
+        send_frame(writer, 0x03, payload)
+        self.fragments_sent += 1
+        self.bytes_sent += len(payload)
+
+    async def handle_kvm(self, reader, writer):
+        frames = FrameReader()
+        self.kvm_writer = writer
+
+        try:
+            send_frame(writer, 0x0E)
+            await writer.drain()
+
+            while True:
+                for msg_type, status, payload in await self.read_frames(reader, frames):
+                    if msg_type == 0x04:
+                        self.hid_packets += 1
+                    elif msg_type == 0x12:
+                        send_frame(writer, 0x13)
+
+        except (ConnectionError, asyncio.IncompleteReadError, ssl.SSLError):
+            pass
+        finally:
+            writer.close()
+
+
+async def report(bmcs, interval):
+    """
+    Periodically logs totals of all BMCs statistics
+    """
+    previous = 0
+    while True:
+        await asyncio.sleep(interval)
+        total = {}
+        for bmc in bmcs:
+            for key, value in bmc.stats.items():
+                if key != "keepalive_rtt":
+                    total[key] = total.get(key, 0) + value
+
+        logging.info(
+            "%d sessions, %d fragments, %.1f MB/s sent, %d HID packets",
+            total["sessions"],
+            total["fragments_sent"],
+            (total["bytes_sent"] - previous) / interval / 1e6,
+            total["hid_packets"],
+        )
+        previous = total["bytes_sent"]
+
+
+async def main(args):
+    if args.cert:
+        cert, key = args.cert, args.key or args.cert
+    else:
+        cert, key = generate_certificate()
+
+    ssl_context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+    ssl_context.load_cert_chain(cert, key)
+
+    resx, resy = map(int, args.resolution.split("x"))
+    started = time.monotonic()
+    workload = make_workload(args.workload, resx, resy, args.fps)
+    logging.info(
+        "Workload %s: %dx%d, %d frames, %d bytes, encoded in %.1fs",
+        args.workload,
+        workload.resx,
+        workload.resy,
+        len(workload.frames),
+        len(workload.initial) + sum(len(f) for _, f in workload.frames),
+        time.monotonic() - started,
+    )
+
+    bmcs = []
+    for n in range(args.count):
+        bmc = FakeBMC(workload, ssl_context, not args.no_ssl, args.token)
+        if args.base_port:
+            await bmc.start(
+                args.listen, args.base_port + n * 2, args.base_port + n * 2 + 1
+            )
+        else:
+            await bmc.start(args.listen)
+        bmcs.append(bmc)
+        print(shlex.join(bmc.arguments(args.listen)))
+
+    sys.stdout.flush()
+
+    if args.config:
+        with open(args.config, "w") as fd:
+            json.dump(
+                {
+                    "hosts": [
+                        {"name": "bmc%d" % n, "arguments": bmc.arguments(args.listen)}
+                        for n, bmc in enumerate(bmcs)
+                    ]
+                },
+                fd,
+                indent=4,
+            )
+
+    await report(bmcs, args.stats_interval)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--count", type=int, default=1, help="number of BMCs")
+    parser.add_argument("--listen", default="127.0.0.1")
+    parser.add_argument(
+        "--base-port",
+        type=int,
+        default=0,
+        help="video port of first BMC, followed by its keyboard/mouse port "
+        "and ports of other BMCs (random ports if not set)",
+    )
+    parser.add_argument(
+        "--workload", default="text", help="static, text, motion or replay:<path>"
+    )
+    parser.add_argument("--resolution", default="800x600")
+    parser.add_argument(
+        "--fps", type=float, default=10, help="frame rate (replay speed for replay)"
+    )
+    parser.add_argument("--token", help="accept only this token")
+    parser.add_argument("--no-ssl", action="store_true", help="plain video port")
+    parser.add_argument("--cert", help="PEM certificate (and key, unless --key)")
+    parser.add_argument("--key")
+    parser.add_argument("--config", help="write multiproxy.py configuration")
+    parser.add_argument("--stats-interval", type=float, default=10)
+
+    asyncio.get_event_loop().run_until_complete(main(parser.parse_args()))
@@ -0,0 +1,320 @@
+"""
+RFB rectangle encoders. Encoders take native RGB555 rectangle data (as kept
+in KVMClient framebuffer) and return a list of encoded rectangles (with
+headers), in viewer pixel format.
+
+Encoder instances are meant to be kept for the whole viewer connection -
+zlib-based encodings rely on a single persistent zlib stream per connection.
+"""
+
+import array
+import io
+import struct
+import sys
+import time
+import zlib
+
+from client import LazyModule
+from pixelformat import rgb555_to_rgb
+
+try:
+    Image = LazyModule("PIL.Image")
+except ImportError:
+    Image = None
+
+
+RAW = 0
+COPYRECT = 1
+ZLIB = 6
+TIGHT = 7
+ZRLE = 16
+
+PSEUDO_DESKTOP_SIZE = -223
+PSEUDO_QUALITY_LEVEL_0 = -32
+PSEUDO_QUALITY_LEVEL_9 = -23
+PSEUDO_COMPRESS_LEVEL_0 = -256
+PSEUDO_COMPRESS_LEVEL_9 = -247
+
+# JPEG quality for Tight quality levels 0-9
+JPEG_QUALITY = [15, 29, 41, 42, 62, 77, 79, 86, 92, 100]
+
+# Translation tables shifting every byte left by n bits
+_SHIFT_LEFT = [bytes((i << n) & 0xFF for i in range(256)) for n in range(8)]
+
+
+def rect_header(x, y, w, h, encoding):
+    return struct.pack(">HHHHi", x, y, w, h, encoding)
+
+
+def sub_rect(data, w, x, y, sw, sh):
+    """
+    Extracts (x, y, sw, sh) subrectangle from RGB555 rectangle data of width w
+    """
+    if x == 0 and sw == w:
+        return data[y * w * 2 : (y + sh) * w * 2]
+
+    return b"".join(
+        data[offset : offset + sw * 2]
+        for offset in range((y * w + x) * 2, (y + sh) * w * 2, w * 2)
+    )
+
+
+def rgb555_values(data):
+    """
+    Returns RGB555 data as array of native integers
+    """
+    pixels = array.array("H")
+    pixels.frombytes(data)
+    if sys.byteorder == "big":
+        pixels.byteswap()
+    return pixels
+
+
+def pack_indices(indices, w, h, bits):
+    """
+    Packs palette indices (1 byte each) into `bits` per index, MSB first,
+    each row padded to byte boundary
+    """
+    per_byte = 8 // bits
+    row = -(-w // per_byte) * per_byte
+    if row != w:
+        padding = bytes(row - w)
+        indices = b"".join(indices[n : n + w] + padding for n in range(0, w * h, w))
+
+    packed = 0
+    for n in range(per_byte):
+        shift = (per_byte - 1 - n) * bits
+        packed |= int.from_bytes(
+            indices[n::per_byte].translate(_SHIFT_LEFT[shift]), "big"
+        )
+
+    return packed.to_bytes(len(indices) // per_byte, "big")
+
+
+def compact_length(length):
+    """
+    Tight "compact representation" of data length
+    """
+    out = bytearray([length & 0x7F])
+    if length > 0x7F:
+        out[0] |= 0x80
+        out.append((length >> 7) & 0x7F)
+        if length > 0x3FFF:
+            out[1] |= 0x80
+            out.append((length >> 14) & 0xFF)
+
+    return bytes(out)
+
+
+class RawEncoder(object):
+    encoding = RAW
+
+    # Tracer sampled for update being encoded (see tracing.py)
+    tracer = None
+
+    # zlib stream of zlib-based encodings, and whether anything has been
+    # sent using it yet
+    stream = None
+    stream_started = False
+
+    def __init__(self, pixel_format, compress_level=None, quality_level=None):
+        self.pixel_format = pixel_format
+        self.compress_level = 6 if compress_level is None else compress_level
+        self.quality_level = quality_level
+
+    def encode(self, x, y, w, h, data):
+        return [rect_header(x, y, w, h, self.encoding) + self.convert(data)]
+
+    def convert(self, data):
+        if self.tracer is None:
+            return self.pixel_format.convert(data)
+
+        start = time.perf_counter()
+        converted = self.pixel_format.convert(data)
+        self.tracer.add("convert", start, size=len(data))
+        return converted
+
+    def compress(self, stream, data):
+        self.stream_started = True
+        return stream.compress(data) + stream.flush(zlib.Z_SYNC_FLUSH)
+
+    def set_compress_level(self, compress_level):
+        """
+        Applies compression level requested by viewer mid-connection. zlib
+        can't change level of a running stream, but every update ends with a
+        sync flush, so a new raw deflate stream can carry on from there -
+        viewer just inflates more deflate blocks.
+        """
+        compress_level = 6 if compress_level is None else compress_level
+        if compress_level == self.compress_level:
+            return
+
+        self.compress_level = compress_level
+        if self.stream is not None:
+            wbits = -zlib.MAX_WBITS if self.stream_started else zlib.MAX_WBITS
+            self.stream = zlib.compressobj(compress_level, zlib.DEFLATED, wbits)
+
+
+class ZlibEncoder(RawEncoder):
+    encoding = ZLIB
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.stream = zlib.compressobj(self.compress_level)
+
+    def encode(self, x, y, w, h, data):
+        compressed = self.compress(self.stream, self.convert(data))
+        return [
+            rect_header(x, y, w, h, self.encoding)
+            + struct.pack(">I", len(compressed))
+            + compressed
+        ]
+
+
+class ZRLEEncoder(ZlibEncoder):
+    """
+    ZRLE encoder - solid, packed palette and raw tile subencodings
+    """
+
+    encoding = ZRLE
+    tile_size = 64
+
+    def encode(self, x, y, w, h, data):
+        tiles = []
+        for ty in range(0, h, self.tile_size):
+            th = min(self.tile_size, h - ty)
+            for tx in range(0, w, self.tile_size):
+                tw = min(self.tile_size, w - tx)
+                tiles.append(
+                    self.encode_tile(sub_rect(data, w, tx, ty, tw, th), tw, th)
+                )
+
+        compressed = self.compress(self.stream, b"".join(tiles))
+        return [
+            rect_header(x, y, w, h, self.encoding)
+            + struct.pack(">I", len(compressed))
+            + compressed
+        ]
+
+    def cpixels(self, data):
+        return self.pixel_format.compact(self.convert(data))
+
+    def encode_tile(self, data, w, h):
+        pixels = rgb555_values(data)
+        colors = set(pixels)
+
+        if len(colors) == 1:
+            return b"\x01" + self.cpixels(data[:2])
+
+        if len(colors) <= 16:
+            palette = sorted(colors)
+            bits = 1 if len(palette) == 2 else 2 if len(palette) <= 4 else 4
+            index = {color: n for n, color in enumerate(palette)}
+            indices = bytes(map(index.__getitem__, pixels))
+
+            palette = array.array("H", palette)
+            if sys.byteorder == "big":
+                palette.byteswap()
+
+            return (
+                bytes([len(palette)])
+                + self.cpixels(palette.tobytes())
+                + pack_indices(indices, w, h, bits)
+            )
+
+        return b"\x00" + self.cpixels(data)
+
+
+class TightEncoder(RawEncoder):
+    """
+    Tight encoder - fill, JPEG (when Pillow is available and viewer asked for
+    it with quality level pseudo-encoding) and basic compression with copy
+    filter
+    """
+
+    encoding = TIGHT
+    max_width = 2048
+    max_pixels = 65536
+    min_jpeg_pixels = 256
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.stream = zlib.compressobj(self.compress_level)
+
+    def encode(self, x, y, w, h, data):
+        rects = []
+        sw = min(w, self.max_width)
+        sh = max(1, min(h, self.max_pixels // sw))
+
+        for sy in range(0, h, sh):
+            for sx in range(0, w, sw):
+                tw, th = min(sw, w - sx), min(sh, h - sy)
+                rects.append(
+                    rect_header(x + sx, y + sy, tw, th, self.encoding)
+                    + self.encode_rect(sub_rect(data, w, sx, sy, tw, th), tw, th)
+                )
+
+        return rects
+
+    def use_jpeg(self, w, h):
+        return (
+            Image is not None
+            and self.quality_level is not None
+            and self.pixel_format.true_color
+            and self.pixel_format.bpp in (16, 32)
+            and w * h >= self.min_jpeg_pixels
+        )
+
+    def encode_rect(self, data, w, h):
+        if data == data[:2] * (w * h):
+            # Fill compression
+            return b"\x80" + self.pixel_format.tight(data[:2])
+
+        if self.use_jpeg(w, h):
+            image = Image.frombytes("RGB", (w, h), rgb555_to_rgb(data))
+            buf = io.BytesIO()
+            image.save(buf, "JPEG", quality=JPEG_QUALITY[self.quality_level])
+            jpeg = buf.getvalue()
+            return b"\x90" + compact_length(len(jpeg)) + jpeg
+
+        # Basic compression, zlib stream 0, copy filter
+        pixels = self.pixel_format.tight(data)
+        if len(pixels) < 12:
+            return b"\x00" + pixels
+
+        compressed = self.compress(self.stream, pixels)
+        return b"\x00" + compact_length(len(compressed)) + compressed
+
+
+ENCODERS = {
+    encoder.encoding: encoder
+    for encoder in (RawEncoder, ZlibEncoder, ZRLEEncoder, TightEncoder)
+}
+
+
+def select_encoding(encodings):
+    """
+    Picks first (most preferred) supported encoding from viewer SetEncodings
+    list, falling back to raw
+    """
+    for encoding in encodings:
+        if encoding in ENCODERS:
+            return encoding
+
+    return RAW
+
+
+def select_levels(encodings):
+    """
+    Returns (compress_level, quality_level) requested by viewer using
+    pseudo-encodings, or None if not requested
+    """
+    compress_level = quality_level = None
+
+    for encoding in encodings:
+        if PSEUDO_COMPRESS_LEVEL_0 <= encoding <= PSEUDO_COMPRESS_LEVEL_9:
+            compress_level = encoding - PSEUDO_COMPRESS_LEVEL_0
+        elif PSEUDO_QUALITY_LEVEL_0 <= encoding <= PSEUDO_QUALITY_LEVEL_9:
+            quality_level = encoding - PSEUDO_QUALITY_LEVEL_0
+
+    return compress_level, quality_level
@@ -0,0 +1,119 @@
+"""
+Minimal asyncio HTTP/1.1 server for small auxiliary endpoints (screenshots,
+statistics), without pulling in a web framework.
+
+Handlers have the same signature as websockets `process_request` hooks (see
+`cmcvncproxy.py`), so these can be used with either: `handler(path, headers)`
+coroutine returns (HTTPStatus, headers dict, body bytes), or None if it
+doesn't handle the path.
+
+    server = await httpserver.start_server(chain(handler1, handler2), host, port)
+"""
+
+import asyncio
+import logging
+from http import HTTPStatus
+
+logger = logging.getLogger("httpserver")
+
+# Seconds to wait for request line and headers
+REQUEST_TIMEOUT = 10
+MAX_HEADERS = 100
+
+
+def chain(*handlers):
+    """
+    Returns a handler trying `handlers` in order, until one of them returns
+    a response
+    """
+
+    async def handler(path, headers):
+        for h in handlers:
+            response = await h(path, headers)
+            if response is not None:
+                return response
+
+        return None
+
+    return handler
+
+
+def error(status, message=None):
+    """
+    Plain text error response
+    """
+    return (
+        status,
+        {"content-type": "text/plain"},
+        ((message or status.phrase) + "\n").encode(),
+    )
+
+
+async def read_request(reader):
+    line = await reader.readline()
+    method, path, version = line.decode("latin-1").split()
+
+    headers = {}
+    for _ in range(MAX_HEADERS):
+        line = await reader.readline()
+        if line in (b"\r\n", b"\n", b""):
+            break
+
+        name, _, value = line.decode("latin-1").partition(":")
+        headers[name.strip().lower()] = value.strip()
+    else:
+        raise ValueError("Too many headers")
+
+    return method, path, headers
+
+
+async def handle_connection(reader, writer, handler):
+    """
+    Serves a single request - connections are never kept alive
+    """
+    try:
+        try:
+            method, path, headers = await asyncio.wait_for(
+                read_request(reader), REQUEST_TIMEOUT
+            )
+        except (asyncio.TimeoutError, ValueError):
+            return
+
+        if method not in ("GET", "HEAD"):
+            response = error(HTTPStatus.METHOD_NOT_ALLOWED)
+        else:
+            try:
+                response = await handler(path, headers)
+            except:
+                logging.exception("Oops?")
+                response = error(HTTPStatus.INTERNAL_SERVER_ERROR)
+
+            if response is None:
+                response = error(HTTPStatus.NOT_FOUND)
+
+        status, response_headers, body = response
+        head = ["HTTP/1.1 %d %s" % (status.value, status.phrase)]
+        head += ["%s: %s" % item for item in response_headers.items()]
+        head += ["Content-Length: %d" % len(body), "Connection: close", "", ""]
+
+        writer.write("\r\n".join(head).encode("latin-1"))
+        if method != "HEAD":
+            writer.write(body)
+        await writer.drain()
+
+    except (ConnectionError, asyncio.IncompleteReadError):
+        pass
+    finally:
+        writer.close()
+
+
+def start_server(handler, host, port):
+    """
+    Returns asyncio.start_server coroutine serving requests with `handler`
+    """
+    logger.info("HTTP server on {}:{}".format(host, port))
+    return asyncio.start_server(
+        lambda reader, writer: handle_connection(reader, writer, handler),
+        host,
+        port,
+    )
@@ -0,0 +1,252 @@
+"""
+Prometheus metrics of proxied KVM sessions.
+
+Hot paths only bump plain integer counters and fixed-bucket histograms kept
+on KVMClient, KVMSession and VNCHandler objects. These are collected into
+text exposition format only when scraped, so metrics cost next to nothing
+when nobody is looking.
+
+`http_handler` has the same signature as websockets `process_request` hooks
+(see `httpserver.py`):
+
+    process_request=chain(metrics.http_handler(hub), serve_static(...))
+"""
+
+import bisect
+import socket
+import struct
+from http import HTTPStatus
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+# Upper bounds (in seconds) of latency histogram buckets
+LATENCY_BUCKETS = (
+    0.0005,
+    0.001,
+    0.0025,
+    0.005,
+    0.01,
+    0.025,
+    0.05,
+    0.1,
+    0.25,
+    0.5,
+    1.0,
+    2.5,
+)
+
+
+class Histogram(object):
+    """
+    Prometheus style histogram - count of observations per bucket, and their
+    sum
+    """
+
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+
+    @property
+    def count(self):
+        return sum(self.counts)
+
+    def cumulative(self):
+        """
+        Yields (upper bound, number of observations up to it), ending with
+        "+Inf" bucket
+        """
+        total = 0
+        for bound, count in zip(self.buckets + ("+Inf",), self.counts):
+            total += count
+            yield bound, total
+
+
+def tcp_rtt(sock):
+    """
+    Smoothed round trip time (in seconds) of TCP connection - socket or
+    asyncio StreamWriter - or None if it's not known (TCP_INFO is Linux-only)
+    """
+    if hasattr(sock, "get_extra_info"):
+        sock = sock.get_extra_info("socket")
+
+    if sock is None or not hasattr(socket, "TCP_INFO"):
+        return None
+
+    try:
+        info = sock.getsockopt(socket.IPPROTO_TCP, socket.TCP_INFO, 104)
+    except OSError:
+        return None
+
+    # struct tcp_info - tcpi_rtt (microseconds) follows 8 bytes of flags and
+    # 15 other 32-bit fields
+    return struct.unpack_from("=I", info, 68)[0] / 1e6
+
+
+def queue_depth(session):
+    return max((len(viewer.dirty) for viewer in session.viewers), default=0)
+
+
+# (name, type, help, getter) - getter is called with KVMSession and its
+# stats dict, and returns a number, Histogram, or None if there's no value
+METRICS = [
+    (
+        "kvm_fragments_total",
+        "counter",
+        "Video fragments received from KVM",
+        lambda session, stats: session.client.frame_number,
+    ),
+    (
+        "kvm_received_bytes_total",
+        "counter",
+        "Bytes received from KVM, on all connections",
+        lambda session, stats: session.client.bytes_received,
+    ),
+    (
+        "kvm_compressed_bytes_total",
+        "counter",
+        "Compressed rectangle data received from KVM",
+        lambda session, stats: stats.get("compressed_bytes"),
+    ),
+    (
+        "kvm_decoded_bytes_total",
+        "counter",
+        "Rectangle data after decompression",
+        lambda session, stats: stats.get("decoded_bytes"),
+    ),
+    (
+        "kvm_tiles_checked_total",
+        "counter",
+        "Framebuffer tiles rehashed after decoding a rectangle",
+        lambda session, stats: stats.get("tiles_checked"),
+    ),
+    (
+        "kvm_tiles_unchanged_total",
+        "counter",
+        "Rehashed framebuffer tiles whose contents didn't change",
+        lambda session, stats: stats.get("tiles_unchanged"),
+    ),
+    (
+        "kvm_decode_seconds",
+        "histogram",
+        "Time spent decoding a video fragment",
+        lambda session, stats: session.client.decode_seconds,
+    ),
+    (
+        "kvm_keepalives_total",
+        "counter",
+        "Keepalives answered",
+        lambda session, stats: session.client.keepalives,
+    ),
+    (
+        "kvm_rtt_seconds",
+        "gauge",
+        "Smoothed TCP round trip time of KVM video connection",
+        lambda session, stats: tcp_rtt(getattr(session.client, "video_socket", None)),
+    ),
+    (
+        "kvm_memory_bytes",
+        "gauge",
+        "Approximate size of framebuffer and other session buffers",
+        lambda session, stats: stats["memory"],
+    ),
+    (
+        "vnc_viewers",
+        "gauge",
+        "Connected VNC viewers",
+        lambda session, stats: stats["viewers"],
+    ),
+    (
+        "vnc_updates_total",
+        "counter",
+        "Framebuffer updates sent to viewers",
+        lambda session, stats: session.updates_sent,
+    ),
+    (
+        "vnc_sent_bytes_total",
+        "counter",
+        "Bytes sent to viewers",
+        lambda session, stats: session.bytes_sent,
+    ),
+    (
+        "vnc_encode_seconds",
+        "histogram",
+        "Time spent encoding a framebuffer update",
+        lambda session, stats: session.encode_seconds,
+    ),
+    (
+        "vnc_update_delay_seconds",
+        "histogram",
+        "Time from framebuffer change until it was sent to viewer",
+        lambda session, stats: session.update_delay,
+    ),
+    (
+        "vnc_queue_depth",
+        "gauge",
+        "Dirty rectangles waiting to be sent, of the most lagging viewer",
+        lambda session, stats: queue_depth(session),
+    ),
+]
+
+
+def escape(value):
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def render(sessions):
+    """
+    Returns text exposition of all metrics of `sessions` ({key: KVMSession}
+    dict, as in SessionHub), labeled with session key
+    """
+    sessions = [
+        ('session="%s"' % escape(key), session, session.stats)
+        for key, session in sessions.items()
+    ]
+
+    lines = [
+        "# HELP kvm_sessions Running KVM sessions",
+        "# TYPE kvm_sessions gauge",
+        "kvm_sessions %d" % len(sessions),
+    ]
+
+    for name, metric_type, description, getter in METRICS:
+        lines.append("# HELP %s %s" % (name, description))
+        lines.append("# TYPE %s %s" % (name, metric_type))
+
+        for labels, session, stats in sessions:
+            value = getter(session, stats)
+            if value is None:
+                continue
+
+            if metric_type != "histogram":
+                lines.append("%s{%s} %r" % (name, labels, value))
+                continue
+
+            for bound, count in value.cumulative():
+                lines.append('%s_bucket{%s,le="%s"} %d' % (name, labels, bound, count))
+            lines.append("%s_sum{%s} %r" % (name, labels, value.sum))
+            lines.append("%s_count{%s} %d" % (name, labels, value.count))
+
+    return "\n".join(lines) + "\n"
+
+
+def http_handler(hub, path="/metrics"):
+    """
+    Returns httpserver handler serving metrics of all SessionHub sessions
+    """
+
+    async def handler(request_path, headers):
+        if request_path.partition("?")[0] != path:
+            return None
+
+        return (
+            HTTPStatus.OK,
+            {"content-type": CONTENT_TYPE},
+            render(hub.sessions).encode(),
+        )
+
+    return handler
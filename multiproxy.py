@@ -0,0 +1,335 @@
+#!/usr/bin/env python3
+"""
+Multi-host VNC proxy - runs KVM sessions for any number of hosts in a single
+process. Hosts are listed in a JSON configuration file:
+
+    {
+        "listen": "127.0.0.1",
+        "base_port": 5900,
+        "selector_port": 5899,
+        "max_sessions": 64,
+        "max_viewers": 4,
+        "session_linger": null,
+        "stats_interval": 60,
+        "decode_workers": 4,
+        "record_dir": "recordings",
+        "http_port": 8080,
+        "thumbnail_scale": 8,
+        "thumbnail_fps": 1,
+        "hosts": [
+            {"name": "blade1", "jnlp": "blade1.jnlp"},
+            {"name": "blade2", "arguments": ["1.2.3.4", "5901", "..."]},
+            {"name": "blade3", "jnlp": "blade3.jnlp", "port": 5999}
+        ]
+    }
+
+Every host gets its own VNC port - `base_port` + its index on the list,
+unless set explicitly. If `selector_port` is set, connections to it choose
+host by sending its name, terminated with a newline, before RFB handshake
+(useful for tunnels, eg. `(echo blade1; cat) | nc proxy 5899`).
+
+Since KVM authentication tokens are one-time use, `jnlp` files are re-read
+whenever a new session for a host is started, so these can be replaced with
+fresh ones once an old session ends.
+
+If `decode_workers` is set, video decoding runs in a pool of that many worker
+processes (see `decodepool.py`), instead of the event loop thread.
+
+If `record_dir` is set, every session is recorded into
+`<record_dir>/<host name>-<start time>.kvmrec` (see `recorder.py`).
+
+If `http_port` is set, current screen of every host can be fetched over HTTP
+from `/screenshot/<host name>.png` (or `.jpg`, with optional `?quality=`).
+Session is started if it isn't running, and kept for `session_linger`
+seconds. `/wall` page shows live thumbnails of all hosts (framebuffer
+downscaled `thumbnail_scale` times, updated at most `thumbnail_fps` times per
+second), also available from `/thumbnail/<host name>.png`. Prometheus metrics
+of all running sessions are served from `/metrics` (see `metrics.py`), and
+traces and profiles of a single session can be captured from
+`/debug/trace/<host name>` and `/debug/profile/<host name>` (see
+`tracing.py`).
+
+    python multiproxy.py hosts.json
+"""
+
+import asyncio
+import itertools
+import json
+import logging
+import os
+import signal
+import sys
+import time
+import xml.etree.ElementTree as ET
+
+import metrics
+import tracing
+from client import AsyncKVMClient
+from decodepool import DecodePool, PooledKVMClient
+from httpserver import chain, start_server
+from recorder import Recorder
+from screenshot import ScreenshotCache, http_handler
+from thumbnails import ThumbnailWall
+from vncproxy import SessionHub, SessionLimitError, WrappedSocket, serve_viewer
+
+
+def jnlp_arguments(path):
+    """
+    Returns JViewer command line arguments stored in .jnlp file
+    """
+    return [argument.text for argument in ET.parse(path).iter("argument")]
+
+
+class MultiProxy(object):
+    """
+    Routes VNC viewer connections to per-host KVM sessions kept in a single
+    SessionHub
+    """
+
+    def __init__(self, config, loop):
+        self.config = config
+        self.loop = loop
+        self.hosts = {host["name"]: host for host in config["hosts"]}
+        self.hub = SessionHub(
+            loop,
+            linger=config.get("session_linger"),
+            max_sessions=config.get("max_sessions"),
+            max_viewers=config.get("max_viewers"),
+        )
+        self.hub.on_close = self.session_closed
+        self.servers = []
+        self.recorders = {}
+        self.screenshots = {}
+        self.thumbnails = ThumbnailWall(
+            config.get("thumbnail_scale", 8), config.get("thumbnail_fps", 1)
+        )
+        self.logger = logging.getLogger("proxy.MultiProxy")
+
+        self.pool = None
+        if config.get("decode_workers"):
+            self.pool = DecodePool(config["decode_workers"], loop=loop)
+
+    def client_factory(self, name):
+        host = self.hosts[name]
+
+        def factory():
+            if "jnlp" in host:
+                arguments = jnlp_arguments(host["jnlp"])
+            else:
+                arguments = host["arguments"]
+
+            self.logger.info("Starting session for %s", name)
+            if self.pool is not None:
+                client = PooledKVMClient.from_arguments(arguments, pool=self.pool)
+            else:
+                client = AsyncKVMClient.from_arguments(arguments)
+
+            if self.config.get("record_dir"):
+                self.record(name, client)
+
+            return client
+
+        return factory
+
+    def record(self, name, client):
+        # New session for a host is only started once the previous one has
+        # ended, so its recording is complete by now
+        if name in self.recorders:
+            self.recorders.pop(name).close()
+
+        os.makedirs(self.config["record_dir"], exist_ok=True)
+        base = os.path.join(
+            self.config["record_dir"],
+            "%s-%s" % (name, time.strftime("%Y%m%d-%H%M%S")),
+        )
+
+        # Sessions restarted within the same second get numbered
+        path = base + ".kvmrec"
+        for n in itertools.count(2):
+            if not os.path.exists(path):
+                break
+            path = "%s-%d.kvmrec" % (base, n)
+
+        self.logger.info("Recording %s to %s", name, path)
+        self.recorders[name] = Recorder(path, client)
+
+    def session_closed(self, name, session):
+        recorder = self.recorders.get(name)
+        if recorder is not None and recorder.client is session.client:
+            self.recorders.pop(name).close()
+
+    async def serve(self, port, selector):
+        """
+        Starts VNC listener on `port`, with `selector` coroutine picking host
+        name for each connection (given its WrappedSocket), or None to reject
+        it
+        """
+
+        async def handle(reader, writer):
+            sock = WrappedSocket(reader, writer)
+            name = await selector(sock)
+
+            if name not in self.hosts:
+                self.logger.warning("Unknown host %r requested", name)
+                await sock.close()
+                return
+
+            await serve_viewer(
+                sock, self.hub, name, self.client_factory(name), self.loop
+            )
+
+        server = await asyncio.start_server(handle, self.config["listen"], port)
+        self.servers.append(server)
+        return server
+
+    async def start_session(self, name):
+        """
+        Returns running session of a host (starting one if needed, and
+        waiting for its video for a while), or None if it can't be started
+        """
+        if name not in self.hosts:
+            return None
+
+        # Screenshots and thumbnails aren't viewers, so viewer limit doesn't
+        # apply to sessions that are running already
+        session = self.hub.sessions.get(name)
+        if session is None:
+            try:
+                session = self.hub.get(name, self.client_factory(name))
+            except SessionLimitError as exc:
+                self.logger.warning("Can't start session for %s: %s", name, exc)
+                return None
+
+        session.start()
+        try:
+            await asyncio.wait_for(session.connected.wait(), 10)
+        except asyncio.TimeoutError:
+            pass
+
+        return session
+
+    async def screenshot_cache(self, name):
+        """
+        Returns ScreenshotCache of host session
+        """
+        session = await self.start_session(name)
+        if session is None:
+            return None
+
+        cache = self.screenshots.get(name)
+        if cache is None or cache.client is not session.client:
+            cache = self.screenshots[name] = ScreenshotCache(session.client, self.loop)
+
+        return cache
+
+    async def thumbnail(self, name):
+        session = await self.start_session(name)
+        if session is None:
+            return None
+
+        return self.thumbnails.get(session)
+
+    async def start(self):
+        base_port = self.config.get("base_port", 5900)
+
+        for index, host in enumerate(self.config["hosts"]):
+            port = host.get("port", base_port + index)
+            await self.serve(port, self.fixed_selector(host["name"]))
+            self.logger.info("%s on port %d", host["name"], port)
+
+        if self.config.get("selector_port"):
+            await self.serve(self.config["selector_port"], self.read_host_name)
+            self.logger.info("Host selector on port %d", self.config["selector_port"])
+
+        if self.config.get("http_port"):
+            self.servers.append(
+                await start_server(
+                    chain(
+                        http_handler(self.screenshot_cache),
+                        http_handler(self.thumbnail, prefix="/thumbnail/"),
+                        self.thumbnails.page_handler(
+                            lambda: [host["name"] for host in self.config["hosts"]]
+                        ),
+                        metrics.http_handler(self.hub),
+                        tracing.http_handler(self.hub),
+                    ),
+                    self.config["listen"],
+                    self.config["http_port"],
+                )
+            )
+
+    async def stop(self):
+        """
+        Stops listening, ends all sessions and shuts down decoding workers
+        """
+        for server in self.servers:
+            server.close()
+
+        sessions = list(self.hub.sessions.values())
+        for session in sessions:
+            session.close()
+
+        tasks = [session.task for session in sessions if session.task is not None]
+        if tasks:
+            await asyncio.wait(tasks, timeout=5)
+
+        if self.pool is not None:
+            self.pool.shutdown()
+
+    @staticmethod
+    def fixed_selector(name):
+        async def selector(sock):
+            return name
+
+        return selector
+
+    @staticmethod
+    async def read_host_name(sock):
+        try:
+            line = await asyncio.wait_for(sock.reader.readline(), 10)
+        except asyncio.TimeoutError:
+            return None
+
+        return line.decode(errors="replace").strip()
+
+    async def report(self, interval):
+        """
+        Periodically logs session statistics and trims idle session buffers
+        """
+        while True:
+            await asyncio.sleep(interval)
+            self.hub.trim()
+
+            stats = self.hub.stats
+            self.logger.info(
+                "%d sessions, %d viewers, %d bytes buffered",
+                stats["sessions"],
+                stats["viewers"],
+                stats["memory"],
+            )
+            for name, session in sorted(stats["per_session"].items()):
+                self.logger.debug("%s: %r", name, session)
+
+
+if __name__ == "__main__":
+    with open(sys.argv[1]) as fd:
+        config = json.load(fd)
+
+    config.setdefault("listen", "127.0.0.1")
+
+    loop = asyncio.get_event_loop()
+    proxy = MultiProxy(config, loop)
+    loop.run_until_complete(proxy.start())
+
+    if config.get("stats_interval"):
+        asyncio.ensure_future(proxy.report(config["stats_interval"]))
+
+    # Sessions are ended cleanly on exit, so that decoding workers' shared
+    # memory is released and recordings are complete
+    for signum in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(signum, loop.stop)
+
+    try:
+        loop.run_forever()
+    finally:
+        loop.run_until_complete(proxy.stop())
@@ -0,0 +1,254 @@
+"""
+RFB pixel format handling
+"""
+
+import array
+import struct
+import sys
+
+from client import rgb555_to_rgb888, numpy
+
+# Converters are shared between all viewers using the same pixel format
+_CONVERTERS = {}
+
+
+def rgb555_to_rgb(data):
+    """
+    Converts RGB555 data into packed 24-bit (R, G, B) pixels
+    """
+    # rgb555_to_rgb888 output is blue, green, red, padding
+    pixels = rgb555_to_rgb888(data)
+    out = bytearray(len(pixels) // 4 * 3)
+    out[0::3] = pixels[2::4]
+    out[1::3] = pixels[1::4]
+    out[2::3] = pixels[0::4]
+    return bytes(out)
+
+
+class PixelFormat(object):
+    """
+    RFB PIXEL_FORMAT structure, along with conversion from native RGB555
+    framebuffer data.
+    """
+
+    fmt = struct.Struct(">BBBBHHHBBBxxx")
+
+    def __init__(
+        self,
+        bpp,
+        depth,
+        big_endian,
+        true_color,
+        red_max,
+        green_max,
+        blue_max,
+        red_shift,
+        green_shift,
+        blue_shift,
+    ):
+        self.bpp = bpp
+        self.depth = depth
+        self.big_endian = bool(big_endian)
+        self.true_color = bool(true_color)
+        self.red_max = red_max
+        self.green_max = green_max
+        self.blue_max = blue_max
+        self.red_shift = red_shift
+        self.green_shift = green_shift
+        self.blue_shift = blue_shift
+        self._converter = None
+
+    def __repr__(self):
+        return "<PixelFormat %dbpp depth %d %s rgb max %d/%d/%d shift %d/%d/%d>" % (
+            self.bpp,
+            self.depth,
+            "BE" if self.big_endian else "LE",
+            self.red_max,
+            self.green_max,
+            self.blue_max,
+            self.red_shift,
+            self.green_shift,
+            self.blue_shift,
+        )
+
+    def pack(self):
+        return self.fmt.pack(
+            self.bpp,
+            self.depth,
+            self.big_endian,
+            self.true_color,
+            self.red_max,
+            self.green_max,
+            self.blue_max,
+            self.red_shift,
+            self.green_shift,
+            self.blue_shift,
+        )
+
+    @property
+    def bytes_per_pixel(self):
+        return self.bpp // 8
+
+    def __eq__(self, other):
+        return isinstance(other, PixelFormat) and self.pack() == other.pack()
+
+    def __hash__(self):
+        return hash(self.pack())
+
+    @property
+    def native(self):
+        """
+        True if pixel format is the same as KVM RGB555 framebuffer
+        """
+        return self == NATIVE_PIXEL_FORMAT
+
+    def convert(self, data):
+        """
+        Converts native RGB555 data into this pixel format
+        """
+        if self._converter is None:
+            key = self.pack()
+            if key not in _CONVERTERS:
+                _CONVERTERS[key] = self.make_converter()
+            self._converter = _CONVERTERS[key]
+
+        return self._converter(data)
+
+    def make_converter(self):
+        if not self.true_color:
+            raise ValueError("Color map pixel formats are not supported")
+
+        if self.native:
+            return bytes
+
+        if self.bpp == 32 and (self.red_max, self.green_max, self.blue_max) == (
+            255,
+            255,
+            255,
+        ):
+            shifts = (self.blue_shift, self.green_shift, self.red_shift)
+            if len(set(shifts)) == 3 and all(s in (0, 8, 16, 24) for s in shifts):
+                return self.make_byte_converter(shifts)
+
+        return self.make_table_converter()
+
+    def make_byte_converter(self, shifts):
+        """
+        32bpp formats with 8-bit channels - rgb555_to_rgb888 output with
+        bytes shuffled around
+        """
+        # Source byte order is blue, green, red, padding
+        layout = [
+            (3 - shift // 8 if self.big_endian else shift // 8, source)
+            for source, shift in enumerate(shifts)
+        ]
+        if layout == [(0, 0), (1, 1), (2, 2)]:
+            return rgb555_to_rgb888
+
+        def convert(data):
+            pixels = rgb555_to_rgb888(data)
+            out = bytearray(len(pixels))
+            for target, source in layout:
+                out[target::4] = pixels[source::4]
+            return bytes(out)
+
+        return convert
+
+    def make_table_converter(self):
+        """
+        Generic converter, using lookup table for all 2**15 RGB555 colors
+        """
+        order = "big" if self.big_endian else "little"
+        table = [
+            (
+                ((value >> 10) & 0x1F) * self.red_max // 31 << self.red_shift
+                | ((value >> 5) & 0x1F) * self.green_max // 31 << self.green_shift
+                | (value & 0x1F) * self.blue_max // 31 << self.blue_shift
+            ).to_bytes(self.bytes_per_pixel, order)
+            for value in range(1 << 16)
+        ]
+
+        if numpy is not None:
+            lookup = numpy.frombuffer(b"".join(table), dtype=numpy.uint8).reshape(
+                (1 << 16, self.bytes_per_pixel)
+            )
+
+            def convert(data):
+                pixels = numpy.frombuffer(data, dtype="<u2", count=len(data) // 2)
+                return lookup[pixels].tobytes()
+
+        else:
+
+            def convert(data):
+                pixels = array.array("H")
+                pixels.frombytes(data[: len(data) & ~1])
+                if sys.byteorder == "big":
+                    pixels.byteswap()
+                return b"".join(map(table.__getitem__, pixels))
+
+        return convert
+
+    @property
+    def unused_byte(self):
+        """
+        Index of a byte (in memory order) of 32bpp pixel that carries no color
+        bits, or None
+        """
+        if not self.true_color or self.bpp != 32 or self.depth > 24:
+            return None
+
+        used = 0
+        for shift, maximum in (
+            (self.red_shift, self.red_max),
+            (self.green_shift, self.green_max),
+            (self.blue_shift, self.blue_max),
+        ):
+            used |= maximum << shift
+
+        if used < 1 << 24:
+            return 0 if self.big_endian else 3
+        if not used & 0xFF:
+            return 3 if self.big_endian else 0
+
+        return None
+
+    def compact(self, pixels):
+        """
+        Converts pixels in this format to ZRLE CPIXELs - 32bpp pixels with
+        unused byte dropped, when possible
+        """
+        unused = self.unused_byte
+        if unused is None:
+            return pixels
+
+        out = bytearray(len(pixels) // 4 * 3)
+        for n, byte in enumerate(b for b in range(4) if b != unused):
+            out[n::3] = pixels[byte::4]
+
+        return bytes(out)
+
+    @property
+    def rgb24(self):
+        """
+        True if pixel format is plain 24-bit color, in which case Tight TPIXEL
+        is sent as 3 (R, G, B) bytes
+        """
+        return (
+            self.true_color
+            and self.bpp == 32
+            and self.depth == 24
+            and (self.red_max, self.green_max, self.blue_max) == (255, 255, 255)
+        )
+
+    def tight(self, data):
+        """
+        Converts native RGB555 data into Tight TPIXELs
+        """
+        if not self.rgb24:
+            return self.convert(data)
+
+        return rgb555_to_rgb(data)
+
+
+DEFAULT_PIXEL_FORMAT = PixelFormat(32, 24, False, True, 255, 255, 255, 16, 8, 0)
+NATIVE_PIXEL_FORMAT = PixelFormat(16, 15, False, True, 31, 31, 31, 10, 5, 0)
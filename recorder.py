@@ -0,0 +1,372 @@
+#!/usr/bin/env python3
+"""
+KVM session recording and replay.
+
+Recordings keep raw (still compressed) video fragments, exactly as received
+from KVM, so recording a session costs little more than writing its traffic
+to disk. Recording file is a magic string followed by records:
+
+    struct record {
+        uint8_t type;       // REC_FRAGMENT or REC_KEYFRAME
+        double timestamp;   // UNIX time
+        uint32_t length;
+        uint8_t payload[length];
+    };
+
+Fragment payload is a video fragment (as passed to `process_video`). Keyframe
+payload is resolution (2 x uint16) followed by zlib-compressed RGB555
+framebuffer, and is written periodically (and on every resolution change),
+so replay can start at any moment by seeking to the nearest preceding
+keyframe instead of decoding everything from the start. Offsets of keyframes
+are kept in `<recording>.idx` file (rebuilt by scanning the recording if
+missing). Records are only ever appended, so a recording cut short (eg. by a
+crash) is still usable, up to its last complete record.
+
+    python recorder.py record session.kvmrec <jviewer arguments>
+    python recorder.py replay session.kvmrec [--speed 4] [--start 120]
+    python recorder.py info session.kvmrec
+
+Both `record` and `replay` serve the session over VNC on 127.0.0.1:5900.
+"""
+
+import argparse
+import asyncio
+import bisect
+import logging
+import os
+import struct
+import time
+import zlib
+
+from client import AsyncKVMClient, KVMClient
+from vncproxy import SessionHub, WrappedSocket, serve_viewer
+
+MAGIC = b"KVMREC1\n"
+
+REC_FRAGMENT = 1
+REC_KEYFRAME = 2
+
+RECORD_HEADER = struct.Struct("<BdI")
+INDEX_ENTRY = struct.Struct("<dQ")
+KEYFRAME_HEADER = struct.Struct("<HH")
+
+
+class Recorder(object):
+    """
+    Appends video fragments received by `client` (any KVMClient, using its
+    `on_fragment` callback) to a recording file, along with a keyframe every
+    `keyframe_interval` seconds. Existing recordings are never overwritten -
+    FileExistsError is raised instead.
+    """
+
+    def __init__(self, path, client, keyframe_interval=60):
+        self.path = path
+        self.client = client
+        self.keyframe_interval = keyframe_interval
+        self.keyframe_time = None
+        self.keyframe_resolution = None
+        self.fragments = 0
+        self.keyframes = 0
+        self.logger = logging.getLogger("recorder.Recorder")
+
+        self.fd = open(path, "xb")
+        self.fd.write(MAGIC)
+
+        # Index without its recording is a leftover, and can be replaced
+        self.index = open(path + ".idx", "wb")
+
+        client.on_fragment = self.on_fragment
+
+        # Session may be recorded from the middle
+        if client.fb is not None:
+            self.write_keyframe(time.time())
+
+    @property
+    def stats(self):
+        return {
+            "fragments": self.fragments,
+            "keyframes": self.keyframes,
+            "bytes": self.fd.tell() if not self.fd.closed else None,
+        }
+
+    def on_fragment(self, payload):
+        if self.fd.closed:
+            return
+
+        now = time.time()
+        self.write(REC_FRAGMENT, now, payload)
+        self.fragments += 1
+
+        if (
+            self.keyframe_resolution != self.client.resolution
+            or now - self.keyframe_time >= self.keyframe_interval
+        ):
+            self.write_keyframe(now)
+
+    def write_keyframe(self, timestamp):
+        resx, resy = self.client.resolution
+        offset = self.fd.tell()
+        self.write(
+            REC_KEYFRAME,
+            timestamp,
+            KEYFRAME_HEADER.pack(resx, resy)
+            + zlib.compress(self.client.framebuffer, 1),
+        )
+
+        self.index.write(INDEX_ENTRY.pack(timestamp, offset))
+        self.index.flush()
+
+        self.keyframe_time = timestamp
+        self.keyframe_resolution = (resx, resy)
+        self.keyframes += 1
+
+    def write(self, record_type, timestamp, payload):
+        self.fd.write(RECORD_HEADER.pack(record_type, timestamp, len(payload)))
+        self.fd.write(payload)
+        self.fd.flush()
+
+    def close(self):
+        if self.client.on_fragment == self.on_fragment:
+            self.client.on_fragment = None
+
+        stats = self.stats
+        self.fd.close()
+        self.index.close()
+        self.logger.info("Closed %s: %r", self.path, stats)
+
+
+class Recording(object):
+    """
+    Read access to a recording file
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.fd = open(path, "rb")
+
+        if self.fd.read(len(MAGIC)) != MAGIC:
+            raise ValueError("%s is not a KVM recording" % path)
+
+        self.size = os.fstat(self.fd.fileno()).st_size
+        self.keyframes = self.load_index()
+        self.start = next((ts for _, ts, _, _ in self.headers()), None)
+
+    def headers(self, offset=len(MAGIC)):
+        """
+        Yields (offset, timestamp, type, length) of every complete record,
+        starting at `offset`
+        """
+        while offset + RECORD_HEADER.size <= self.size:
+            self.fd.seek(offset)
+            record_type, timestamp, length = RECORD_HEADER.unpack(
+                self.fd.read(RECORD_HEADER.size)
+            )
+            if offset + RECORD_HEADER.size + length > self.size:
+                break
+
+            yield offset, timestamp, record_type, length
+            offset += RECORD_HEADER.size + length
+
+    def complete(self, offset):
+        """
+        True if record at `offset` has been fully written
+        """
+        for record_offset, _, _, length in self.headers(offset):
+            return True
+
+        return False
+
+    def records(self, offset=len(MAGIC)):
+        """
+        Yields (type, timestamp, payload) of every complete record, starting
+        at `offset`
+        """
+        for offset, timestamp, record_type, length in self.headers(offset):
+            self.fd.seek(offset + RECORD_HEADER.size)
+            yield record_type, timestamp, self.fd.read(length)
+
+    def load_index(self):
+        """
+        Returns list of (timestamp, offset) of all keyframes, from the index
+        file if it's there, or by scanning the whole recording
+        """
+        keyframes = []
+        try:
+            with open(self.path + ".idx", "rb") as fd:
+                data = fd.read()
+            for timestamp, offset in INDEX_ENTRY.iter_unpack(
+                data[: len(data) - len(data) % INDEX_ENTRY.size]
+            ):
+                if self.complete(offset):
+                    keyframes.append((timestamp, offset))
+            return keyframes
+        except FileNotFoundError:
+            pass
+
+        logging.info("No index for %s, scanning", self.path)
+        return [
+            (timestamp, offset)
+            for offset, timestamp, record_type, _ in self.headers()
+            if record_type == REC_KEYFRAME
+        ]
+
+    def seek(self, timestamp):
+        """
+        Returns offset of the last keyframe at or before `timestamp` - or of
+        the first record if there's none
+        """
+        n = bisect.bisect_right(self.keyframes, (timestamp, self.size))
+        if n == 0:
+            return len(MAGIC)
+
+        return self.keyframes[n - 1][1]
+
+    def close(self):
+        self.fd.close()
+
+
+class ReplayClient(KVMClient):
+    """
+    KVMClient replaying a recording instead of connecting to KVM, for use with
+    KVMSession/VNCHandler. `run` coroutine plays the recording back `speed`
+    times faster than real-time, starting `start` seconds into it (anything
+    before that is applied without delay), and keeps the last screen until
+    stopped. Keyboard input is ignored.
+    """
+
+    def __init__(self, recording, speed=1.0, start=0.0):
+        super().__init__(None, None)
+        self.recording = recording
+        self.speed = speed
+        self.start = start
+        self.position = None
+        self.stopped = asyncio.Event()
+        self.logger = logging.getLogger("recorder.ReplayClient")
+
+    async def run(self):
+        if self.recording.start is None:
+            self.logger.warning("Empty recording")
+            await self.stopped.wait()
+            return
+
+        target = self.recording.start + self.start
+        offset = self.recording.seek(target)
+        clock = None
+
+        for record_type, timestamp, payload in self.recording.records(offset):
+            if not self.running:
+                return
+
+            if timestamp > target:
+                if clock is None:
+                    clock = time.monotonic()
+
+                delay = clock + (timestamp - target) / self.speed - time.monotonic()
+                if delay > 0:
+                    await asyncio.sleep(delay)
+                if not self.running:
+                    return
+
+            self.position = timestamp - self.recording.start
+
+            if record_type == REC_FRAGMENT:
+                self.process_video(payload)
+            elif record_type == REC_KEYFRAME and self.fb is None:
+                # Later keyframes match what fragments have produced already
+                self.apply_keyframe(payload)
+
+        self.logger.info("Replay finished at %.1fs", self.position or 0)
+        await self.stopped.wait()
+
+    def apply_keyframe(self, payload):
+        resx, resy = KEYFRAME_HEADER.unpack_from(payload)
+        self.resize(resx, resy)
+        self.fb[:] = zlib.decompress(payload[KEYFRAME_HEADER.size :])
+
+        if self.on_damage:
+            self.on_damage(0, 0, resx, resy)
+
+    def stop(self):
+        self.running = False
+        self.stopped.set()
+
+    def send_keyboard(self, keycode, modifiers, down):
+        pass
+
+
+def info(path):
+    recording = Recording(path)
+    counts = {REC_FRAGMENT: 0, REC_KEYFRAME: 0}
+    sizes = {REC_FRAGMENT: 0, REC_KEYFRAME: 0}
+    end = None
+
+    for _, timestamp, record_type, length in recording.headers():
+        counts[record_type] = counts.get(record_type, 0) + 1
+        sizes[record_type] = sizes.get(record_type, 0) + length
+        end = timestamp
+
+    print("Duration:  %.1fs" % ((end - recording.start) if end else 0))
+    print("Fragments: %d (%d bytes)" % (counts[REC_FRAGMENT], sizes[REC_FRAGMENT]))
+    print("Keyframes: %d (%d bytes)" % (counts[REC_KEYFRAME], sizes[REC_KEYFRAME]))
+    print("Indexed:   %d" % len(recording.keyframes))
+
+
+def serve(client_factory, port=5900, host="127.0.0.1"):
+    """
+    Serves a single session over VNC, returns it once it has ended
+    """
+    loop = asyncio.get_event_loop()
+    hub = SessionHub(loop, linger=None)
+
+    async def handle_vnc(reader, writer):
+        await serve_viewer(
+            WrappedSocket(reader, writer), hub, "session", client_factory, loop
+        )
+
+    loop.run_until_complete(asyncio.start_server(handle_vnc, host, port))
+    logging.info("Listening on {}:{}".format(host, port))
+
+    # Session is started right away, without waiting for a viewer
+    session = hub.get("session", client_factory)
+    session.start()
+    loop.run_until_complete(session.task)
+    return session
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    record = commands.add_parser("record", help="record a KVM session")
+    record.add_argument("path")
+    record.add_argument("arguments", nargs="+", help="JViewer arguments")
+    record.add_argument("--keyframe-interval", type=float, default=60)
+    record.add_argument("--port", type=int, default=5900)
+
+    replay = commands.add_parser("replay", help="serve a recording over VNC")
+    replay.add_argument("path")
+    replay.add_argument("--speed", type=float, default=1.0)
+    replay.add_argument("--start", type=float, default=0.0, help="seconds")
+    replay.add_argument("--port", type=int, default=5900)
+
+    commands.add_parser("info", help="print recording summary").add_argument("path")
+
+    args = parser.parse_args()
+
+    if args.command == "info":
+        info(args.path)
+
+    elif args.command == "record":
+        if os.path.exists(args.path):
+            parser.error("%s already exists" % args.path)
+
+        client = AsyncKVMClient.from_arguments(args.arguments)
+        recorder = Recorder(args.path, client, args.keyframe_interval)
+        try:
+            serve(lambda: client, args.port)
+        finally:
+            recorder.close()
+
+    elif args.command == "replay":
+        recording = Recording(args.path)
+        serve(lambda: ReplayClient(recording, args.speed, args.start), args.port)
@@ -0,0 +1,137 @@
+"""
+Minimal rectangle-set arithmetic used for VNC damage tracking. Rectangles are
+(x, y, w, h) tuples.
+"""
+
+
+def intersect(a, b):
+    """
+    Returns intersection of two rectangles, or None
+    """
+    x0 = max(a[0], b[0])
+    y0 = max(a[1], b[1])
+    x1 = min(a[0] + a[2], b[0] + b[2])
+    y1 = min(a[1] + a[3], b[1] + b[3])
+
+    if x1 <= x0 or y1 <= y0:
+        return None
+
+    return (x0, y0, x1 - x0, y1 - y0)
+
+
+def subtract(a, b):
+    """
+    Returns list of (up to 4) non-overlapping rectangles covering `a` minus `b`
+    """
+    i = intersect(a, b)
+    if i is None:
+        return [a]
+
+    ax, ay, aw, ah = a
+    ix, iy, iw, ih = i
+    out = []
+
+    if iy > ay:
+        out.append((ax, ay, aw, iy - ay))
+    if iy + ih < ay + ah:
+        out.append((ax, iy + ih, aw, ay + ah - iy - ih))
+    if ix > ax:
+        out.append((ax, iy, ix - ax, ih))
+    if ix + iw < ax + aw:
+        out.append((ix + iw, iy, ax + aw - ix - iw, ih))
+
+    return out
+
+
+def bounds(rects):
+    """
+    Returns bounding box of all rectangles
+    """
+    x0 = min(r[0] for r in rects)
+    y0 = min(r[1] for r in rects)
+    x1 = max(r[0] + r[2] for r in rects)
+    y1 = max(r[1] + r[3] for r in rects)
+    return (x0, y0, x1 - x0, y1 - y0)
+
+
+class Region(object):
+    """
+    Set of non-overlapping rectangles. Rectangles sharing a whole edge are
+    merged, and the region collapses to its bounding box once it grows past
+    `max_rects` rectangles.
+
+    `superseded` counts added rectangles which overlapped area that was
+    already in the region.
+    """
+
+    max_rects = 64
+
+    def __init__(self):
+        self.rects = []
+        self.superseded = 0
+
+    def __bool__(self):
+        return bool(self.rects)
+
+    def __len__(self):
+        return len(self.rects)
+
+    def __iter__(self):
+        return iter(self.rects)
+
+    def clear(self):
+        self.rects = []
+
+    def add(self, x, y, w, h):
+        if w <= 0 or h <= 0:
+            return
+
+        pieces = [(x, y, w, h)]
+        for rect in self.rects:
+            pieces = [p for piece in pieces for p in subtract(piece, rect)]
+            if not pieces:
+                break
+
+        if pieces != [(x, y, w, h)]:
+            self.superseded += 1
+
+        for piece in pieces:
+            self.merge(piece)
+
+        if len(self.rects) > self.max_rects:
+            self.rects = [bounds(self.rects)]
+
+    def merge(self, rect):
+        x, y, w, h = rect
+
+        for n, (rx, ry, rw, rh) in enumerate(self.rects):
+            if (rx, rw) == (x, w) and (ry + rh == y or y + h == ry):
+                merged = (x, min(y, ry), w, h + rh)
+            elif (ry, rh) == (y, h) and (rx + rw == x or x + w == rx):
+                merged = (min(x, rx), y, w + rw, h)
+            else:
+                continue
+
+            del self.rects[n]
+            return self.merge(merged)
+
+        self.rects.append(rect)
+
+    def take(self, x, y, w, h):
+        """
+        Removes and returns parts of the region within given area
+        """
+        area = (x, y, w, h)
+        taken = []
+        rest = []
+
+        for rect in self.rects:
+            i = intersect(rect, area)
+            if i is None:
+                rest.append(rect)
+            else:
+                taken.append(i)
+                rest.extend(subtract(rect, area))
+
+        self.rects = rest
+        return taken
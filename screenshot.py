@@ -0,0 +1,233 @@
+#!/usr/bin/env python3
+"""
+KVM framebuffer screenshots - PNG (built-in encoder) or JPEG (requires
+Pillow). Encoded images are cached until framebuffer changes, so polling a
+static screen doesn't cost any encoding, and are served with ETags, so it
+doesn't cost any transfer either.
+
+    python screenshot.py screen.png <jviewer arguments>
+"""
+
+import asyncio
+import io
+import logging
+import struct
+import sys
+import urllib.parse
+import zlib
+from http import HTTPStatus
+
+from client import AsyncKVMClient, LazyModule
+from httpserver import error
+from pixelformat import rgb555_to_rgb
+
+try:
+    Image = LazyModule("PIL.Image")
+except ImportError:
+    Image = None
+
+
+CONTENT_TYPES = {"png": "image/png", "jpg": "image/jpeg", "jpeg": "image/jpeg"}
+
+
+def png_chunk(chunk_type, data):
+    return (
+        struct.pack(">I", len(data))
+        + chunk_type
+        + data
+        + struct.pack(">I", zlib.crc32(chunk_type + data))
+    )
+
+
+def encode_png(data, w, h, compress_level=6):
+    """
+    Encodes RGB555 data as 8-bit RGB PNG image
+    """
+    pixels = rgb555_to_rgb(data)
+    stride = w * 3
+
+    # Every row is prefixed with filter type - none
+    rows = bytearray((stride + 1) * h)
+    for y in range(h):
+        rows[y * (stride + 1) + 1 : (y + 1) * (stride + 1)] = pixels[
+            y * stride : (y + 1) * stride
+        ]
+
+    return (
+        b"\x89PNG\r\n\x1a\n"
+        + png_chunk(b"IHDR", struct.pack(">IIBBBBB", w, h, 8, 2, 0, 0, 0))
+        + png_chunk(b"IDAT", zlib.compress(rows, compress_level))
+        + png_chunk(b"IEND", b"")
+    )
+
+
+def encode_jpeg(data, w, h, quality=75):
+    """
+    Encodes RGB555 data as JPEG image
+    """
+    if Image is None:
+        raise ValueError("JPEG screenshots require Pillow")
+
+    image = Image.frombytes("RGB", (w, h), rgb555_to_rgb(data))
+    buf = io.BytesIO()
+    image.save(buf, "JPEG", quality=quality)
+    return buf.getvalue()
+
+
+def encode(data, w, h, image_format="png", quality=None):
+    if image_format == "png":
+        return encode_png(data, w, h)
+
+    if image_format in ("jpg", "jpeg"):
+        return encode_jpeg(data, w, h, 75 if quality is None else quality)
+
+    raise ValueError("Unsupported image format %r" % image_format)
+
+
+class ScreenshotCache(object):
+    """
+    Screenshots of `client` framebuffer, encoded (in executor thread) when
+    first requested after framebuffer has changed
+    """
+
+    def __init__(self, client, loop=None):
+        self.client = client
+        self.loop = loop or asyncio.get_event_loop()
+        self.cache = {}
+        self.hits = 0
+        self.misses = 0
+
+    @property
+    def stats(self):
+        return {"hits": self.hits, "misses": self.misses}
+
+    async def get(self, image_format="png", quality=None):
+        """
+        Returns (framebuffer generation, encoded image), or None if no video
+        has been received yet
+        """
+        if self.client.fb is None:
+            return None
+
+        key = (image_format, quality)
+        generation = self.client.generation
+        cached = self.cache.get(key)
+
+        # Concurrent requests for the same screen all wait for a single
+        # encoding
+        if cached is not None and cached[0] == generation:
+            self.hits += 1
+            return generation, await cached[1]
+
+        self.misses += 1
+        resx, resy = self.client.resolution
+        future = self.loop.run_in_executor(
+            None,
+            encode,
+            self.client.read_rect(0, 0, resx, resy),
+            resx,
+            resy,
+            image_format,
+            quality,
+        )
+        self.cache[key] = (generation, future)
+
+        try:
+            return generation, await future
+        except:
+            if self.cache.get(key, (None, None))[1] is future:
+                del self.cache[key]
+            raise
+
+
+def http_handler(lookup, prefix="/screenshot/"):
+    """
+    Returns httpserver handler serving `<prefix><name>.<png|jpg>` screenshots,
+    with JPEG quality set by optional `quality` query parameter. `lookup`
+    coroutine returns ScreenshotCache for a name, or None if there's no such
+    session.
+    """
+
+    async def handler(path, headers):
+        url = urllib.parse.urlparse(path)
+        if not url.path.startswith(prefix):
+            return None
+
+        name, _, image_format = url.path[len(prefix) :].rpartition(".")
+        if image_format not in CONTENT_TYPES:
+            return error(HTTPStatus.NOT_FOUND)
+
+        query = urllib.parse.parse_qs(url.query)
+        try:
+            quality = int(query["quality"][0]) if "quality" in query else None
+        except ValueError:
+            return error(HTTPStatus.BAD_REQUEST, "Invalid quality")
+
+        if image_format == "png":
+            quality = None
+        elif Image is None:
+            return error(HTTPStatus.NOT_IMPLEMENTED, "JPEG requires Pillow")
+
+        cache = await lookup(urllib.parse.unquote(name))
+        if cache is None:
+            return error(HTTPStatus.NOT_FOUND, "No such session")
+
+        screenshot = await cache.get(image_format, quality)
+        if screenshot is None:
+            return error(HTTPStatus.SERVICE_UNAVAILABLE, "No video received yet")
+
+        generation, image = screenshot
+        etag = '"%x-%d"' % (id(cache.client), generation)
+        response_headers = {"cache-control": "no-cache", "etag": etag}
+
+        if headers.get("if-none-match") == etag:
+            return HTTPStatus.NOT_MODIFIED, response_headers, b""
+
+        response_headers["content-type"] = CONTENT_TYPES[image_format]
+        return HTTPStatus.OK, response_headers, image
+
+    return handler
+
+
+async def take_screenshot(client, timeout=30):
+    """
+    Runs `client` until first video fragment is received, then returns its
+    framebuffer
+    """
+    received = asyncio.Event()
+    client.on_fragment = lambda payload: received.set()
+    task = asyncio.ensure_future(client.run())
+    waiter = asyncio.ensure_future(received.wait())
+
+    try:
+        await asyncio.wait(
+            [task, waiter], timeout=timeout, return_when=asyncio.FIRST_COMPLETED
+        )
+        if not received.is_set():
+            if task.done():
+                # Raises exception of failed client
+                task.result()
+                raise EOFError("KVM connection closed before any video")
+            raise asyncio.TimeoutError("No video received in %ds" % timeout)
+
+        resx, resy = client.resolution
+        return client.read_rect(0, 0, resx, resy), resx, resy
+
+    finally:
+        waiter.cancel()
+        client.stop()
+        task.cancel()
+
+
+if __name__ == "__main__":
+    path = sys.argv[1]
+    client = AsyncKVMClient.from_arguments(sys.argv[2:])
+
+    data, resx, resy = asyncio.get_event_loop().run_until_complete(
+        take_screenshot(client)
+    )
+
+    with open(path, "wb") as fd:
+        fd.write(encode(data, resx, resy, path.rpartition(".")[2].lower()))
+
+    logging.info("Saved %dx%d screenshot to %s", resx, resy, path)
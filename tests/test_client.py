@@ -0,0 +1,279 @@
+import os
+import random
+import struct
+import sys
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import client  # noqa: E402
+import emulator  # noqa: E402
+from client import DecompressionError, KVMClient, decompress_rle  # noqa: E402
+
+
+def noise(w, h, seed=0):
+    rng = random.Random(seed)
+    return struct.pack("<%dH" % (w * h), *(rng.getrandbits(15) for _ in range(w * h)))
+
+
+def put_pixel(data, w, x, y, value=0x7FFF):
+    data = bytearray(data)
+    data[(y * w + x) * 2 : (y * w + x + 1) * 2] = struct.pack("<H", value)
+    return bytes(data)
+
+
+def crop(data, w, x, y, cw, ch):
+    return b"".join(
+        data[((y + row) * w + x) * 2 : ((y + row) * w + x + cw) * 2]
+        for row in range(ch)
+    )
+
+
+class ClientTestCase(unittest.TestCase):
+    resolution = (100, 70)
+
+    def setUp(self):
+        self.client = KVMClient(None, None)
+        self.damage = []
+        self.client.on_damage = lambda *rect: self.damage.append(rect)
+
+    def send(self, *rects):
+        """
+        Decodes a fragment of (x, y, w, h, RGB555 data) rectangles, returns
+        reported damage
+        """
+        self.damage = []
+        self.client.process_video(
+            emulator.fragment(
+                *self.resolution,
+                [
+                    (x, y, w, h, emulator.compress_rle(data))
+                    for x, y, w, h, data in rects
+                ],
+            )
+        )
+        return self.damage
+
+
+class TileDamageTest(ClientTestCase):
+    def test_unchanged(self):
+        resx, resy = self.resolution
+        screen = noise(resx, resy)
+        self.assertEqual(
+            self.send((0, 0, resx, resy, screen)),
+            [(0, 0, resx, 32), (0, 32, resx, 32), (0, 64, resx, 6)],
+        )
+
+        stats = self.client.stats
+        self.assertEqual(self.send((0, 0, resx, resy, screen)), [])
+        self.assertEqual(
+            self.client.stats["rects_unchanged"], stats["rects_unchanged"] + 1
+        )
+
+        # 4x3 tiles, partial at the right and bottom edges
+        self.assertEqual(
+            self.client.stats["tiles_checked"], stats["tiles_checked"] + 12
+        )
+        self.assertEqual(
+            self.client.stats["tiles_unchanged"], stats["tiles_unchanged"] + 12
+        )
+
+    def test_changed_tiles(self):
+        resx, resy = self.resolution
+        screen = noise(resx, resy)
+        self.send((0, 0, resx, resy, screen))
+
+        screen = put_pixel(screen, resx, 40, 50)
+        self.assertEqual(self.send((0, 0, resx, resy, screen)), [(32, 32, 32, 32)])
+
+        # Horizontally adjacent changed tiles are merged, partial edge tiles
+        # are clipped to framebuffer
+        screen = put_pixel(screen, resx, 70, 65)
+        screen = put_pixel(screen, resx, 99, 69)
+        self.assertEqual(self.send((0, 0, resx, resy, screen)), [(64, 64, 36, 6)])
+
+    def test_clipped_to_rect(self):
+        resx, resy = self.resolution
+        screen = noise(resx, resy)
+        self.send((0, 0, resx, resy, screen))
+
+        # Rectangle spans two tiles, only one of which changes
+        screen = put_pixel(screen, resx, 40, 50)
+        self.assertEqual(
+            self.send((30, 40, 20, 20, crop(screen, resx, 30, 40, 20, 20))),
+            [(32, 40, 18, 20)],
+        )
+
+
+class ScrollTest(ClientTestCase):
+    resolution = (160, 128)
+
+    def setUp(self):
+        super().setUp()
+        self.copies = []
+        self.client.on_copy = lambda *rect: self.copies.append(rect)
+
+        fg, bg = emulator.rgb555(192, 192, 192), emulator.rgb555(0, 0, 0)
+        self.text = emulator.render_text(20, 12, fg, bg, random.Random(0))
+
+    def screen(self, line):
+        """
+        Full screen of text, starting at `line`
+        """
+        return b"".join(self.text[line * 16 : line * 16 + self.resolution[1]])
+
+    def test_scroll(self):
+        resx, resy = self.resolution
+        self.send((0, 0, resx, resy, self.screen(0)))
+        self.assertEqual(self.copies, [])
+
+        # Scrolled up by two lines
+        damage = self.send((0, 0, resx, resy, self.screen(2)))
+        self.assertEqual(self.copies, [(0, 0, resx, 96, 0, 32)])
+        self.assertEqual(damage, [(0, 96, resx, 32)])
+        self.assertEqual(bytes(self.client.fb), self.screen(2))
+        self.assertEqual(self.client.stats["scrolls_detected"], 1)
+
+    def test_scroll_within_rect(self):
+        resx, resy = self.resolution
+        self.send((0, 0, resx, resy, self.screen(0)))
+
+        # Lower part of the screen scrolled down by a line, making room for
+        # a solid one
+        line = [emulator.rgb555(0, 0, 255) * resx] * 16
+        rows = self.text[:48] + line + self.text[48:112]
+        damage = self.send((0, 48, resx, 80, b"".join(rows[48:])))
+        self.assertEqual(self.copies, [(0, 64, resx, 64, 0, 48)])
+        self.assertEqual(damage, [(0, 48, resx, 16)])
+        self.assertEqual(bytes(self.client.fb), b"".join(rows))
+
+    def test_no_scroll(self):
+        resx, resy = self.resolution
+        self.send((0, 0, resx, resy, self.screen(0)))
+
+        self.send((0, 0, resx, resy, self.screen(8)))
+        self.assertEqual(self.copies, [])
+
+        # Rectangles too short to tell scrolling apart are not checked
+        self.send((0, 0, resx, 8, self.screen(1)[: resx * 8 * 2]))
+        self.assertEqual(self.copies, [])
+
+
+def raw_fragment(resx, resy, rects, colormode=client.COLOR_MODE_15BIT):
+    """
+    Builds video fragment out of (x, y, w, h, compression mode, data)
+    rectangles
+    """
+    body = b"".join(
+        emulator.RECT_HEADER.pack(x, y, w, h, mode, len(data)) + data
+        for x, y, w, h, mode, data in rects
+    )
+    return (
+        emulator.FRAGMENT_HEADER.pack(
+            0, emulator.FRAGMENT_HEADER.size + len(body), resx, resy, colormode
+        )
+        + body
+    )
+
+
+class DecompressRLETest(unittest.TestCase):
+    def test_round_trip(self):
+        rng = random.Random(0)
+        data = bytes(
+            rng.choice(b"\x00\x01\xff") if n % 64 < 48 else rng.getrandbits(8)
+            for n in range(4001)
+        )
+
+        for unit in (1, 2, 4):
+            for size in (0, 1, 2, 3, 4, 1000, 4000, 4001):
+                out = bytearray(size + 4)
+                encoded = emulator.compress_rle(data[:size], unit)
+                decoded = decompress_rle(encoded, size, out, unit)
+                self.assertEqual(bytes(decoded), data[:size], (unit, size))
+
+    def test_long_runs(self):
+        data = bytes(0x7FFF * 2 + 10) + bytes(range(256)) * 300
+        encoded = emulator.compress_rle(data)
+        out = bytearray(len(data))
+        self.assertEqual(bytes(decompress_rle(encoded, len(data), out)), data)
+
+    def test_small_output(self):
+        with self.assertRaises(ValueError):
+            decompress_rle(emulator.compress_rle(bytes(10)), 10, bytearray(8))
+
+    def test_malformed(self):
+        fill = struct.pack("<HH", 0x1234, 0x8000 | 5)
+        copy = b"\x01\x02\x03\x04" + struct.pack("<H", 2)
+        malformed = [
+            b"\x05",  # truncated run header
+            fill[2:],  # fill run without value
+            copy[1:],  # copy run missing data
+            fill,  # fill longer than rectangle
+            copy,  # copy longer than rectangle
+        ]
+        for data in malformed:
+            with self.assertRaises(DecompressionError, msg=data):
+                decompress_rle(data, 2, bytearray(8))
+
+
+class DecoderTest(ClientTestCase):
+    resolution = (16, 8)
+
+    def test_registry(self):
+        for colormode in (client.COLOR_MODE_15BIT, client.COLOR_MODE_7BIT):
+            for mode in client.COMPRESSION_UNITS:
+                self.assertIn((colormode, mode), client.DECODERS)
+
+    def test_15bit(self):
+        data = noise(16, 8)
+        for mode, unit in client.COMPRESSION_UNITS.items():
+            self.client = KVMClient(None, None)
+            compressed = data if unit is None else emulator.compress_rle(data, unit)
+            self.client.process_video(
+                raw_fragment(16, 8, [(0, 0, 16, 8, mode, compressed)])
+            )
+            self.assertEqual(bytes(self.client.fb), data, mode)
+
+    def test_7bit(self):
+        indices = bytes(range(128))
+        expected = struct.pack(
+            "<128H", *(client.rgb7_to_rgb555(value) for value in indices)
+        )
+        self.assertEqual(client.rgb7_to_rgb555(0x7F), 0x7FFF)
+
+        for mode, unit in client.COMPRESSION_UNITS.items():
+            self.client = KVMClient(None, None)
+            compressed = (
+                indices if unit is None else emulator.compress_rle(indices, unit)
+            )
+            self.client.process_video(
+                raw_fragment(
+                    16, 8, [(0, 0, 16, 8, mode, compressed)], client.COLOR_MODE_7BIT
+                )
+            )
+            self.assertEqual(bytes(self.client.fb), expected, mode)
+
+    def test_malformed_rect_dropped(self):
+        data = noise(16, 8)
+        rle = emulator.compress_rle(data[:64])
+        with self.assertLogs("client", "WARNING"):
+            self.client.process_video(
+                raw_fragment(
+                    16,
+                    8,
+                    [
+                        (0, 0, 16, 2, 2, b"\x05" + rle),
+                        (0, 2, 16, 2, 2, rle),
+                        (0, 4, 16, 2, 7, rle),
+                    ],
+                )
+            )
+
+        # Only the valid rectangle is decoded
+        self.assertEqual(self.damage, [(0, 2, 16, 2)])
+        self.assertEqual(bytes(self.client.fb)[64:128], data[:64])
+        self.assertEqual(bytes(self.client.fb)[:64], bytes(64))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,116 @@
+import asyncio
+import os
+import struct
+import sys
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import emulator  # noqa: E402
+from client import KVMClient  # noqa: E402
+from decodepool import DecodePool, PooledKVMClient  # noqa: E402
+from tracing import Tracer  # noqa: E402
+
+
+class PooledKVMClientTest(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.loop = asyncio.new_event_loop()
+        cls.pool = DecodePool(1, loop=cls.loop)
+
+        workload = emulator.TextWorkload(320, 240, 10)
+        cls.fragments = [workload.initial] + [f for _, f in workload.frames[:20]]
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.pool.shutdown()
+        cls.loop.close()
+
+    def setUp(self):
+        self.client = PooledKVMClient(None, None, pool=self.pool)
+        self.events = []
+        self.client.on_damage = lambda *rect: self.events.append(("damage", rect))
+        self.client.on_copy = lambda *rect: self.events.append(("copy", rect))
+        self.client.worker, self.client.sid = self.pool.open(True)
+
+    def tearDown(self):
+        self.client.stop()
+
+    def test_matches_local_decoding(self):
+        reference = KVMClient(None, None)
+        reference.on_copy = lambda *rect: None
+
+        for payload in self.fragments:
+            self.loop.run_until_complete(self.client.decode_remote(payload))
+            reference.process_video(payload)
+            self.assertEqual(bytes(self.client.fb), bytes(reference.fb))
+
+        self.assertTrue(any(event == "copy" for event, rect in self.events))
+
+    def test_framebuffer_changes_with_damage(self):
+        self.loop.run_until_complete(self.client.decode_remote(self.fragments[0]))
+
+        # Worker reply is held back until the worker is done writing
+        replies = []
+        call = self.pool.call
+
+        def delayed_call(worker, request):
+            reply = call(worker, request)
+            delayed = self.loop.create_future()
+            replies.append((reply, delayed))
+            return delayed
+
+        self.pool.call = delayed_call
+        try:
+            before = bytes(self.client.fb)
+            task = self.loop.create_task(self.client.decode_remote(self.fragments[1]))
+            reply, delayed = None, None
+            while reply is None or not reply.done():
+                self.loop.run_until_complete(asyncio.sleep(0.01))
+                if replies:
+                    reply, delayed = replies[0]
+
+            self.assertEqual(bytes(self.client.fb), before)
+
+            delayed.set_result(reply.result())
+            self.loop.run_until_complete(task)
+            self.assertNotEqual(bytes(self.client.fb), before)
+        finally:
+            del self.pool.call
+
+    def test_readable_after_stop(self):
+        self.loop.run_until_complete(self.client.decode_remote(self.fragments[0]))
+        frame = bytes(self.client.fb)
+        self.client.stop()
+
+        resx, resy = self.client.resolution
+        self.assertEqual(self.client.read_rect(0, 0, resx, resy), frame)
+        self.assertGreaterEqual(self.client.memory_usage, len(frame))
+
+    def test_read_loop_traced(self):
+        reader = asyncio.StreamReader(loop=self.loop)
+        for payload in self.fragments[:2]:
+            reader.feed_data(struct.pack("<BIH", 0x03, len(payload), 0) + payload)
+        reader.feed_eof()
+
+        self.client.tracer = Tracer()
+        self.client.video_socket = sock = object()
+        with self.assertRaises(OSError):
+            self.loop.run_until_complete(self.client.read_loop(reader, sock))
+
+        # Remote decoding is within parse span of data it was read with
+        spans = self.client.tracer.spans
+        parses = [span for span in spans if span[0] == "parse"]
+        decodes = [span for span in spans if span[0] == "decompress"]
+        self.assertEqual(len(decodes), 2)
+        for _, start, duration, _, _ in decodes:
+            self.assertTrue(
+                any(
+                    p_start <= start and start + duration <= p_start + p_duration
+                    for _, p_start, p_duration, _, _ in parses
+                )
+            )
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,265 @@
+import io
+import os
+import random
+import struct
+import sys
+import unittest
+import zlib
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import encoders  # noqa: E402
+from pixelformat import DEFAULT_PIXEL_FORMAT  # noqa: E402
+
+
+def rgb(value):
+    """
+    RGB888 (R, G, B) of a RGB555 value, as converted for viewers
+    """
+    return ((value >> 10) & 0x1F) << 3, ((value >> 5) & 0x1F) << 3, (value & 0x1F) << 3
+
+
+def screen(w, h, seed=0):
+    """
+    RGB555 rectangle data - a few solid areas, a few-colored text-like area
+    and noise, so that every subencoding gets used
+    """
+    rng = random.Random(seed)
+    palette = [rng.getrandbits(15) for _ in range(3)]
+    pixels = []
+    for y in range(h):
+        for x in range(w):
+            if y < h // 3:
+                pixels.append(palette[0])
+            elif y < 2 * h // 3:
+                pixels.append(palette[rng.randrange(1, 3)])
+            else:
+                pixels.append(rng.getrandbits(15))
+    return struct.pack("<%dH" % len(pixels), *pixels)
+
+
+def expected(data):
+    return [rgb(v) for v in struct.unpack("<%dH" % (len(data) // 2), data)]
+
+
+def bgrx(pixels, size=4):
+    """
+    Decodes DEFAULT_PIXEL_FORMAT pixels (or CPIXELs, when size is 3) into
+    (R, G, B) tuples
+    """
+    return [
+        (pixels[n + 2], pixels[n + 1], pixels[n]) for n in range(0, len(pixels), size)
+    ]
+
+
+def compact_length(data, pos):
+    """
+    Reads Tight compact length at `pos`, returns (length, position after it)
+    """
+    length = 0
+    for shift in (0, 7, 14):
+        byte = data[pos]
+        pos += 1
+        if shift == 14:
+            return length | byte << shift, pos
+
+        length |= (byte & 0x7F) << shift
+        if not byte & 0x80:
+            return length, pos
+
+
+class Viewer(object):
+    """
+    Decoding side of an encoder - keeps zlib streams across rectangles, the
+    same way a VNC viewer does
+    """
+
+    def __init__(self):
+        self.streams = {}
+
+    def inflate(self, stream, data):
+        if stream not in self.streams:
+            self.streams[stream] = zlib.decompressobj()
+        return self.streams[stream].decompress(data)
+
+    def decode(self, rects, w, h):
+        """
+        Decodes list of encoded rectangles into (R, G, B) pixels of a single
+        w x h area at (0, 0)
+        """
+        out = [None] * (w * h)
+        for rect in rects:
+            x, y, rw, rh, encoding = struct.unpack_from(">HHHHi", rect)
+            pixels = getattr(self, "decode_%d" % encoding)(rect[12:], rw, rh)
+            for row in range(rh):
+                start = (y + row) * w + x
+                out[start : start + rw] = pixels[row * rw : (row + 1) * rw]
+        return out
+
+    def decode_0(self, data, w, h):
+        return bgrx(data)
+
+    def decode_6(self, data, w, h):
+        (length,) = struct.unpack_from(">I", data)
+        return bgrx(self.inflate("zlib", data[4 : 4 + length]))
+
+    def decode_16(self, data, w, h):
+        (length,) = struct.unpack_from(">I", data)
+        data = self.inflate("zrle", data[4 : 4 + length])
+        out = [None] * (w * h)
+        pos = 0
+
+        for ty in range(0, h, 64):
+            th = min(64, h - ty)
+            for tx in range(0, w, 64):
+                tw = min(64, w - tx)
+                subencoding = data[pos]
+                pos += 1
+
+                if subencoding == 0:
+                    tile = bgrx(data[pos : pos + tw * th * 3], 3)
+                    pos += tw * th * 3
+                elif subencoding == 1:
+                    tile = bgrx(data[pos : pos + 3], 3) * (tw * th)
+                    pos += 3
+                else:
+                    palette = bgrx(data[pos : pos + subencoding * 3], 3)
+                    pos += subencoding * 3
+                    bits = 1 if subencoding == 2 else 2 if subencoding <= 4 else 4
+                    row = -(-tw * bits // 8)
+                    tile = []
+                    for y in range(th):
+                        packed = int.from_bytes(data[pos : pos + row], "big")
+                        pos += row
+                        for x in range(tw):
+                            shift = row * 8 - (x + 1) * bits
+                            tile.append(palette[(packed >> shift) & ((1 << bits) - 1)])
+
+                for y in range(th):
+                    start = (ty + y) * w + tx
+                    out[start : start + tw] = tile[y * tw : (y + 1) * tw]
+
+        if pos != len(data):
+            raise ValueError("%d bytes of ZRLE data left" % (len(data) - pos))
+        return out
+
+    def decode_7(self, data, w, h):
+        control = data[0]
+        if control == 0x80:
+            return [tuple(data[1:4])] * (w * h)
+
+        if control != 0x00:
+            raise ValueError("Unexpected Tight control byte %02x" % control)
+
+        if w * h * 3 < 12:
+            pixels = data[1:]
+        else:
+            length, pos = compact_length(data, 1)
+            pixels = self.inflate("tight", data[pos : pos + length])
+
+        return [tuple(pixels[n : n + 3]) for n in range(0, len(pixels), 3)]
+
+
+class EncoderTest(unittest.TestCase):
+    def encoder(self, encoding, **kwargs):
+        return encoders.ENCODERS[encoding](DEFAULT_PIXEL_FORMAT, **kwargs)
+
+    def assertRoundTrip(self, encoder, data, w, h, viewer=None):
+        rects = encoder.encode(0, 0, w, h, data)
+        self.assertEqual((viewer or Viewer()).decode(rects, w, h), expected(data))
+        return rects
+
+    def test_raw(self):
+        rects = self.assertRoundTrip(self.encoder(encoders.RAW), screen(50, 30), 50, 30)
+        self.assertEqual(len(rects[0]), 12 + 50 * 30 * 4)
+
+    def test_zlib(self):
+        encoder = self.encoder(encoders.ZLIB)
+        viewer = Viewer()
+
+        # Stream carries on across updates
+        for seed in range(3):
+            self.assertRoundTrip(encoder, screen(50, 30, seed), 50, 30, viewer)
+
+    def test_zrle(self):
+        encoder = self.encoder(encoders.ZRLE)
+        viewer = Viewer()
+
+        # Partial tiles, solid, palette and raw subencodings
+        for seed in range(3):
+            self.assertRoundTrip(encoder, screen(150, 100, seed), 150, 100, viewer)
+
+    def test_zrle_palette_sizes(self):
+        encoder = self.encoder(encoders.ZRLE)
+        viewer = Viewer()
+
+        for colors in (2, 3, 4, 5, 16):
+            rng = random.Random(colors)
+            palette = [rng.getrandbits(15) for _ in range(colors)]
+            pixels = [palette[n % colors] for n in range(37 * 19)]
+            data = struct.pack("<%dH" % len(pixels), *pixels)
+            self.assertRoundTrip(encoder, data, 37, 19, viewer)
+
+    def test_tight(self):
+        encoder = self.encoder(encoders.TIGHT)
+        viewer = Viewer()
+
+        for seed in range(3):
+            self.assertRoundTrip(encoder, screen(150, 100, seed), 150, 100, viewer)
+
+    def test_tight_fill_and_split(self):
+        encoder = self.encoder(encoders.TIGHT)
+        encoder.max_width = 64
+        encoder.max_pixels = 1024
+
+        rects = self.assertRoundTrip(encoder, screen(150, 100), 150, 100)
+        self.assertGreater(len(rects), 1)
+
+        # Top third of the screen is a single color
+        fills = [rect for rect in rects if rect[12] == 0x80]
+        self.assertTrue(fills)
+        self.assertTrue(all(len(rect) == 16 for rect in fills))
+
+    def test_tight_jpeg(self):
+        if encoders.Image is None:
+            self.skipTest("JPEG requires Pillow")
+
+        encoder = self.encoder(encoders.TIGHT, quality_level=9)
+        data = screen(64, 48)
+        (rect,) = encoder.encode(0, 0, 64, 48, data)
+        self.assertEqual(rect[12], 0x90)
+
+        length, pos = compact_length(rect, 13)
+        self.assertEqual(pos + length, len(rect))
+        image = encoders.Image.open(io.BytesIO(rect[pos:])).convert("RGB")
+        self.assertEqual(image.size, (64, 48))
+
+        # Solid top third survives lossy compression almost exactly
+        color = image.getpixel((10, 5))
+        reference = expected(data[:2])[0]
+        self.assertTrue(all(abs(a - b) <= 8 for a, b in zip(color, reference)))
+
+    def test_compress_level_change(self):
+        data = screen(80, 60)
+        for encoding in (encoders.ZLIB, encoders.ZRLE, encoders.TIGHT):
+            encoder = self.encoder(encoding)
+            viewer = Viewer()
+
+            for level in (6, 1, 9, None):
+                encoder.set_compress_level(level)
+                rects = encoder.encode(0, 0, 80, 60, data)
+                self.assertEqual(viewer.decode(rects, 80, 60), expected(data))
+
+            self.assertEqual(encoder.compress_level, 6)
+
+    def test_compress_level_change_before_first_update(self):
+        encoder = self.encoder(encoders.ZLIB)
+        encoder.set_compress_level(1)
+
+        data = screen(16, 16)
+        rects = encoder.encode(0, 0, 16, 16, data)
+        self.assertEqual(Viewer().decode(rects, 16, 16), expected(data))
+
+
+if __name__ == "__main__":
+    unittest.main()
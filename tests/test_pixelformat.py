@@ -0,0 +1,133 @@
+import os
+import struct
+import sys
+import unittest
+from unittest import mock
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import pixelformat  # noqa: E402
+from client import rgb555_to_rgb888_struct  # noqa: E402
+from pixelformat import (  # noqa: E402
+    DEFAULT_PIXEL_FORMAT,
+    NATIVE_PIXEL_FORMAT,
+    PixelFormat,
+    rgb555_to_rgb,
+)
+
+# Every RGB555 color, along with a few having the unused top bit set
+VALUES = list(range(1 << 15)) + [0x8000, 0xFFFF, 0xABCD]
+DATA = struct.pack("<%dH" % len(VALUES), *VALUES)
+
+
+def channels(value):
+    return (value >> 10) & 0x1F, (value >> 5) & 0x1F, value & 0x1F
+
+
+def reference(fmt, data, scale):
+    """
+    Converts RGB555 data to `fmt` one pixel at a time, with `scale(channel,
+    maximum)` expanding 5-bit channels
+    """
+    order = "big" if fmt.big_endian else "little"
+    out = bytearray()
+    for value in struct.unpack("<%dH" % (len(data) // 2), data):
+        r, g, b = channels(value)
+        out += (
+            scale(r, fmt.red_max) << fmt.red_shift
+            | scale(g, fmt.green_max) << fmt.green_shift
+            | scale(b, fmt.blue_max) << fmt.blue_shift
+        ).to_bytes(fmt.bytes_per_pixel, order)
+    return bytes(out)
+
+
+def shifted(channel, maximum):
+    return channel << 3
+
+
+def scaled(channel, maximum):
+    return channel * maximum // 31
+
+
+class PixelFormatTest(unittest.TestCase):
+    def test_default(self):
+        self.assertEqual(
+            DEFAULT_PIXEL_FORMAT.convert(DATA), rgb555_to_rgb888_struct(DATA)
+        )
+
+    def test_native(self):
+        self.assertTrue(NATIVE_PIXEL_FORMAT.native)
+        self.assertEqual(NATIVE_PIXEL_FORMAT.convert(DATA), DATA)
+
+    def test_byte_converters(self):
+        for big_endian in (False, True):
+            for shifts in ((16, 8, 0), (0, 8, 16), (24, 16, 8), (8, 16, 24)):
+                fmt = PixelFormat(32, 24, big_endian, True, 255, 255, 255, *shifts)
+                self.assertEqual(
+                    fmt.convert(DATA), reference(fmt, DATA, shifted), repr(fmt)
+                )
+
+    def test_table_converters(self):
+        formats = [
+            PixelFormat(16, 16, False, True, 31, 63, 31, 11, 5, 0),
+            PixelFormat(16, 16, True, True, 31, 63, 31, 11, 5, 0),
+            PixelFormat(16, 15, True, True, 31, 31, 31, 10, 5, 0),
+            PixelFormat(8, 8, False, True, 7, 7, 3, 0, 3, 6),
+            PixelFormat(32, 30, False, True, 1023, 1023, 1023, 20, 10, 0),
+        ]
+
+        for fmt in formats:
+            expected = reference(fmt, DATA, scaled)
+            self.assertEqual(fmt.make_table_converter()(DATA), expected, repr(fmt))
+
+            # Fallback without numpy gives the same result
+            with mock.patch.object(pixelformat, "numpy", None):
+                self.assertEqual(fmt.make_table_converter()(DATA), expected, repr(fmt))
+
+    def test_odd_length(self):
+        fmt = PixelFormat(16, 16, False, True, 31, 63, 31, 11, 5, 0)
+        self.assertEqual(fmt.convert(DATA[:5]), fmt.convert(DATA[:4]))
+
+    def test_color_map(self):
+        fmt = PixelFormat(8, 8, False, False, 0, 0, 0, 0, 0, 0)
+        with self.assertRaises(ValueError):
+            fmt.convert(DATA)
+
+    def test_compact(self):
+        pixels = DEFAULT_PIXEL_FORMAT.convert(DATA)
+        self.assertEqual(DEFAULT_PIXEL_FORMAT.unused_byte, 3)
+        self.assertEqual(
+            DEFAULT_PIXEL_FORMAT.compact(pixels),
+            b"".join(pixels[n : n + 3] for n in range(0, len(pixels), 4)),
+        )
+
+        fmt = PixelFormat(32, 24, True, True, 255, 255, 255, 16, 8, 0)
+        self.assertEqual(fmt.unused_byte, 0)
+        pixels = fmt.convert(DATA)
+        self.assertEqual(
+            fmt.compact(pixels),
+            b"".join(pixels[n + 1 : n + 4] for n in range(0, len(pixels), 4)),
+        )
+
+        fmt = PixelFormat(32, 24, False, True, 255, 255, 255, 24, 16, 8)
+        self.assertEqual(fmt.unused_byte, 0)
+
+        fmt = PixelFormat(32, 30, False, True, 1023, 1023, 1023, 20, 10, 0)
+        self.assertIsNone(fmt.unused_byte)
+        self.assertEqual(fmt.compact(b"1234"), b"1234")
+
+    def test_tight(self):
+        expected = b"".join(
+            bytes(channel << 3 for channel in channels(value)) for value in VALUES
+        )
+        self.assertEqual(rgb555_to_rgb(DATA), expected)
+        self.assertTrue(DEFAULT_PIXEL_FORMAT.rgb24)
+        self.assertEqual(DEFAULT_PIXEL_FORMAT.tight(DATA), expected)
+
+        fmt = PixelFormat(16, 16, False, True, 31, 63, 31, 11, 5, 0)
+        self.assertFalse(fmt.rgb24)
+        self.assertEqual(fmt.tight(DATA), fmt.convert(DATA))
+
+
+if __name__ == "__main__":
+    unittest.main()
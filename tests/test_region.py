@@ -0,0 +1,106 @@
+import os
+import random
+import sys
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from region import Region, bounds, intersect, subtract  # noqa: E402
+
+
+def pixels(rects):
+    """
+    Set of all (x, y) points covered by rectangles
+    """
+    return {
+        (x, y)
+        for rx, ry, rw, rh in rects
+        for x in range(rx, rx + rw)
+        for y in range(ry, ry + rh)
+    }
+
+
+def overlapping(rects):
+    return any(intersect(a, b) for n, a in enumerate(rects) for b in rects[n + 1 :])
+
+
+class RectTest(unittest.TestCase):
+    def test_intersect(self):
+        self.assertEqual(intersect((0, 0, 10, 10), (5, 5, 10, 10)), (5, 5, 5, 5))
+        self.assertIsNone(intersect((0, 0, 10, 10), (10, 0, 5, 5)))
+
+    def test_subtract(self):
+        rng = random.Random(0)
+        for _ in range(200):
+            a = (rng.randrange(20), rng.randrange(20), rng.randrange(1, 20), 5)
+            b = tuple(rng.randrange(1, 20) for _ in range(4))
+            pieces = subtract(a, b)
+
+            self.assertLessEqual(len(pieces), 4)
+            self.assertFalse(overlapping(pieces))
+            self.assertEqual(pixels(pieces), pixels([a]) - pixels([b]))
+
+    def test_bounds(self):
+        self.assertEqual(bounds([(0, 5, 2, 2), (10, 0, 5, 1)]), (0, 0, 15, 7))
+
+
+class RegionTest(unittest.TestCase):
+    def test_add_keeps_rects_disjoint(self):
+        rng = random.Random(1)
+        region = Region()
+        added = []
+
+        for _ in range(30):
+            rect = tuple(rng.randrange(1, 30) for _ in range(4))
+            region.add(*rect)
+            added.append(rect)
+
+            self.assertFalse(overlapping(region.rects))
+            self.assertEqual(pixels(region), pixels(added))
+
+    def test_merges_adjacent(self):
+        region = Region()
+        for y in range(0, 64, 16):
+            region.add(0, y, 100, 16)
+        self.assertEqual(region.rects, [(0, 0, 100, 64)])
+
+        region.add(100, 0, 20, 64)
+        self.assertEqual(region.rects, [(0, 0, 120, 64)])
+
+    def test_superseded(self):
+        region = Region()
+        region.add(0, 0, 10, 10)
+        region.add(20, 0, 10, 10)
+        self.assertEqual(region.superseded, 0)
+
+        region.add(5, 5, 10, 10)
+        self.assertEqual(region.superseded, 1)
+
+    def test_collapses_past_max_rects(self):
+        region = Region()
+        for n in range(Region.max_rects + 1):
+            region.add(n * 10, n * 10, 5, 5)
+
+        size = Region.max_rects * 10 + 5
+        self.assertEqual(region.rects, [(0, 0, size, size)])
+
+    def test_take(self):
+        region = Region()
+        region.add(0, 0, 100, 100)
+        region.add(200, 200, 10, 10)
+
+        taken = region.take(50, 50, 100, 100)
+        self.assertEqual(taken, [(50, 50, 50, 50)])
+        self.assertEqual(
+            pixels(region),
+            pixels([(0, 0, 100, 100), (200, 200, 10, 10)]) - pixels(taken),
+        )
+        self.assertFalse(overlapping(region.rects))
+
+        rest = list(region)
+        self.assertEqual(sorted(region.take(0, 0, 1000, 1000)), sorted(rest))
+        self.assertFalse(region)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,186 @@
+import asyncio
+import os
+import struct
+import sys
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from vncproxy import SessionHub, WrappedSocket, serve_viewer  # noqa: E402
+
+
+class FakeClient(object):
+    """
+    Upstream KVM session that is connected right away and never sends
+    anything else
+    """
+
+    resolution = (64, 48)
+    tracer = None
+    profiler = None
+    stats = {}
+    memory_usage = 0
+
+    def __init__(self):
+        self.stopped = asyncio.Event()
+
+    async def run(self):
+        self.on_damage(0, 0, *self.resolution)
+        await self.stopped.wait()
+
+    def stop(self):
+        self.stopped.set()
+
+    def read_rect(self, x, y, w, h):
+        return bytes(w * h * 2)
+
+
+async def connect_viewer(port):
+    """
+    Connects to proxy and goes through RFB handshake, returns (reader,
+    writer) once ServerInit is received
+    """
+    reader, writer = await asyncio.open_connection("127.0.0.1", port)
+    await reader.readexactly(12)
+    writer.write(b"RFB 003.008\n")
+    await reader.readexactly(2)
+    writer.write(b"\x01")
+    await reader.readexactly(4)
+    writer.write(b"\x01")
+
+    server_init = await reader.readexactly(24)
+    await reader.readexactly(struct.unpack(">I", server_init[20:])[0])
+    return reader, writer
+
+
+async def read_update(reader):
+    """
+    Reads a FramebufferUpdate of raw and DesktopSize rectangles, returns list
+    of (x, y, w, h, encoding)
+    """
+    msg_type, count = struct.unpack(">BxH", await reader.readexactly(4))
+    assert msg_type == 0
+
+    rects = []
+    for _ in range(count):
+        rect = struct.unpack(">HHHHi", await reader.readexactly(12))
+        if rect[4] == 0:
+            await reader.readexactly(rect[2] * rect[3] * 4)
+        rects.append(rect)
+    return rects
+
+
+class ViewerDisconnectTest(unittest.TestCase):
+    def setUp(self):
+        self.loop = asyncio.new_event_loop()
+        self.hub = SessionHub(self.loop, linger=None, max_viewers=1)
+
+    def tearDown(self):
+        for session in list(self.hub.sessions.values()):
+            session.close()
+        self.loop.run_until_complete(asyncio.sleep(0.01))
+        self.loop.close()
+
+    async def start_proxy(self):
+        async def handle(reader, writer):
+            await serve_viewer(
+                WrappedSocket(reader, writer),
+                self.hub,
+                "host",
+                FakeClient,
+                self.loop,
+            )
+
+        server = await asyncio.start_server(handle, "127.0.0.1", 0)
+        return server, server.sockets[0].getsockname()[1]
+
+    async def wait_detached(self, session, timeout=1):
+        for _ in range(int(timeout / 0.01)):
+            if not session.viewers:
+                return
+            await asyncio.sleep(0.01)
+
+    def test_disconnect_detaches_viewer(self):
+        async def run():
+            server, port = await self.start_proxy()
+            reader, writer = await connect_viewer(port)
+
+            session = self.hub.sessions["host"]
+            self.assertEqual(len(session.viewers), 1)
+
+            writer.close()
+            await self.wait_detached(session)
+            self.assertEqual(len(session.viewers), 0)
+            server.close()
+
+        self.loop.run_until_complete(asyncio.wait_for(run(), 5))
+
+    def test_viewer_limit_after_disconnects(self):
+        async def run():
+            server, port = await self.start_proxy()
+
+            # Viewers that left don't count towards the limit
+            for _ in range(3):
+                reader, writer = await connect_viewer(port)
+                writer.close()
+                await self.wait_detached(self.hub.sessions["host"])
+
+            # ...but connected ones do
+            reader, writer = await connect_viewer(port)
+            with self.assertRaises(asyncio.IncompleteReadError):
+                await connect_viewer(port)
+
+            writer.close()
+            server.close()
+
+        self.loop.run_until_complete(asyncio.wait_for(run(), 5))
+
+
+class ResolutionChangeTest(unittest.TestCase):
+    def setUp(self):
+        self.loop = asyncio.new_event_loop()
+        self.hub = SessionHub(self.loop, linger=None)
+
+    def tearDown(self):
+        for session in list(self.hub.sessions.values()):
+            session.close()
+        self.loop.run_until_complete(asyncio.sleep(0.01))
+        self.loop.close()
+
+    def test_desktop_size_with_repaint(self):
+        async def run():
+            async def handle(reader, writer):
+                await serve_viewer(
+                    WrappedSocket(reader, writer),
+                    self.hub,
+                    "host",
+                    FakeClient,
+                    self.loop,
+                )
+
+            server = await asyncio.start_server(handle, "127.0.0.1", 0)
+            reader, writer = await connect_viewer(server.sockets[0].getsockname()[1])
+            writer.write(struct.pack(">BxHii", 2, 2, 0, -223))
+            writer.write(struct.pack(">BBHHHH", 3, 0, 0, 0, 64, 48))
+            self.assertEqual(await read_update(reader), [(0, 0, 64, 48, 0)])
+
+            session = self.hub.sessions["host"]
+            session.client.resolution = (80, 60)
+            session.client_on_damage(0, 0, 80, 60)
+            writer.write(struct.pack(">BBHHHH", 3, 1, 0, 0, 64, 48))
+
+            # Single update answering the request, with the new size first
+            self.assertEqual(
+                await read_update(reader), [(0, 0, 80, 60, -223), (0, 0, 80, 60, 0)]
+            )
+            with self.assertRaises(asyncio.TimeoutError):
+                await asyncio.wait_for(reader.readexactly(1), 0.1)
+
+            writer.close()
+            server.close()
+
+        self.loop.run_until_complete(asyncio.wait_for(run(), 5))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,244 @@
+"""
+Low resolution live thumbnails of KVM sessions, for an overview of many
+consoles at once.
+
+Each thumbnail keeps its own downscaled copy of session framebuffer, and
+only cells covered by damage reported since last update are downscaled again
+- at most `fps` times per second, and only when someone actually asks for the
+thumbnail. Thumbnail of a static screen costs nothing, and a busy one costs
+a fraction of encoding it for a full-size viewer.
+"""
+
+import html
+import json
+import time
+import urllib.parse
+from http import HTTPStatus
+
+from client import numpy
+from region import Region
+from screenshot import encode
+
+
+def downscale(fb, resx, scale, tx, ty, tw, th):
+    """
+    Returns (tx, ty, tw, th) area of framebuffer downscaled `scale` times as
+    RGB555 data - averaging each scale x scale block if numpy is available,
+    or taking its middle pixel otherwise
+    """
+    if numpy is not None:
+        pixels = numpy.frombuffer(fb, dtype="<u2", count=len(fb) // 2).reshape(
+            (-1, resx)
+        )
+        block = (
+            pixels[ty * scale : (ty + th) * scale, tx * scale : (tx + tw) * scale]
+            .astype(numpy.uint32)
+            .reshape((th, scale, tw, scale))
+        )
+        area = scale * scale
+        red = ((block >> 10) & 0x1F).sum(axis=(1, 3)) // area
+        green = ((block >> 5) & 0x1F).sum(axis=(1, 3)) // area
+        blue = (block & 0x1F).sum(axis=(1, 3)) // area
+        return ((red << 10) | (green << 5) | blue).astype("<u2").tobytes()
+
+    pixels = memoryview(fb).cast("B").cast("H")
+    half = scale // 2
+    return b"".join(
+        pixels[offset : offset + tw * scale : scale].tobytes()
+        for offset in (
+            ((ty + row) * scale + half) * resx + tx * scale + half for row in range(th)
+        )
+    )
+
+
+class Thumbnail(object):
+    """
+    Downscaled copy of `client` framebuffer, to be registered as KVMSession
+    observer. Implements ScreenshotCache interface, so it can be served with
+    `screenshot.http_handler`.
+    """
+
+    def __init__(self, client, scale=8, fps=1.0):
+        self.client = client
+        self.scale = scale
+        self.fps = fps
+        self.resolution = None
+        self.data = None
+        self.generation = 0
+        self.updated = 0
+        self.cache = {}
+
+        # Damaged cells, in thumbnail coordinates
+        self.dirty = Region()
+        self.cells_updated = 0
+
+    @property
+    def size(self):
+        resx, resy = self.client.resolution
+        return resx // self.scale, resy // self.scale
+
+    @property
+    def stats(self):
+        return {"generation": self.generation, "cells_updated": self.cells_updated}
+
+    def on_damage(self, x, y, w, h):
+        s = self.scale
+        self.dirty.add(
+            x // s, y // s, -(-(x + w) // s) - x // s, -(-(y + h) // s) - y // s
+        )
+
+    def on_copy(self, x, y, w, h, src_x, src_y):
+        self.on_damage(x, y, w, h)
+
+    def update(self):
+        """
+        Downscales damaged framebuffer areas into thumbnail, if there are any
+        """
+        if self.client.fb is None:
+            return
+
+        tw, th = self.size
+        if self.resolution != self.client.resolution:
+            self.resolution = self.client.resolution
+            self.data = bytearray(tw * th * 2)
+            self.dirty.clear()
+            self.dirty.add(0, 0, tw, th)
+
+        rects = self.dirty.take(0, 0, tw, th)
+        self.dirty.clear()
+        if not rects:
+            return
+
+        resx = self.resolution[0]
+        for x, y, w, h in rects:
+            cells = downscale(self.client.fb, resx, self.scale, x, y, w, h)
+            for row in range(h):
+                offset = ((y + row) * tw + x) * 2
+                self.data[offset : offset + w * 2] = cells[
+                    row * w * 2 : (row + 1) * w * 2
+                ]
+            self.cells_updated += w * h
+
+        self.generation += 1
+
+    async def get(self, image_format="png", quality=None):
+        """
+        Returns (generation, encoded thumbnail), or None if no video has been
+        received yet
+        """
+        # Thumbnail of previous resolution can't be encoded at the new size,
+        # so resolution change is picked up right away
+        now = time.monotonic()
+        if (
+            now - self.updated >= 1.0 / self.fps
+            or self.resolution != self.client.resolution
+        ):
+            self.updated = now
+            self.update()
+
+        if self.data is None:
+            return None
+
+        key = (image_format, quality)
+        cached = self.cache.get(key)
+        if cached is None or cached[0] != self.generation:
+            cached = self.cache[key] = (
+                self.generation,
+                encode(bytes(self.data), *self.size, image_format, quality),
+            )
+
+        return cached
+
+
+class ThumbnailWall(object):
+    """
+    Thumbnails of KVMSessions, attached on first request
+    """
+
+    def __init__(self, scale=8, fps=1.0):
+        self.scale = scale
+        self.fps = fps
+        self.thumbnails = {}
+
+    def get(self, session):
+        thumbnail = self.thumbnails.get(session)
+        if thumbnail is None:
+            if session.closed:
+                return None
+
+            thumbnail = self.thumbnails[session] = Thumbnail(
+                session.client, self.scale, self.fps
+            )
+            session.observers.add(thumbnail)
+
+            # Drop thumbnails of sessions which have ended
+            for old in [s for s in self.thumbnails if s.closed]:
+                old.observers.discard(self.thumbnails.pop(old))
+
+        return thumbnail
+
+    def page_handler(self, names, path="/wall", thumbnail_prefix="/thumbnail/"):
+        """
+        Returns httpserver handler serving HTML page with live thumbnails of
+        hosts listed by `names` function
+        """
+
+        async def handler(request_path, headers):
+            if request_path.partition("?")[0] != path:
+                return None
+
+            cells = "\n".join(
+                '<figure><img data-src="%s.png"><figcaption>%s</figcaption></figure>'
+                % (
+                    html.escape(thumbnail_prefix + urllib.parse.quote(name)),
+                    html.escape(name),
+                )
+                for name in names()
+            )
+            page = WALL_PAGE % {
+                "interval": json.dumps(int(1000 / self.fps)),
+                "cells": cells,
+            }
+            return (
+                HTTPStatus.OK,
+                {"content-type": "text/html; charset=utf-8"},
+                page.encode(),
+            )
+
+        return handler
+
+
+WALL_PAGE = """<!DOCTYPE html>
+<html>
+<head>
+<title>KVM consoles</title>
+<style>
+body { background: #222; color: #ddd; font-family: sans-serif; }
+figure { display: inline-block; margin: 8px; }
+img { min-width: 128px; min-height: 96px; background: #000; }
+</style>
+</head>
+<body>
+%(cells)s
+<script>
+// Thumbnails are revalidated using ETags, and only replaced when changed
+async function refresh(img) {
+  try {
+    const response = await fetch(img.dataset.src, {cache: "no-cache"});
+    const etag = response.headers.get("etag");
+    if (response.ok && etag !== img.dataset.etag) {
+      img.dataset.etag = etag;
+      URL.revokeObjectURL(img.src);
+      img.src = URL.createObjectURL(await response.blob());
+    }
+  } catch (e) {}
+}
+function refreshAll() {
+  document.querySelectorAll("img[data-src]").forEach(refresh);
+}
+refreshAll();
+setInterval(refreshAll, %(interval)s);
+</script>
+</body>
+</html>
+"""
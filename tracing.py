@@ -0,0 +1,279 @@
+"""
+Hot path tracing and on-demand profiling of a single KVM session, for
+finding out why it misbehaves without restarting the proxy.
+
+Tracer records timing spans of video pipeline stages, for a sampled fraction
+(`rate`) of data received from KVM and of updates sent to viewers:
+
+ * `read` - waiting for and reading data from KVM video socket
+ * `parse` - processing all frames read, including everything below
+ * `decompress` - decoding a single rectangle
+ * `convert` - pixel format conversion for viewer
+ * `encode` - encoding a framebuffer update for viewer
+ * `send` - writing an update to viewer socket
+
+Profiler is a cProfile enabled only while that session's video is processed
+in event loop thread, plus encoding of its updates in executor threads.
+Python 3.12+ allows only a single active cProfile per process, which records
+calls made by all threads, so there encoding isn't profiled separately, and
+profile may include some work of other threads. Sessions decoding video in
+DecodePool worker processes (see `decodepool.py`) only get encoding
+profiled.
+
+Both are attached to KVMClient (`client.tracer` and `client.profiler`, None
+when disabled), and can be captured for a number of seconds with
+`http_handler` endpoints:
+
+    /debug/trace/<session>?seconds=5&rate=0.1   - Chrome trace JSON (can be
+                                                  opened in Perfetto)
+    /debug/profile/<session>?seconds=10         - pstats report
+"""
+
+import asyncio
+import collections
+import io
+import json
+import logging
+import random
+import sys
+import threading
+import time
+import urllib.parse
+from http import HTTPStatus
+
+from client import LazyModule
+from httpserver import error
+
+# Only needed once something gets profiled
+cProfile = LazyModule("cProfile")
+pstats = LazyModule("pstats")
+
+# Longest capture allowed over HTTP, in seconds
+MAX_CAPTURE = 60
+
+# cProfile is built on sys.monitoring since Python 3.12, and only one profiler
+# can be active at a time
+SINGLE_PROFILER = sys.version_info >= (3, 12)
+
+
+class Tracer(object):
+    """
+    Bounded buffer of timing spans - (stage, start, duration, thread id,
+    attributes). Spans may be added from any thread.
+    """
+
+    def __init__(self, rate=1.0, capacity=100000):
+        self.rate = rate
+        self.spans = collections.deque(maxlen=capacity)
+
+    def sample(self):
+        """
+        Returns tracer if next unit of work (data read from KVM, or update
+        for a viewer) should be traced, None otherwise
+        """
+        if self.rate >= 1.0 or random.random() < self.rate:
+            return self
+        return None
+
+    def add(self, stage, start, **attributes):
+        """
+        Records span of `stage` started at `start` (time.perf_counter) and
+        ending now
+        """
+        self.spans.append(
+            (
+                stage,
+                start,
+                time.perf_counter() - start,
+                threading.get_ident(),
+                attributes,
+            )
+        )
+
+    def chrome_trace(self):
+        """
+        Returns spans in Chrome Trace Event Format
+        """
+        return {
+            "traceEvents": [
+                {
+                    "name": stage,
+                    "ph": "X",
+                    "ts": start * 1e6,
+                    "dur": duration * 1e6,
+                    "pid": 1,
+                    "tid": thread,
+                    "args": attributes,
+                }
+                for stage, start, duration, thread, attributes in list(self.spans)
+            ],
+            "displayTimeUnit": "ms",
+        }
+
+
+class Profiler(object):
+    """
+    cProfile of a single session - main profile is only enabled around its
+    processing in event loop thread (see KVMClient.process_frames), and
+    calls made in executor threads get profiles of their own
+    """
+
+    def __init__(self):
+        self.profile = cProfile.Profile()
+        self.enabled = False
+        self.calls = []
+
+    def enable(self):
+        """
+        Enables main profile, unless another profiler is active (which is
+        only detected on Python 3.12+) - processing just isn't profiled then
+        """
+        try:
+            self.profile.enable()
+            self.enabled = True
+        except ValueError:
+            self.enabled = False
+
+    def disable(self):
+        if self.enabled:
+            self.profile.disable()
+            self.enabled = False
+
+    def call(self, fn, *args):
+        """
+        Runs `fn` with a profile of its own - safe to use from any thread. On
+        Python 3.12+ `fn` is just called, since its profile would collide
+        with the main one.
+        """
+        if SINGLE_PROFILER:
+            return fn(*args)
+
+        profile = cProfile.Profile()
+        try:
+            return profile.runcall(fn, *args)
+        finally:
+            self.calls.append(profile)
+
+    def report(self, sort="cumulative", limit=50):
+        """
+        Returns pstats report of all profiles combined
+        """
+        out = io.StringIO()
+        stats = None
+
+        # pstats refuses profiles that haven't recorded anything (eg. of an
+        # idle session)
+        for profile in [self.profile] + list(self.calls):
+            if not profile.getstats():
+                continue
+
+            if stats is None:
+                stats = pstats.Stats(profile, stream=out)
+            else:
+                stats.add(profile)
+
+        if stats is None:
+            return "No samples collected\n"
+
+        stats.sort_stats(sort).print_stats(limit)
+        return out.getvalue()
+
+
+async def capture_trace(client, seconds, rate=1.0):
+    """
+    Traces `client` session for `seconds`, returns Tracer
+    """
+    if client.tracer is not None:
+        raise RuntimeError("Session is already being traced")
+
+    tracer = client.tracer = Tracer(rate)
+    try:
+        await asyncio.sleep(seconds)
+    finally:
+        client.tracer = client.trace = None
+
+    return tracer
+
+
+async def capture_profile(client, seconds):
+    """
+    Profiles `client` session for `seconds`, returns Profiler
+    """
+    if client.profiler is not None:
+        raise RuntimeError("Session is already being profiled")
+
+    profiler = client.profiler = Profiler()
+    try:
+        await asyncio.sleep(seconds)
+    finally:
+        client.profiler = None
+
+    return profiler
+
+
+async def log_profile(name, client, seconds=10):
+    """
+    Profiles `client` session, and logs report
+    """
+    logger = logging.getLogger("tracing")
+    logger.info("Profiling %s for %ds", name, seconds)
+    try:
+        profiler = await capture_profile(client, seconds)
+    except RuntimeError as exc:
+        logger.warning("%s: %s", name, exc)
+        return
+
+    logger.info("Profile of %s:\n%s", name, profiler.report())
+
+
+def http_handler(hub, prefix="/debug/"):
+    """
+    Returns httpserver handler capturing traces (`<prefix>trace/<session>`)
+    and profiles (`<prefix>profile/<session>`) of SessionHub sessions, with
+    `seconds` (and `rate` for traces) query parameters
+    """
+
+    async def handler(path, headers):
+        url = urllib.parse.urlparse(path)
+        if not url.path.startswith(prefix):
+            return None
+
+        kind, _, name = url.path[len(prefix) :].partition("/")
+        if kind not in ("trace", "profile"):
+            return error(HTTPStatus.NOT_FOUND)
+
+        query = urllib.parse.parse_qs(url.query)
+        try:
+            seconds = float(query.get("seconds", ["5"])[0])
+            rate = float(query.get("rate", ["1"])[0])
+        except ValueError:
+            return error(HTTPStatus.BAD_REQUEST, "Invalid parameters")
+
+        if not 0 < seconds <= MAX_CAPTURE or not 0 < rate <= 1:
+            return error(HTTPStatus.BAD_REQUEST, "Invalid parameters")
+
+        name = urllib.parse.unquote(name)
+        session = next((s for key, s in hub.sessions.items() if str(key) == name), None)
+        if session is None:
+            return error(HTTPStatus.NOT_FOUND, "No such session")
+
+        try:
+            if kind == "trace":
+                tracer = await capture_trace(session.client, seconds, rate)
+                return (
+                    HTTPStatus.OK,
+                    {"content-type": "application/json"},
+                    json.dumps(tracer.chrome_trace()).encode(),
+                )
+
+            profiler = await capture_profile(session.client, seconds)
+            return (
+                HTTPStatus.OK,
+                {"content-type": "text/plain; charset=utf-8"},
+                profiler.report().encode(),
+            )
+
+        except RuntimeError as exc:
+            return error(HTTPStatus.CONFLICT, str(exc))
+
+    return handler
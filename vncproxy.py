@@ -1,83 +1,500 @@
 import struct
-import threading
+import array
 import asyncio
 import csv
+import functools
 import logging
+import os
+import signal
 import sys
+import time
 
-from client import rgb555_to_rgb888, KVMClient
+from client import AsyncKVMClient
+import tracing
+from httpserver import chain, start_server
+from metrics import Histogram, http_handler
+from region import Region, intersect
+from pixelformat import PixelFormat, DEFAULT_PIXEL_FORMAT
+import encoders
 
+KEYMAP_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "keymaps.csv")
 
-def build_keymap():
+
+def build_keymap(path=KEYMAP_PATH):
     keymap = {}
 
-    with open("keymaps.csv") as fd:
+    with open(path) as fd:
         reader = csv.reader(fd)
         headers = next(reader)
+        keysym = headers.index("X11 keysym")
+        keycode = headers.index("USB Keycodes")
         for row in reader:
-            r = dict(zip(headers, row))
-            if r["USB Keycodes"] and r["X11 keysym"]:
-                keymap[int(r["X11 keysym"][2:], 16)] = int(r["USB Keycodes"])
+            if row[keycode] and row[keysym]:
+                keymap[int(row[keysym][2:], 16)] = int(row[keycode])
 
     return keymap
 
 
+def load_keymap(path=KEYMAP_PATH):
+    """
+    Returns X11 keysym to USB keycode mapping. Parsed keymap is cached in
+    __pycache__ next to `path` as a flat array of (keysym, keycode) pairs,
+    and used for as long as keymap file isn't modified.
+    """
+    stat = os.stat(path)
+    cache = os.path.join(
+        os.path.dirname(path),
+        "__pycache__",
+        "keymaps.%x-%x.bin" % (stat.st_mtime_ns, stat.st_size),
+    )
+
+    pairs = array.array("I")
+    try:
+        with open(cache, "rb") as fd:
+            pairs.frombytes(fd.read())
+        return dict(zip(pairs[0::2], pairs[1::2]))
+    except (OSError, ValueError):
+        pass
+
+    keymap = build_keymap(path)
+    for item in sorted(keymap.items()):
+        pairs.extend(item)
+
+    # Written atomically, since other proxy processes may be starting too.
+    # Read-only installations just parse keymap every time.
+    try:
+        os.makedirs(os.path.dirname(cache), exist_ok=True)
+        temp = "%s.%d" % (cache, os.getpid())
+        with open(temp, "wb") as fd:
+            fd.write(pairs.tobytes())
+        os.replace(temp, cache)
+    except OSError:
+        pass
+
+    return keymap
+
+
+class SessionLimitError(Exception):
+    """
+    Raised when a session or viewer can't be added due to SessionHub limits
+    """
+
+
+class KVMSession(object):
+    """
+    Single upstream AsyncKVMClient connection shared by any number of
+    VNCHandler viewers. Each video rectangle is decoded once into client
+    framebuffer, and areas it actually changed are reported to all attached
+    viewers as damage.
+    """
+
+    def __init__(self, client, loop, linger=None):
+        self.client = client
+        self.loop = loop
+        self.linger = linger
+        self.viewers = set()
+
+        # Other consumers of damage/copy reports (eg. thumbnails), which
+        # don't keep the session alive
+        self.observers = set()
+        self.task = None
+        self.closed = False
+        self.connected = asyncio.Event()
+        self.on_close = None
+        self.linger_handle = None
+        self.created = time.time()
+        self.logger = logging.getLogger("proxy.KVMSession")
+
+        # Totals of all viewers, past and present (see metrics.py)
+        self.updates_sent = 0
+        self.bytes_sent = 0
+        self.encode_seconds = Histogram()
+        self.update_delay = Histogram()
+
+        self.client.on_damage = self.client_on_damage
+        self.client.on_copy = self.client_on_copy
+
+    @property
+    def stats(self):
+        return dict(
+            self.client.stats,
+            viewers=len(self.viewers),
+            memory=self.client.memory_usage,
+            uptime=time.time() - self.created,
+            updates_sent=self.updates_sent,
+            bytes_sent=self.bytes_sent,
+        )
+
+    def attach(self, viewer):
+        if self.linger_handle:
+            self.linger_handle.cancel()
+            self.linger_handle = None
+
+        self.viewers.add(viewer)
+        self.logger.info("Viewer attached, %d total", len(self.viewers))
+        self.start()
+
+    def start(self):
+        """
+        Starts upstream connection if it's not running yet. If there are no
+        viewers attached, it's closed after `linger` seconds, as if the last
+        one just left.
+        """
+        if self.task is None:
+            self.task = asyncio.ensure_future(self.client_run())
+
+        if (
+            not self.viewers
+            and not self.closed
+            and self.linger is not None
+            and self.linger_handle is None
+        ):
+            self.linger_handle = self.loop.call_later(self.linger, self.close)
+
+    def detach(self, viewer):
+        if viewer not in self.viewers:
+            return
+
+        self.viewers.remove(viewer)
+        self.logger.info("Viewer detached, %d left", len(self.viewers))
+
+        # Upstream connection is kept alive for `linger` seconds after last
+        # viewer leaves (or forever, if None)
+        if not self.viewers and not self.closed and self.linger is not None:
+            self.linger_handle = self.loop.call_later(self.linger, self.close)
+
+    def close(self):
+        self.client.stop()
+
+    async def client_run(self):
+        try:
+            await self.client.run()
+        except OSError as exc:
+            self.logger.info("Upstream connection closed: %r", exc)
+        finally:
+            self.client_closed()
+
+    def client_closed(self):
+        self.closed = True
+        self.connected.set()
+
+        for viewer in list(self.viewers):
+            asyncio.ensure_future(viewer.sock.close())
+
+        if self.on_close:
+            self.on_close(self)
+
+    def client_on_damage(self, x, y, w, h):
+        # Rectangles are reported as soon as these are decoded, without
+        # waiting for the rest of the fragment.
+        self.connected.set()
+
+        for viewer in list(self.viewers) + list(self.observers):
+            viewer.on_damage(x, y, w, h)
+
+    def client_on_copy(self, x, y, w, h, src_x, src_y):
+        for viewer in list(self.viewers) + list(self.observers):
+            viewer.on_copy(x, y, w, h, src_x, src_y)
+
+
+class SessionHub(object):
+    """
+    Keeps a single KVMSession per upstream host, optionally limiting number of
+    concurrent sessions and viewers per session
+    """
+
+    def __init__(self, loop, linger=None, max_sessions=None, max_viewers=None):
+        self.loop = loop
+        self.linger = linger
+        self.max_sessions = max_sessions
+        self.max_viewers = max_viewers
+        self.sessions = {}
+
+        # Called with (key, session) once a session has ended
+        self.on_close = None
+
+    def get(self, key, client_factory):
+        """
+        Returns running session for `key`, or creates a new one using
+        AsyncKVMClient returned by `client_factory`. Raises SessionLimitError
+        if limits don't allow another viewer to join.
+        """
+        session = self.sessions.get(key)
+
+        if session is None:
+            if (
+                self.max_sessions is not None
+                and len(self.sessions) >= self.max_sessions
+            ):
+                raise SessionLimitError(
+                    "Session limit (%d) reached" % self.max_sessions
+                )
+
+            session = KVMSession(client_factory(), self.loop, linger=self.linger)
+            session.on_close = lambda s: self.remove(key, s)
+            self.sessions[key] = session
+
+        elif self.max_viewers is not None and len(session.viewers) >= self.max_viewers:
+            raise SessionLimitError(
+                "Viewer limit (%d) reached for %r" % (self.max_viewers, key)
+            )
+
+        return session
+
+    def remove(self, key, session):
+        if self.sessions.get(key) is session:
+            del self.sessions[key]
+
+        if self.on_close:
+            self.on_close(key, session)
+
+    def trim(self):
+        """
+        Releases oversized per-session buffers, keeping memory use of idle
+        sessions close to their framebuffer size
+        """
+        for session in self.sessions.values():
+            session.client.trim()
+
+    @property
+    def stats(self):
+        sessions = {key: session.stats for key, session in self.sessions.items()}
+        return {
+            "sessions": len(sessions),
+            "viewers": sum(s["viewers"] for s in sessions.values()),
+            "memory": sum(s["memory"] for s in sessions.values()),
+            "per_session": sessions,
+        }
+
+
+async def serve_viewer(sock, hub, key, client_factory, loop):
+    """
+    Runs VNCHandler for a viewer connection, attached to `hub` session for
+    `key` (see SessionHub.get)
+    """
+    try:
+        session = hub.get(key, client_factory)
+    except SessionLimitError as exc:
+        logging.warning("Refusing viewer: %s", exc)
+        await sock.close()
+        return
+
+    handler = VNCHandler(sock, session, loop)
+    try:
+        await handler.handle()
+    except ConnectionError as exc:
+        logging.info("Viewer disconnected: %r", exc)
+    finally:
+        handler.finish()
+
+
 class VNCHandler(object):
     """
-    Naive VNC server-proxy implementation to be used with KVMClient.
+    Naive VNC server-proxy implementation to be used with AsyncKVMClient.
     """
 
-    first_frame = None
     res_x = 0
     res_y = 0
     client = None
-    keymap = build_keymap()
+    keymap = load_keymap()
 
-    def __init__(self, sock, client, loop):
+    def __init__(self, sock, session, loop):
         self.sock = sock
-        self.client = client
+        self.session = session
+        self.client = session.client
         self.loop = loop
         self.recv_buffer = bytearray()
         self.logger = logging.getLogger("proxy.VNCHandler")
-        self.connected = asyncio.Event()
         self.encodings = []
+        self.pixel_format = DEFAULT_PIXEL_FORMAT
+        self.compress_level = self.quality_level = None
+
+        # Encoders are kept for the whole connection, since zlib streams of
+        # each encoding need to persist even if viewer switches between them
+        self.encoders = {}
+        self.encoder = self.get_encoder(encoders.RAW)
+
+        # Framebuffer areas changed since these were last sent to viewer, and
+        # area of pending UpdateRequest, if there's one. Damage reported while
+        # viewer is still busy receiving previous update is merged into dirty
+        # region, and only latest framebuffer contents are ever sent, so
+        # memory use stays bounded regardless of viewer speed.
+        self.dirty = Region()
+        self.requested = None
+
+        # Framebuffer area copy (scroll) not yet sent to viewer, as CopyRect
+        # (x, y, w, h, src_x, src_y). It is always sent first in an update,
+        # with dirty region adjusted to what viewer will have after the copy.
+        self.copy = None
+        self.copies_sent = 0
+        self.wakeup = asyncio.Event()
+        self.sender = None
+        self.updates_sent = 0
+
+        # Time of the oldest change not sent to viewer yet
+        self.dirty_since = None
+
+    @property
+    def stats(self):
+        return {
+            "queue_depth": len(self.dirty),
+            "dropped_updates": self.dirty.superseded,
+            "updates_sent": self.updates_sent,
+            "copies_sent": self.copies_sent,
+        }
 
-    async def on_frame(self, chunks, resx, resy):
-        self.logger.debug("on_frame(%d, %d, %d)" % (len(chunks), resx, resy))
-
-        frame = struct.pack(">BxH", 0, len(chunks))
-
-        for x, y, w, h, chunk in chunks:
-            chunkdata = rgb555_to_rgb888(chunk)
-            if y + h > resy:
-                h = resy - y
-                chunkdata = chunkdata[: w * h * 4]
-            frame += (
-                struct.pack(
-                    ">HHHHi",
-                    x,
-                    y,
-                    w,
-                    h,
-                    0,
-                )
-                + chunkdata
+    def get_encoder(self, encoding):
+        if encoding not in self.encoders:
+            compress_level, quality_level = encoders.select_levels(self.encodings)
+            self.encoders[encoding] = encoders.ENCODERS[encoding](
+                self.pixel_format, compress_level, quality_level
             )
 
-        if not self.connected.is_set():
+        return self.encoders[encoding]
+
+    def on_damage(self, x, y, w, h):
+        self.dirty.add(x, y, w, h)
+        if self.dirty_since is None:
+            self.dirty_since = time.monotonic()
+
+        if self.requested:
+            self.wakeup.set()
+
+    def on_copy(self, x, y, w, h, src_x, src_y):
+        if (
+            self.copy is not None
+            or encoders.COPYRECT not in self.encodings
+            or (self.res_x, self.res_y) != self.client.resolution
+        ):
+            self.on_damage(x, y, w, h)
+            return
+
+        # Parts of source not yet sent to viewer will be copied stale, so
+        # these need to be resent at their destination. Anything dirty at
+        # the destination gets overwritten by the copy.
+        moved = [
+            rect
+            for rect in (intersect(r, (src_x, src_y, w, h)) for r in self.dirty)
+            if rect
+        ]
+        self.dirty.take(x, y, w, h)
+        for rx, ry, rw, rh in moved:
+            self.dirty.add(rx + x - src_x, ry + y - src_y, rw, rh)
+
+        self.copy = (x, y, w, h, src_x, src_y)
+        if self.dirty_since is None:
+            self.dirty_since = time.monotonic()
+
+        if self.requested:
+            self.wakeup.set()
+
+    async def send_loop(self):
+        """
+        Per-viewer delivery stage - sends updates whenever there's a pending
+        request and something to send
+        """
+        while True:
+            await self.wakeup.wait()
+            self.wakeup.clear()
+            await self.flush()
+
+    async def flush(self):
+        """
+        Answers pending UpdateRequest with dirty rectangles within requested
+        area, read from client framebuffer. Request is left pending if there's
+        nothing to send yet.
+        """
+        if self.requested is None:
+            return
+
+        resx, resy = self.client.resolution
+        encoded = []
+
+        if (self.res_x, self.res_y) != (resx, resy):
+            self.logger.debug("Resolution change detected")
             self.res_x = resx
             self.res_y = resy
-            self.first_frame = frame
-            self.connected.set()
+            self.dirty.clear()
+            self.dirty.add(0, 0, resx, resy)
+            self.copy = None
+
+            # Viewer resizes its framebuffer on DesktopSize, so the repaint
+            # of the whole new screen goes along with it in the same update
+            if encoders.PSEUDO_DESKTOP_SIZE in self.encodings:
+                self.requested = (0, 0, resx, resy)
+                encoded.append(
+                    encoders.rect_header(0, 0, resx, resy, encoders.PSEUDO_DESKTOP_SIZE)
+                )
 
-        else:
-            if (self.res_x, self.res_y) != (resx, resy) and -223 in self.encodings:
-                self.logger.debug("Resolution change detected")
-                await self.send(struct.pack(">BxHHHHHi", 0, 1, 0, 0, resx, resy, -223))
-                self.res_x = resx
-                self.res_y = resy
+        area = intersect(self.requested, (0, 0, resx, resy))
+        rects = self.dirty.take(*area) if area else []
+        if not rects and self.copy is None and not encoded:
+            return
+
+        self.requested = None
 
-            await self.send(frame)
+        if self.copy is not None:
+            x, y, w, h, src_x, src_y = self.copy
+            encoded.append(
+                encoders.rect_header(x, y, w, h, encoders.COPYRECT)
+                + struct.pack(">HH", src_x, src_y)
+            )
+            self.copy = None
+            self.copies_sent += 1
+
+        # Rectangles are copied out of framebuffer right away, but converted
+        # and encoded in executor thread, so that large updates don't stall
+        # other viewers and keyboard input handled by the event loop.
+        encoder = self.encoder
+        encoder.pixel_format = self.pixel_format
+        encoder.quality_level = self.quality_level
+        encoder.set_compress_level(self.compress_level)
+        encoder.tracer = trace = (
+            self.client.tracer.sample() if self.client.tracer is not None else None
+        )
+        snapshot = [
+            (x, y, w, h, self.client.read_rect(x, y, w, h)) for x, y, w, h in rects
+        ]
+
+        # Profiled sessions get encoding profiled as well
+        encode = self.encode
+        if self.client.profiler is not None:
+            encode = functools.partial(self.client.profiler.call, encode)
+
+        start = time.monotonic()
+        encoded.extend(await self.loop.run_in_executor(None, encode, encoder, snapshot))
+        self.session.encode_seconds.observe(time.monotonic() - start)
+
+        start = time.perf_counter()
+        await self.send_many([struct.pack(">BxH", 0, len(encoded))] + encoded)
+        if trace is not None:
+            trace.add("send", start, size=sum(map(len, encoded)))
+        self.updates_sent += 1
+        self.session.updates_sent += 1
+
+        # Changes made while this update was encoded and sent are only
+        # counted from now, which is when they could have been noticed
+        now = time.monotonic()
+        if self.dirty_since is not None:
+            self.session.update_delay.observe(now - self.dirty_since)
+        self.dirty_since = now if self.dirty else None
+
+    @staticmethod
+    def encode(encoder, rects):
+        start = time.perf_counter()
+        encoded = []
+        for x, y, w, h, data in rects:
+            encoded.extend(encoder.encode(x, y, w, h, data))
+
+        if encoder.tracer is not None:
+            encoder.tracer.add(
+                "encode",
+                start,
+                encoding=encoder.encoding,
+                rects=len(rects),
+                pixels=sum(w * h for x, y, w, h, data in rects),
+            )
+        return encoded
 
     async def recv(self, num_bytes=None):
         if num_bytes is None:
@@ -97,14 +514,18 @@ class VNCHandler(object):
         return chunk
 
     async def send(self, payload):
+        self.session.bytes_sent += len(payload)
         await self.sock.send(payload)
 
-    def client_run(self):
-        try:
-            self.client.run()
-        finally:
-            asyncio.run_coroutine_threadsafe(self.sock.close(), self.loop)
-            self.connected.set()
+    async def send_many(self, chunks):
+        self.session.bytes_sent += sum(map(len, chunks))
+
+        # Sockets that can write a scatter list get chunks as-is, others
+        # (websockets) a single message
+        if hasattr(self.sock, "send_many"):
+            await self.sock.send_many(chunks)
+        else:
+            await self.sock.send(b"".join(chunks))
 
     async def handle(self):
         # ProtocolVersion
@@ -124,36 +545,24 @@ class VNCHandler(object):
         (shared,) = struct.unpack(">?", await self.recv(1))
         self.logger.debug("Shared: %r", shared)
 
-        # Execute callbacks in asynctio thread...
-        self.client.on_frame = lambda *args: asyncio.run_coroutine_threadsafe(
-            self.on_frame(*args), self.loop
-        )
-        self.client_thread = threading.Thread(target=self.client_run)
-        self.client_thread.start()
+        self.session.attach(self)
 
         self.logger.info("Connecting...")
-        await self.connected.wait()
+        await self.session.connected.wait()
+        if self.session.closed:
+            return
+
+        self.res_x, self.res_y = self.client.resolution
         self.logger.info("Connected! %d %d", self.res_x, self.res_y)
 
+        self.sender = asyncio.ensure_future(self.send_loop())
+
         # ServerInit
         server_name = b"Test RFB Server"
         server_init = (
-            struct.pack(
-                ">HHBBBBHHHBBBxxxI",
-                self.res_x,  # width
-                self.res_y,  # height
-                24,  # bpp
-                24,  # depth
-                0,  # big endian
-                1,  # true color
-                0xFF,  # max rgb
-                0xFF,
-                0xFF,
-                16,  # shift rgb
-                8,
-                0,
-                len(server_name),
-            )
+            struct.pack(">HH", self.res_x, self.res_y)
+            + self.pixel_format.pack()
+            + struct.pack(">I", len(server_name))
             + server_name
         )
         await self.send(server_init)
@@ -168,18 +577,41 @@ class VNCHandler(object):
 
     async def handle_SetPixelFormat(self, *pixel_format):
         # SetPixelFormat
+        pixel_format = PixelFormat(*pixel_format)
         self.logger.info("Pixel format: %r", pixel_format)
 
+        if not pixel_format.true_color:
+            self.logger.warning("Color map pixel formats are not supported")
+            return
+
+        # Applied to encoder when next update is prepared, so that an update
+        # that is being encoded at the moment isn't affected
+        self.pixel_format = pixel_format
+
     async def handle_SetEncodings(self, num_enc):
         # SetEncodings
         self.encodings = struct.unpack(">%di" % num_enc, await self.recv(4 * num_enc))
         self.logger.info("Encodings: %d %r", num_enc, self.encodings)
 
+        # Levels are applied to encoder when next update is prepared, just
+        # like pixel format
+        self.compress_level, self.quality_level = encoders.select_levels(self.encodings)
+        self.encoder = self.get_encoder(encoders.select_encoding(self.encodings))
+        self.logger.info(
+            "Using %s (compression: %r, quality: %r)",
+            type(self.encoder).__name__,
+            self.compress_level,
+            self.quality_level,
+        )
+
     async def handle_UpdateRequest(self, incremental, x, y, w, h):
         # UpdateRequest
-        if self.first_frame:
-            await self.send(self.first_frame)
-            self.first_frame = None
+        if not incremental:
+            # Full refresh of requested area, served from client framebuffer
+            self.dirty.add(x, y, w, h)
+
+        self.requested = (x, y, w, h)
+        self.wakeup.set()
 
     modifiers = 0
 
@@ -223,8 +655,10 @@ class VNCHandler(object):
     }
 
     def finish(self):
-        if self.client:
-            self.client.stop()
+        if self.sender:
+            self.sender.cancel()
+
+        self.session.detach(self)
         self.logger.info("cleanup finished")
 
 
@@ -242,12 +676,22 @@ class WrappedSocket(object):
 
     async def recv(self, num=1024):
         self.pending_recv = asyncio.ensure_future(self.reader.read(num))
-        return await self.pending_recv
+        data = await self.pending_recv
+
+        # Websockets raise ConnectionClosed instead of returning nothing
+        if not data:
+            raise ConnectionResetError("Connection closed by viewer")
+
+        return data
 
     async def send(self, data):
         self.writer.write(data)
         await self.writer.drain()
 
+    async def send_many(self, chunks):
+        self.writer.writelines(chunks)
+        await self.writer.drain()
+
     async def close(self):
         self.writer.close()
         if self.pending_recv:
@@ -257,19 +701,41 @@ class WrappedSocket(object):
 if __name__ == "__main__":
     loop = asyncio.get_event_loop()
 
-    async def handle_vnc(reader, writer):
-        sock = WrappedSocket(reader, writer)
-        client = KVMClient.from_arguments(sys.argv[1:])
-        handler = VNCHandler(sock, client, loop)
+    # One-time authentication token can't be reused, so upstream connection
+    # is kept alive even when no viewers are connected.
+    hub = SessionHub(loop, linger=None)
 
-        try:
-            await handler.handle()
-        finally:
-            handler.finish()
+    async def handle_vnc(reader, writer):
+        await serve_viewer(
+            WrappedSocket(reader, writer),
+            hub,
+            sys.argv[1],
+            lambda: AsyncKVMClient.from_arguments(sys.argv[1:]),
+            loop,
+        )
 
-    host, port = "127.0.0.1", 5900
+    host, port = "127.0.0.1", int(os.getenv("VNC_PORT", 5900))
 
     vnc_server = asyncio.start_server(handle_vnc, host, port)
     logging.info("Listening on {}:{}".format(host, port))
     loop.run_until_complete(vnc_server)
+
+    # Prometheus metrics, scraped from http://host:$METRICS_PORT/metrics, and
+    # tracing/profiling endpoints (see tracing.py)
+    if os.getenv("METRICS_PORT"):
+        loop.run_until_complete(
+            start_server(
+                chain(http_handler(hub), tracing.http_handler(hub)),
+                host,
+                int(os.getenv("METRICS_PORT")),
+            )
+        )
+
+    # SIGUSR1 logs 10 second profile of the session
+    def profile_sessions():
+        for key, session in hub.sessions.items():
+            asyncio.ensure_future(tracing.log_profile(key, session.client))
+
+    loop.add_signal_handler(signal.SIGUSR1, profile_sessions)
+
     loop.run_forever()